@@ -0,0 +1,222 @@
+"""
+Offline engine that computes the top-k companies of every incentive in one pass.
+
+Instead of one vector query per incentive, the company embeddings are streamed out of Postgres in blocks
+and compared against all the incentive query vectors at once (one matrix product per block, numpy/BLAS uses all the cores).
+Only the running top-k of each incentive is kept, so memory stays bounded no matter how many companies there are.
+
+Examples:
+    python all_pairs_matching.py                                    # incentive embeddings as queries
+    python all_pairs_matching.py --queries rewrite                  # LLM query rewrite (same as create_csv_matching), cached
+    python all_pairs_matching.py --queries incentive_query_vectors.npz --compare 20
+    python all_pairs_matching.py --snapshot snapshots/2025-10-15         # no database, reads a snapshot (see snapshot.py)
+"""
+import argparse
+import csv
+import os
+import threading
+import time
+from queue import Queue
+
+import numpy as np
+
+from sql import PostgreSQLManager, DB_CONFIG
+
+QUERY_VECTORS_FILE = "incentive_query_vectors.npz"
+
+
+class RunningTopK:
+    """
+    Top-k smallest distances of every query, merged block by block.
+    Same idea as keeping one heap per incentive, but vectorized over all the incentives at once.
+    """
+
+    def __init__(self, n_queries: int, k: int):
+        self.k = k
+        self.scores = np.full((n_queries, 0), np.inf, dtype=np.float32)
+        self.ids = np.empty((n_queries, 0), dtype=np.int64)
+
+    def push(self, scores: np.ndarray, ids: np.ndarray):
+        """scores: (n_queries, block) smaller is better, ids: (block,)"""
+        if scores.shape[1] > self.k:
+            # Only the best k of the block can get into the top k
+            candidates = np.argpartition(scores, self.k - 1, axis=1)[:, :self.k]
+            scores = np.take_along_axis(scores, candidates, axis=1)
+            block_ids = ids[candidates]
+        else:
+            block_ids = np.broadcast_to(ids, scores.shape)
+        merged_scores = np.concatenate([self.scores, scores], axis=1)
+        merged_ids = np.concatenate([self.ids, block_ids], axis=1)
+        if merged_scores.shape[1] > self.k:
+            best = np.argpartition(merged_scores, self.k - 1, axis=1)[:, :self.k]
+            merged_scores = np.take_along_axis(merged_scores, best, axis=1)
+            merged_ids = np.take_along_axis(merged_ids, best, axis=1)
+        self.scores, self.ids = merged_scores, merged_ids
+
+    def result(self):
+        """(scores, ids) sorted from best to worst"""
+        order = np.argsort(self.scores, axis=1)
+        return np.take_along_axis(self.scores, order, axis=1), np.take_along_axis(self.ids, order, axis=1)
+
+
+class PrefetchError:
+    """Put in the queue by the producer when the iterator raised, the consumer raises it again"""
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def prefetch(iterator, depth: int = 2):
+    """
+    Fetch/parse the next blocks in a background thread while the current one is being computed.
+    An error of the iterator is raised in the consumer (a top-k of part of the companies is not a result).
+    """
+    queue = Queue(maxsize=depth)
+    done = object()
+
+    def producer():
+        try:
+            for item in iterator:
+                queue.put(item)
+        except BaseException as e:
+            queue.put(PrefetchError(e))
+            return
+        queue.put(done)
+
+    threading.Thread(target=producer, daemon=True).start()
+    while True:
+        item = queue.get()
+        if item is done:
+            return
+        if isinstance(item, PrefetchError):
+            raise item.error
+        yield item
+
+
+def all_pairs_top_k(database: PostgreSQLManager, queries: np.ndarray, k: int = 5, block_size: int = 20000):
+    """
+    Top k companies (L2 distance, same as the <-> operator) for each query vector.
+    Returns (distances, company_ids), both (n_queries, k) and sorted.
+    """
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    query_norms = np.einsum("ij,ij->i", queries, queries)
+    top_k = RunningTopK(len(queries), k)
+    n_companies = 0
+    time_start = time.time()
+    for company_ids, block in prefetch(database.iter_company_embeddings(block_size)):
+        # |q - c|^2 = |q|^2 + |c|^2 - 2 q.c, |q|^2 is the same for the whole row so it's added at the end
+        scores = np.einsum("ij,ij->i", block, block)[None, :] - 2.0 * (queries @ block.T)
+        top_k.push(scores, company_ids)
+        n_companies += len(company_ids)
+        print(f"📦 {n_companies} companies processed ({n_companies / (time.time() - time_start):.0f} companies/s)")
+    scores, ids = top_k.result()
+    distances = np.sqrt(np.maximum(scores + query_norms[:, None], 0.0))
+    return distances, ids
+
+
+def load_query_vectors(database: PostgreSQLManager, source: str):
+    """Returns (incentive_ids, titles, query vectors)"""
+    if source == "incentives":
+        rows = database.get_incentive_embeddings()
+        ids = np.array([row["incentive_id"] for row in rows])
+        vectors = np.array([row["embeddings"] for row in rows], dtype=np.float32)
+    elif source == "rewrite":
+        if os.path.exists(QUERY_VECTORS_FILE):
+            return load_query_vectors(database, QUERY_VECTORS_FILE)
+        ids, vectors = create_rewrite_query_vectors(database)
+    else:
+        data = np.load(source)
+        ids, vectors = data["incentive_ids"], data["vectors"].astype(np.float32)
+    titles = {incentive["incentive_id"]: incentive["title"] for incentive in database.load_incentives() or []}
+    return ids, [titles.get(int(i), "") for i in ids], vectors
+
+
+def create_rewrite_query_vectors(database: PostgreSQLManager, path: str = QUERY_VECTORS_FILE):
+    """Same queries as create_csv_matching (LLM rewrite + embedding), saved so they are only paid once"""
+    from tool_calling import create_incentive_query
+
+    incentive_ids = [row[0] for row in database.general_query("SELECT incentive_id FROM incentives ORDER BY incentive_id")]
+    queries = [create_incentive_query(incentive_id) for incentive_id in incentive_ids]
+    vectors = []
+    for i in range(0, len(queries), 500):
+        response = database.embedder.get_embedding(queries[i:i + 500], model="text-embedding-3-small")
+        vectors.extend(e.embedding for e in response["embedding"])
+    ids = np.array(incentive_ids)
+    vectors = np.array(vectors, dtype=np.float32)
+    np.savez(path, incentive_ids=ids, vectors=vectors, queries=np.array(queries))
+    print(f"✅ Saved {len(ids)} query vectors to {path}")
+    return ids, vectors
+
+
+def write_results(database, path, scores_path, incentive_ids, titles, distances, company_ids):
+    companies = database.query_companies_by_ids(np.unique(company_ids).tolist()) or {}
+    k = company_ids.shape[1]
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["incentive_id", "title"] + [f"company_{i + 1}" for i in range(k)])
+        for incentive_id, title, row in zip(incentive_ids, titles, company_ids):
+            writer.writerow([int(incentive_id), title] + [companies.get(int(c), {}).get("company_name", "") for c in row])
+    print(f"✅ Wrote {len(incentive_ids)} incentives to {path}")
+
+    if scores_path:
+        with open(scores_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["incentive_id", "rank", "company_id", "company_name", "distance_score"])
+            for incentive_id, row_ids, row_distances in zip(incentive_ids, company_ids, distances):
+                for rank, (company_id, distance) in enumerate(zip(row_ids, row_distances), start=1):
+                    name = companies.get(int(company_id), {}).get("company_name", "")
+                    writer.writerow([int(incentive_id), rank, int(company_id), name, f"{distance:.6f}"])
+        print(f"✅ Wrote scores to {scores_path}")
+
+
+def compare_with_per_query(database, vectors, company_ids, k, n_samples, engine_seconds):
+    """Run the old one-query-per-incentive approach on a sample and extrapolate to every incentive"""
+    sample = np.random.default_rng(0).choice(len(vectors), size=min(n_samples, len(vectors)), replace=False)
+    time_start = time.time()
+    overlap = []
+    names = database.query_companies_by_ids(np.unique(company_ids[sample]).tolist()) or {}
+    for i in sample:
+        results = database.query_companies_by_vector(vectors[i], k) or []
+        per_query = {r["company_name"] for r in results}
+        engine = {names.get(int(c), {}).get("company_name") for c in company_ids[i]}
+        overlap.append(len(per_query & engine) / k)
+    per_query_seconds = (time.time() - time_start) / len(sample)
+    print("\n📊 All-pairs engine vs one query per incentive")
+    print(f"  {'approach':<28}{'seconds':>12}")
+    print(f"  {'all-pairs (measured)':<28}{engine_seconds:>12.2f}")
+    print(f"  {'per-query (extrapolated)':<28}{per_query_seconds * len(vectors):>12.2f}")
+    print(f"  per-query latency: {per_query_seconds * 1000:.1f} ms, speedup: {per_query_seconds * len(vectors) / engine_seconds:.1f}x")
+    print(f"  top-{k} agreement on {len(sample)} sampled incentives: {np.mean(overlap):.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Top-k companies for every incentive in one pass")
+    parser.add_argument("--queries", default="incentives", help="'incentives', 'rewrite' or a .npz file with incentive_ids and vectors")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--block-size", type=int, default=20000)
+    parser.add_argument("--output", default="incentivos_com_empresas_all_pairs.csv")
+    parser.add_argument("--scores-output", default=None, help="optional long CSV with company ids and distances")
+    parser.add_argument("--compare", type=int, default=0, help="also time N per-query searches and compare")
+    parser.add_argument("--snapshot", default=None, help="read the incentives and companies from a snapshot directory instead of Postgres")
+    args = parser.parse_args()
+
+    if args.snapshot:
+        from snapshot import load_snapshot
+        database = load_snapshot(args.snapshot)
+    else:
+        database = PostgreSQLManager(**DB_CONFIG)
+    incentive_ids, titles, vectors = load_query_vectors(database, args.queries)
+    print(f"🔎 {len(incentive_ids)} incentive query vectors")
+
+    time_start = time.time()
+    distances, company_ids = all_pairs_top_k(database, vectors, args.top_k, args.block_size)
+    engine_seconds = time.time() - time_start
+    print(f"🕒 All-pairs top-{args.top_k} took {engine_seconds:.2f} seconds")
+
+    write_results(database, args.output, args.scores_output, incentive_ids, titles, distances, company_ids)
+    if args.compare and not args.snapshot:
+        compare_with_per_query(database, vectors, company_ids, args.top_k, args.compare, engine_seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,13 @@
 # Please install OpenAI SDK first: `pip3 install openai`
 import os
+import openai
 from openai import OpenAI
 from openai.types.chat.chat_completion import ChatCompletion
 from dotenv import load_dotenv
 from typing import List, Dict
+from outbound import scheduler, estimate_tokens
+from routing import router
+import cancellation
 
 # Load environment variables from .env file
 load_dotenv()
@@ -15,13 +19,17 @@ class API():
         if model_name.startswith("deepseek"):
             self.client = OpenAI(
                 api_key=os.getenv("MY_DEEPSEEK_API_KEY"),
-                base_url="https://api.deepseek.com"
+                base_url="https://api.deepseek.com",
+                max_retries=0  # retries are done by the outbound scheduler
             )
+            self.provider = "deepseek"
         else:
             self.client = OpenAI(
-                api_key=os.getenv("THEIR_GPT_API_KEY")
+                api_key=os.getenv("THEIR_GPT_API_KEY"),
                 # base_url default (OpenAI's official)
+                max_retries=0
             )
+            self.provider = "openai"
         self.model = model_name
         self.conversation_token_history = []  # I was thinking later use this to put on a graph or something
 
@@ -42,23 +50,57 @@ class API():
             messages.pop(1) # user
             messages.pop(1) # assistant
 
-    def call(self, prompt: str, system: str = "You are a helpful assistant"):
-        response = self.client.chat.completions.create(
+    def create_completion(self, messages: List[Dict[str, str]]) -> ChatCompletion:
+        # Goes through the shared scheduler (concurrency / rate limits / retries on 429)
+        return scheduler.call(
+            self.provider,
+            self.cancellable_create,
             model=self.model,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": prompt}
-            ],
-            stream=False
+            messages=messages,
+            stream=False,
+            estimated_tokens=estimate_tokens(messages) + 500,  # + room for the answer
+            usage_tokens=lambda response: response.usage.total_tokens
         )
+
+    def cancellable_create(self, **kwargs) -> ChatCompletion:
+        """chat.completions.create that stops when the current request is cancelled (see cancellation.py)"""
+        token = cancellation.current()
+        if token is None:
+            return self.client.chat.completions.create(**kwargs)
+        try:
+            token.check()
+        except cancellation.RequestCancelled:
+            cancellation.stats.add("llm_calls_skipped")
+            raise
+        options = {"http_client": token.http_client()}
+        if token.remaining() is not None:
+            options["timeout"] = token.remaining()
+        client = self.client.with_options(**options)
+        try:
+            return client.chat.completions.create(**kwargs)
+        except (openai.APIConnectionError, openai.APITimeoutError) as e:
+            if not token.cancelled and token.remaining() == 0:
+                token.cancel("deadline")
+            if token.cancelled:
+                cancellation.stats.add("llm_calls_aborted")
+                raise cancellation.RequestCancelled(token.reason) from e
+            raise
+
+    def complete(self, messages: List[Dict[str, str]], site: str = None) -> ChatCompletion:
+        # With a call site the model (and hedging) comes from routing.py, without it it's this API's model
+        if site is None:
+            return self.create_completion(messages)
+        return router.complete(site, messages)
+
+    def call(self, prompt: str, system: str = "You are a helpful assistant", site: str = None):
+        response = self.complete([
+            {"role": "system", "content": system},
+            {"role": "user", "content": prompt}
+        ], site)
         return response.choices[0].message.content
     
-    def converse(self, messages: List[Dict[str, str]]) -> str:
-        response: ChatCompletion = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            stream=False
-        )
+    def converse(self, messages: List[Dict[str, str]], site: str = None) -> str:
+        response: ChatCompletion = self.complete(messages, site)
         self.conversation_token_history.append({
             "cache_hit_tokens": response.usage.prompt_tokens_details.cached_tokens,
             "cache_miss_tokens": response.usage.prompt_tokens - response.usage.prompt_tokens_details.cached_tokens,
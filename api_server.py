@@ -1,10 +1,26 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Query, Request
+from contextlib import asynccontextmanager
+from fastapi.responses import StreamingResponse, JSONResponse
+from pydantic import BaseModel, Field
 from api import API
-from tool_calling import analyze_response
+from tool_calling import analyze_response, incentive_index, database, prefetcher
+from typing import List, Optional, Union
+import intent_router
+import search_api
+import profiling
+from outbound import scheduler, Overloaded
+from company_writer import CompanyWriter
+from routing import router
+import cancellation
+import warmup
+import logs
+import logging
+import time
+import math
+import singleflight
 import json
 import asyncio
+import os
 
 ASSISTANT_SYSTEM_PROMPT = """
 Tu és um assistente virtual português chamado IA-go.
@@ -30,15 +46,97 @@ As funçoes possiveis que podes usar são:
 - get_incentive_by_title(<title>)               # Returns the 3 most probable incentives in the database given that title/name
 - get_company_by_title(<title>)                 # Returns the 3 most probable companies in the database given that title/name
 - get_companies_by_incentive(<id_incentive>)    # Returns the 5 most probable companies that benefit from that incentive
+- get_incentives_by_company(<company_name>)     # Returns the 5 incentives that best fit that company
 Só podes chamar uma função de cada vez.
 Se uma função for chamada para dar informação, dá uma resposta simples e pequena a menos que seja pedido uma descrição detalhada.
 """.strip()
 
-app = FastAPI(title="RAG API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    loop = asyncio.get_event_loop()
+    # The blocking work of the requests runs here and is mostly waiting on the LLM / embeddings / database,
+    # the default (cpu count + 4 threads) would cap the requests in flight, and the embeddings that can be batched together
+    # (a ProfilingExecutor, the jobs of a sampled request are profiled too, see profiling.py)
+    loop.set_default_executor(profiling.ProfilingExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix="request"))
+    # Keep the incentives in memory, the incentive tools stop going to the database
+    await loop.run_in_executor(None, database.enable_incentive_catalog)
+    # Company searches by query text are cached until the companies table changes
+    await loop.run_in_executor(None, database.enable_result_cache)
+    database.on_change("incentives", incentive_index.load)
+    # Companies upserted by another worker (this one's writes are dropped by the company writer right away)
+    database.on_change("companies", incentive_index.clear_company_cache)
+    # Count the searches, a new worker primes the ones asked the most (see warmup.py)
+    if warmup.RECORD:
+        recorder = warmup.QueryRecorder(database)
+        if await loop.run_in_executor(None, recorder.start):
+            database.query_recorder = recorder
+    # Connections, shared_buffers and caches warmed in the background, /health says ready when it's done
+    warmup_task = asyncio.create_task(run_warmup(loop))
+    yield
+    warmup_task.cancel()
+    if database.query_recorder is not None:
+        await loop.run_in_executor(None, database.query_recorder.stop)
+
+async def run_warmup(loop):
+    try:
+        await asyncio.wait_for(loop.run_in_executor(None, startup_warmup.run), warmup.TIMEOUT)
+    except asyncio.TimeoutError:
+        log.warning(f"⚠️ Warmup not done after {warmup.TIMEOUT}s, ready anyway")
+        startup_warmup.finish("timed_out")
+    except Exception as e:
+        log.error(f"❌ Warmup failed: {e}")
+        startup_warmup.finish("failed")
+    startup_warmup.finish()
+
+log = logs.get_logger(__name__)
+
+# Threads of the default executor (where every blocking call of the requests runs)
+EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS", 64))
+
+# How often /chat checks if the client is still there while the turn runs
+DISCONNECT_POLL_INTERVAL = 0.5
+
+app = FastAPI(title="RAG API", version="1.0.0", lifespan=lifespan)
 
 # Store conversation sessions, probably in production would use Redis (which i only used once in my life) or another db
 sessions = {}
 
+# First requests of the worker, see warmup.py (WARMUP=0 disables it)
+startup_warmup = warmup.Warmup(database, incentive_index)
+
+# POST /companies, embedded and upserted in micro-batches by one writer thread
+company_writer = CompanyWriter(database, on_written=incentive_index.forget_companies)
+
+# GET /incentives/..., /companies/search (no LLM)
+app.include_router(search_api.router)
+
+# Sampled cProfile of the requests (PROFILING=1) and the slow-query log, under /admin (only with ADMIN_TOKEN)
+if profiling.PROFILING:
+    app.add_middleware(profiling.ProfilingMiddleware)
+if profiling.ADMIN_TOKEN:
+    app.include_router(profiling.router)
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request, exc: Overloaded):
+    # The LLM/embedding provider is saturated, tell the client when to come back instead of a 500
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc), "retry_after": exc.retry_after},
+        headers={"Retry-After": str(math.ceil(exc.retry_after))}
+    )
+
+def get_session(session_id: str) -> dict:
+    """Get or create the conversation session"""
+    if session_id not in sessions:
+        api = API()
+        messages = []
+        api.add_system_prompt(ASSISTANT_SYSTEM_PROMPT, messages)
+        sessions[session_id] = {
+            "api": api,
+            "messages": messages
+        }
+    return sessions[session_id]
+
 class PromptRequest(BaseModel):
     prompt: str
     session_id: str = "default"
@@ -47,78 +145,120 @@ class ConversationResponse(BaseModel):
     response: str
     session_id: str
 
+async def run_cancellable(http_request: Request, token: cancellation.CancelToken, function, *args):
+    """Run function in the executor with the token of the request, cancelling it if the client goes away"""
+    task = asyncio.ensure_future(cancellation.run_in_executor(token, function, *args))
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+        if done:
+            return task.result()
+        if token.remaining() == 0:
+            token.cancel("deadline")
+        elif await http_request.is_disconnected():
+            token.cancel("disconnect")
+
 @app.post("/chat", response_model=ConversationResponse)
-async def chat(request: PromptRequest):
+async def chat(request: PromptRequest, http_request: Request):
     """
     Send a prompt and get a response from the RAG system
     """
+    token = cancellation.CancelToken()
+    # Every log record of this turn (here and in the executor threads) carries the session_id and a request_id
+    log_token = logs.bind(request.session_id)
+    time_start = time.perf_counter()
+    status = 200
     try:
-        # Get or create session
-        if request.session_id not in sessions:
-            api = API()
-            messages = []
-            api.add_system_prompt(ASSISTANT_SYSTEM_PROMPT, messages)
-            sessions[request.session_id] = {
-                "api": api,
-                "messages": messages
-            }
-        
-        session = sessions[request.session_id]
-        api: API = session["api"]
-        messages = session["messages"]
-        
-        # Add user prompt
-        api.add_user_prompt(request.prompt, messages)
-        
-        # Get response
-        response = api.converse(messages)
-        full_response = ""
-        
-        for part in analyze_response(response, messages, api):
-            full_response += part
-        
-        # Add assistant response to history
-        api.add_assistant_prompt(full_response, messages)
-        api.check_limit(messages, 10)
-        
+        full_response = await run_cancellable(http_request, token, chat_turn, request)
         return ConversationResponse(
             response=full_response.strip(),
             session_id=request.session_id
         )
-    
+    except Overloaded:
+        status = 503
+        raise
+    except cancellation.RequestCancelled as e:
+        # 499 = client closed the request (nobody reads it anyway)
+        status = 499 if e.reason == "disconnect" else 504
+        raise HTTPException(status_code=status, detail=str(e))
     except Exception as e:
+        status = 500
+        log.error(f"❌ Error in the chat turn: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        token.close()
+        logs.event(log, logging.INFO, "chat_turn", "Chat turn", status=status,
+                   ms=round((time.perf_counter() - time_start) * 1000, 2))
+        logs.unbind(log_token)
+
+def chat_turn(request: PromptRequest) -> str:
+    """One turn of the conversation (blocking, runs in the executor)"""
+    session = get_session(request.session_id)
+    api: API = session["api"]
+    messages = session["messages"]
+    
+    # Deterministic questions (like "Qual é o incentivo 1060") don't need the LLM
+    full_response = intent_router.try_fast_path(request.prompt, request.session_id)
+    if full_response is None:
+        # Fast 503 if the LLM queue is already too long
+        scheduler.admit(router.route("turn").provider)
+    
+    # Add user prompt
+    api.add_user_prompt(request.prompt, messages)
+    
+    if full_response is None:
+        # Get response
+        response = api.converse(messages, site="turn")
+        full_response = ""
+        
+        for part in analyze_response(response, messages, api, request.session_id):
+            full_response += part
+    
+    # Add assistant response to history
+    api.add_assistant_prompt(full_response, messages)
+    api.check_limit(messages, 10)
+    return full_response
 
 @app.post("/chat/stream")
 async def chat_stream(request: PromptRequest):
     """
     Streaming version - sends response as it's generated
     """
+    if intent_router.match_intent(request.prompt) is None:
+        # Fast 503 if the LLM queue is already too long (before the stream starts)
+        scheduler.admit(router.route("turn").provider)
+
+    token = cancellation.CancelToken()
+
     async def generate():
+        # The generator runs in the task of the response, the binding ends with it
+        logs.bind(request.session_id)
         try:
-            if request.session_id not in sessions:
-                api = API()
-                messages = []
-                api.add_system_prompt(ASSISTANT_SYSTEM_PROMPT, messages)
-                sessions[request.session_id] = {
-                    "api": api,
-                    "messages": messages
-                }
-            
-            session = sessions[request.session_id]
+            session = get_session(request.session_id)
             api: API = session["api"]
             messages = session["messages"]
             
+            # Run in executor to not block
+            fast_response = await cancellation.run_in_executor(token, intent_router.try_fast_path, request.prompt, request.session_id)
+            
             api.add_user_prompt(request.prompt, messages)
             
-            # Run in executor to not block
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(None, api.converse, messages)
+            if fast_response is not None:
+                yield f"data: {json.dumps({'text': fast_response})}\n\n"
+                yield f"data: {json.dumps({'done': True})}\n\n"
+                api.add_assistant_prompt(fast_response, messages)
+                api.check_limit(messages, 10)
+                return
+            
+            response = await cancellation.run_in_executor(token, api.converse, messages, "turn")
             
             full_response = ""
             
-            # Stream each chunk immediately
-            for part in analyze_response(response, messages, api):
+            # Stream each chunk immediately, the tool calls and LLM calls between chunks run in the executor
+            parts = analyze_response(response, messages, api, request.session_id)
+            while True:
+                part = await cancellation.run_in_executor(token, next, parts, None)
+                if part is None:
+                    break
                 full_response += part
                 
                 # Send the chunk
@@ -134,8 +274,16 @@ async def chat_stream(request: PromptRequest):
             api.add_assistant_prompt(full_response, messages)
             api.check_limit(messages, 10)
             
+        except asyncio.CancelledError:
+            # The client disconnected (StreamingResponse cancels this generator), stop the work still running for it
+            token.cancel("disconnect")
+            raise
+        except Overloaded as e:
+            yield f"data: {json.dumps({'error': str(e), 'retry_after': e.retry_after})}\n\n"
         except Exception as e:
             yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            token.close()
     
     return StreamingResponse(
         generate(), 
@@ -148,11 +296,71 @@ async def chat_stream(request: PromptRequest):
     )
 
 
+class PortfolioRequest(BaseModel):
+    company_ids: List[int]
+    top_k: int = Field(5, ge=1, le=search_api.MAX_PAGE_SIZE)
+
+@app.get("/companies/{company_id}/incentives")
+async def company_incentives(company_id: int, top_k: int = Query(5, ge=1, le=search_api.MAX_PAGE_SIZE)):
+    """
+    Incentives that best fit a company (ranked by the incentive embeddings, no LLM)
+    """
+    loop = asyncio.get_event_loop()
+    ranking = await loop.run_in_executor(None, incentive_index.rank_for_company, company_id, top_k)
+    if ranking is False:
+        raise HTTPException(status_code=503, detail="Incentive index unavailable")
+    if ranking is None:
+        raise HTTPException(status_code=404, detail="Company not found")
+    return {"company_id": company_id, "incentives": ranking}
+
+@app.post("/companies/incentives")
+async def portfolio_incentives(request: PortfolioRequest):
+    """
+    Same as /companies/{id}/incentives but for many companies at once (portfolio screen)
+    """
+    loop = asyncio.get_event_loop()
+    rankings = await loop.run_in_executor(None, incentive_index.rank_for_companies, request.company_ids, request.top_k)
+    if rankings is False:
+        raise HTTPException(status_code=503, detail="Incentive index unavailable")
+    return {"results": [{"company_id": company_id, "incentives": ranking} for company_id, ranking in rankings.items()]}
+
+class CompanyRequest(BaseModel):
+    company_name: str
+    cae_primary_label: Optional[str] = None
+    trade_description_native: Optional[str] = None
+    website: Optional[str] = None
+
+@app.post("/companies")
+async def upsert_companies(request: Union[CompanyRequest, List[CompanyRequest]], wait: float = Query(0, ge=0, le=60)):
+    """
+    Add or update (by company_name) one company or a list of them, embedded and written in the background.
+    Answers 202 with the job right away, or waits up to `wait` seconds for it (200 when it's done)
+    """
+    companies = [request] if isinstance(request, CompanyRequest) else request
+    job = company_writer.submit([company.model_dump() for company in companies])
+    if wait > 0:
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(job.future)), timeout=wait)
+        except asyncio.TimeoutError:
+            pass
+    return JSONResponse(status_code=202 if job.finished is None else 200, content=job.to_dict())
+
+@app.get("/companies/jobs/{job_id}")
+async def company_job(job_id: str):
+    """
+    Status of a POST /companies job (company_ids once it's done)
+    """
+    job = company_writer.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
 @app.delete("/session/{session_id}")
 async def clear_session(session_id: str):
     """
     Clear a conversation session
     """
+    prefetcher.clear(session_id)
     if session_id in sessions:
         del sessions[session_id]
         return {"message": f"Session {session_id} cleared"}
@@ -161,9 +369,34 @@ async def clear_session(session_id: str):
 @app.get("/health")
 async def health_check():
     """
-    Health check endpoint
+    Health check endpoint, 503 until the warmup of the worker is done (a load balancer only sends it traffic then)
     """
-    return {"status": "healthy"}
+    if not startup_warmup.ready:
+        return JSONResponse(status_code=503, content={"status": "warming", **startup_warmup.stats()}, headers={"Retry-After": "1"})
+    return {"status": "healthy", "warmup": startup_warmup.stats()}
+
+@app.get("/stats")
+async def stats():
+    """
+    How much of the traffic was answered without calling the LLM
+    """
+    return {
+        "fast_path": intent_router.stats.snapshot(),
+        "outbound": scheduler.stats(),
+        "coalescing": singleflight.stats(),
+        "prefetch": prefetcher.stats(),
+        "routing": router.stats(),
+        "cancellation": cancellation.stats.snapshot(),
+        "result_cache": database.result_cache.stats() if database.result_cache is not None else None,
+        "warmup": {
+            **startup_warmup.stats(),
+            "recorder": database.query_recorder.stats() if database.query_recorder is not None else None,
+        },
+        "company_writes": company_writer.stats(),
+        "embedding_batches": database.embedder.batcher.stats() if database.embedder.batcher is not None else None,
+        "incentive_search": incentive_index.stats(),
+        "logging": logs.stats()
+    }
 
 @app.get("/")
 async def root():
@@ -173,6 +406,17 @@ async def root():
             "POST /chat": "Send a prompt and get response",
             "POST /chat/stream": "Stream responses",
             "DELETE /session/{id}": "Clear conversation history",
-            "GET /health": "Health check"
+            "GET /health": "Health check (503 while the worker warms up)",
+            "GET /incentives/{id}": "One incentive",
+            "GET /incentives/search?q=": "Search incentives by title",
+            "GET /incentives/{id}/companies": "Companies that best fit an incentive",
+            "GET /companies/search?q=&top_k=": "Search companies",
+            "GET /companies/{id}/incentives": "Incentives that best fit a company",
+            "POST /companies/incentives": "Incentives that best fit each company of a list",
+            "POST /companies?wait=": "Add or update one company or a list of them",
+            "GET /companies/jobs/{job_id}": "Status of a POST /companies job",
+            "GET /stats": "Fast path (no LLM) statistics",
+            "GET /admin/profiles": "Sampled request profiles (PROFILING=1, needs ADMIN_TOKEN)",
+            "GET /admin/slow-queries": "Slow database queries with their plans (needs ADMIN_TOKEN)"
         }
     }
\ No newline at end of file
@@ -0,0 +1,190 @@
+"""
+Deadline and cancellation of a chat request, carried through the tool loop, the LLM calls and the database.
+
+api_server creates a CancelToken per request (REQUEST_TIMEOUT seconds, default 60) and runs the blocking work
+with run_in_executor(token, ...), which makes it the current token of that code (a ContextVar).
+When the client disconnects (or the deadline passes) the token is cancelled and:
+    - analyze_response / execute_function stop before the next tool call or LLM call
+    - the LLM calls of the request use their own http client, its sockets are shut down so the call in flight fails right away,
+      and every call has the time left until the deadline as its timeout
+    - the Postgres statement running on a pooled connection is cancelled (the same as pg_cancel_backend),
+      and statement_timeout is set to the time left until the deadline
+Calls shared by several requests (singleflight.py) run without a token, every caller only stops waiting for them.
+
+stats() counts the requests cancelled and the work that was not done because of it.
+"""
+import asyncio
+import contextvars
+import math
+import os
+import socket
+import threading
+import time
+
+import httpx
+
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", 60))
+
+current_token = contextvars.ContextVar("cancel_token", default=None)
+
+
+class RequestCancelled(Exception):
+    """The client went away or the request passed its deadline"""
+
+    def __init__(self, reason: str):
+        super().__init__(f"Request cancelled ({reason})")
+        self.reason = reason
+
+
+class CancellationStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {
+            "requests": 0,
+            "cancelled_disconnect": 0,
+            "cancelled_deadline": 0,
+            "llm_calls_skipped": 0,     # not started because the request was already cancelled
+            "llm_calls_aborted": 0,     # in flight when the request was cancelled
+            "tool_calls_skipped": 0,
+            "queries_cancelled": 0,
+        }
+
+    def add(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.counters)
+
+
+stats = CancellationStats()
+
+
+class CancelToken:
+    def __init__(self, timeout: float = REQUEST_TIMEOUT, counted: bool = True):
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.reason = None
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.client = None      # httpx.Client of the LLM calls of this request, created on the first one
+        self.counted = counted  # False for the child tokens, they are part of a request
+        self.release = None     # unregisters a child token from its parent
+        if counted:
+            stats.add("requests")
+
+    @property
+    def cancelled(self) -> bool:
+        return self.reason is not None
+
+    def cancel(self, reason: str = "disconnect"):
+        """reason is "disconnect" or "deadline"""
+        with self.lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            callbacks, self.callbacks = self.callbacks, []
+        if self.counted:
+            stats.add(f"cancelled_{reason}")
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"⚠️ Cancel callback failed: {e}")
+
+    def child(self) -> "CancelToken":
+        """
+        Token for a part of the request that can also be cancelled on its own (one request of a hedged LLM call):
+        same deadline, cancelled with the request, with its own http client
+        """
+        child = CancelToken(timeout=None, counted=False)
+        child.deadline = self.deadline
+        child.release = self.on_cancel(lambda: child.cancel(self.reason))
+        return child
+
+    def remaining(self):
+        """Seconds until the deadline, None if there is no deadline"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check(self):
+        """Raises RequestCancelled if the request was cancelled or is past its deadline"""
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("deadline")
+        if self.reason is not None:
+            raise RequestCancelled(self.reason)
+
+    def on_cancel(self, callback):
+        """Run callback() when the request is cancelled (right away if it already was), returns the function to unregister it"""
+        with self.lock:
+            if self.reason is None:
+                self.callbacks.append(callback)
+                return lambda: self.remove(callback)
+        callback()
+        return lambda: None
+
+    def remove(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def http_client(self) -> httpx.Client:
+        with self.lock:
+            if self.client is None:
+                self.client = httpx.Client(timeout=httpx.Timeout(600.0, connect=5.0))
+                self.callbacks.append(self.abort_http)
+            return self.client
+
+    def abort_http(self):
+        """Shut down the sockets of the requests in flight (closing the client alone doesn't wake up a blocked read)"""
+        pool = getattr(getattr(self.client, "_transport", None), "_pool", None)
+        for connection in getattr(pool, "connections", []):
+            stream = getattr(getattr(connection, "_connection", None), "_network_stream", None)
+            sock = stream.get_extra_info("socket") if stream is not None else None
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def close(self):
+        """End of the request"""
+        if self.release is not None:
+            self.release()
+        with self.lock:
+            self.callbacks = []
+            client, self.client = self.client, None
+        if client is not None:
+            client.close()
+
+
+def current() -> CancelToken:
+    return current_token.get()
+
+
+def check():
+    token = current_token.get()
+    if token is not None:
+        token.check()
+
+
+def statement_timeout_ms():
+    """statement_timeout for the current request (whole seconds so a pooled connection can keep it), None = no limit"""
+    token = current_token.get()
+    remaining = token.remaining() if token is not None else None
+    if remaining is None:
+        return None
+    return max(1, math.ceil(remaining)) * 1000
+
+
+def run_with_token(token: CancelToken, function, *args):
+    current_token.set(token)
+    return function(*args)
+
+
+async def run_in_executor(token: CancelToken, function, *args):
+    """loop.run_in_executor with token as the current token of function"""
+    loop = asyncio.get_event_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, context.run, run_with_token, token, function, *args)
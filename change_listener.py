@@ -0,0 +1,87 @@
+"""
+Listens for data changes in Postgres so in-process caches know when to refresh.
+
+The triggers installed by PostgreSQLManager.install_change_notifications bump a version counter
+in the data_versions table and send a NOTIFY on the "data_changed" channel (payload = table name).
+The NOTIFY makes the refresh immediate, the version counter is polled every few seconds as a fallback
+(for example if the listening connection dropped and a notification was lost).
+"""
+import select
+import threading
+import time
+from collections import defaultdict
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+CHANNEL = "data_changed"
+
+
+class ChangeListener:
+    def __init__(self, connection_params: dict, database: str, poll_interval: float = 10.0):
+        self.connection_params = dict(connection_params, database=database)
+        self.poll_interval = poll_interval
+        self.callbacks = defaultdict(list)     # table name -> callbacks
+        self.versions = {}                      # table name -> last version seen
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def subscribe(self, table: str, callback):
+        """callback() is called (from the listener thread) every time the table changes"""
+        self.callbacks[table].append(callback)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name="change-listener", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def notify(self, table: str):
+        for callback in self.callbacks.get(table, []):
+            try:
+                callback()
+            except Exception as e:
+                print(f"⚠️ Error refreshing after a change in '{table}': {e}")
+
+    def check_versions(self, cursor):
+        """Fallback for lost notifications, returns the tables whose version changed"""
+        cursor.execute("SELECT table_name, version FROM data_versions")
+        changed = []
+        for table, version in cursor.fetchall():
+            if table in self.versions and self.versions[table] != version:
+                changed.append(table)
+            self.versions[table] = version
+        return changed
+
+    def run(self):
+        while not self.stopped.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.connection_params)
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                cursor = conn.cursor()
+                cursor.execute(f"LISTEN {CHANNEL}")
+                # Anything that changed while we were not listening
+                for table in self.check_versions(cursor):
+                    self.notify(table)
+                while not self.stopped.is_set():
+                    if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                        for table in self.check_versions(cursor):
+                            self.notify(table)
+                        continue
+                    conn.poll()
+                    tables = set()
+                    while conn.notifies:
+                        tables.add(conn.notifies.pop(0).payload)
+                    self.check_versions(cursor)
+                    for table in tables:
+                        self.notify(table)
+            except psycopg2.Error as e:
+                print(f"⚠️ Change listener lost the connection ({e}), reconnecting...")
+                time.sleep(self.poll_interval)
+            finally:
+                if conn is not None:
+                    conn.close()
@@ -0,0 +1,239 @@
+"""
+Online company upserts (POST /companies), micro-batched.
+
+Every company sent to the API goes into one queue. A single writer thread takes whatever is pending,
+up to COMPANY_WRITE_BATCH rows or what arrived in COMPANY_WRITE_WAIT_MS after the first one, and for that batch:
+    - one embeddings request for every row (instead of one per company)
+    - one multi-row upsert by company_name (PostgreSQLManager.upsert_company_rows)
+so a burst of single-company POSTs costs the same as one bulk POST.
+
+Reads come first:
+    - the writer has its own connection, it never takes a slot of the pool of the searches
+    - one batch at a time, so writes never have more than one embeddings request in flight
+    - while the embeddings provider has a queue (searches waiting) the next batch waits, up to COMPANY_WRITE_MAX_DEFER_MS
+    - the writer is busy at most COMPANY_WRITE_DUTY of the time (formatting the vectors and the upsert take CPU too),
+      after a batch that took t seconds it rests t * (1 - duty) / duty
+    - the queue holds at most COMPANY_WRITE_QUEUE rows, past that POST /companies answers 503 (Overloaded)
+
+Every POST is a job: the caller gets its job_id right away and polls GET /companies/jobs/{job_id}
+or waits for it (?wait=seconds). Finished jobs are kept COMPANY_JOB_TTL seconds.
+on_written(company_ids) runs after every batch written, before its jobs are done (the API drops the cached
+incentive rankings of those companies, their embeddings changed).
+"""
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from queue import Empty, Queue
+
+import psycopg2
+
+import logs
+from outbound import scheduler, Overloaded
+
+BATCH_SIZE = int(os.getenv("COMPANY_WRITE_BATCH", 256))
+WAIT_MS = float(os.getenv("COMPANY_WRITE_WAIT_MS", 20))
+MAX_DEFER_MS = float(os.getenv("COMPANY_WRITE_MAX_DEFER_MS", 1000))
+DUTY = float(os.getenv("COMPANY_WRITE_DUTY", 0.5))
+MAX_QUEUE = int(os.getenv("COMPANY_WRITE_QUEUE", 20000))
+JOB_TTL = float(os.getenv("COMPANY_JOB_TTL", 3600))
+
+# The provider the searches embed their queries with (see OpenAIEmbeder)
+READ_PROVIDER = "openai-embeddings"
+
+log = logs.get_logger(__name__)
+
+
+class Job:
+    def __init__(self, companies: list):
+        self.job_id = uuid.uuid4().hex
+        self.companies = companies
+        self.company_ids = [None] * len(companies)
+        self.pending = len(companies)
+        self.errors = []
+        self.created = time.time()
+        self.finished = None
+        self.future = Future()      # done (with the job) when every row was written or failed
+
+    @property
+    def status(self) -> str:
+        if self.finished is None:
+            return "pending"
+        return "failed" if self.errors else "done"
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "count": len(self.companies),
+            "pending": self.pending,
+            "company_ids": self.company_ids,
+            "errors": self.errors,
+            "seconds": round(self.finished - self.created, 3) if self.finished else None,
+        }
+
+
+class CompanyWriter:
+    def __init__(self, database, batch_size: int = BATCH_SIZE, wait_ms: float = WAIT_MS,
+                 max_defer_ms: float = MAX_DEFER_MS, max_queue: int = MAX_QUEUE, duty: float = DUTY, on_written=None):
+        self.database = database
+        self.on_written = on_written
+        self.batch_size = batch_size
+        self.wait = wait_ms / 1000
+        self.max_defer = max_defer_ms / 1000
+        self.max_queue = max_queue
+        self.duty = duty
+        self.queue = Queue()        # (job, index of the row in the job)
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()   # job_id -> Job, oldest first
+        self.thread = None
+        self.conn = None
+        self.batch_sizes = deque(maxlen=1000)
+        self.counters = {"jobs": 0, "rows": 0, "written": 0, "failed": 0, "batches": 0, "deferred": 0, "rejected": 0}
+        self.busy_seconds = 0.0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="company-writer", daemon=True)
+                self.thread.start()
+
+    def submit(self, companies: list) -> Job:
+        """Queue the companies (dicts with company_name, cae_primary_label...), returns their job"""
+        if self.queue.qsize() + len(companies) > self.max_queue:
+            with self.lock:
+                self.counters["rejected"] += 1
+            # Rough time to drain the queue at the current batch rate
+            raise Overloaded("Too many companies waiting to be written, try again later",
+                             retry_after=max(1.0, self.queue.qsize() / self.batch_size * self.wait * 10))
+        self.start()
+        job = Job(companies)
+        with self.lock:
+            self.sweep()
+            self.jobs[job.job_id] = job
+            self.counters["jobs"] += 1
+            self.counters["rows"] += len(companies)
+        if not companies:
+            self.finish(job)
+        for index in range(len(companies)):
+            self.queue.put((job, index))
+        return job
+
+    def get(self, job_id: str):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def sweep(self):
+        """Forget the jobs finished more than JOB_TTL ago (call with the lock)"""
+        now = time.time()
+        while self.jobs:
+            job = next(iter(self.jobs.values()))
+            if job.finished is None or now - job.finished < JOB_TTL:
+                break
+            self.jobs.popitem(last=False)
+
+    def next_batch(self) -> list:
+        """Block until there is something to write, then take what arrives in the batch window"""
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def yield_to_reads(self):
+        """Wait while the searches are queueing for the embeddings provider (bounded, writes must progress)"""
+        deadline = time.monotonic() + self.max_defer
+        deferred = False
+        while scheduler.provider(READ_PROVIDER).estimated_wait() > 0 and time.monotonic() < deadline:
+            deferred = True
+            time.sleep(0.01)
+        if deferred:
+            with self.lock:
+                self.counters["deferred"] += 1
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            self.yield_to_reads()
+            time_start = time.monotonic()
+            try:
+                company_ids = self.write([job.companies[index] for job, index in batch])
+                error = None if company_ids is not False else "Error writing companies"
+            except Exception as e:
+                company_ids, error = False, str(e)
+            if error is None and self.on_written is not None:
+                try:
+                    self.on_written(company_ids)
+                except Exception as e:
+                    log.warning(f"⚠️ Error after writing {len(company_ids)} companies: {e}")
+            busy = time.monotonic() - time_start
+            self.busy_seconds += busy
+            with self.lock:
+                self.counters["batches"] += 1
+                self.counters["written" if error is None else "failed"] += len(batch)
+                self.batch_sizes.append(len(batch))
+            for position, (job, index) in enumerate(batch):
+                if error is None:
+                    job.company_ids[index] = company_ids[position]
+                else:
+                    job.errors.append({"index": index, "error": error})
+                with self.lock:
+                    job.pending -= 1
+                    done = job.pending == 0
+                if done:
+                    self.finish(job)
+            if 0 < self.duty < 1:
+                time.sleep(busy * (1 - self.duty) / self.duty)
+
+    def finish(self, job: Job):
+        job.finished = time.time()
+        job.future.set_result(job)
+
+    def write(self, companies: list):
+        """Embed and upsert one batch, the company_id of each row (same order) or False"""
+        rows = [dict(company) for company in companies]
+        self.database.add_embeddings_companies(rows)
+        if self.database.company_shards is not None:
+            return self.database.company_shards.upsert(rows)
+        conn = self.connection()
+        if conn is None:
+            return False
+        try:
+            cursor = conn.cursor()
+            company_ids = self.database.upsert_company_rows(rows, cursor)
+            conn.commit()
+            cursor.close()
+            return company_ids
+        except psycopg2.Error as e:
+            log.error(f"❌ Error upserting {len(rows)} companies: {e}")
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+            if conn.closed:
+                self.conn = None
+            return False
+
+    def connection(self):
+        """The writer's own connection (not one of the pool of the searches), reopened if it dropped"""
+        if self.conn is None or self.conn.closed:
+            self.conn = self.database.get_connection(database=self.database.database_name)
+        return self.conn
+
+    def stats(self) -> dict:
+        with self.lock:
+            sizes = list(self.batch_sizes)
+            return {
+                **self.counters,
+                "duty": self.duty,
+                "queued": self.queue.qsize(),
+                "jobs_kept": len(self.jobs),
+                "avg_batch_size": round(sum(sizes) / len(sizes), 1) if sizes else None,
+                "busy_seconds": round(self.busy_seconds, 3),
+            }
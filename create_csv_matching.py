@@ -1,40 +1,293 @@
-from tool_calling import get_companies_by_incentive
-from sql import PostgreSQLManager, DB_CONFIG
+"""
+Batch job que gera o incentivos_com_empresas.csv (incentivo -> 5 empresas que mais beneficiam).
+
+- Os incentivos são divididos em shards, um por processo, e cada processo usa várias threads
+- A concorrência contra o LLM e contra a API de embeddings é limitada por semáforos partilhados entre processos
+- Cada linha é escrita no output assim que fica pronta, e o ID do incentivo vai para o checkpoint,
+  se o job crashar basta correr outra vez que continua onde parou
+
+Exemplos:
+    python create_csv_matching.py
+    python create_csv_matching.py --processes 8 --threads 4 --llm-concurrency 16 --embed-concurrency 16
+    python create_csv_matching.py --only 1060,3406              # refaz só estes incentivos
+    python create_csv_matching.py --format parquet              # pasta incentivos_com_empresas_parquet
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty
+
 import pandas as pd
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from sql import PostgreSQLManager, DB_CONFIG
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+DEFAULT_OUTPUT = {"csv": "incentivos_com_empresas.csv", "parquet": "incentivos_com_empresas_parquet"}
+COLUMNS = ['incentive_id', 'title', 'company_1', 'company_2', 'company_3', 'company_4', 'company_5']
+
+# Estado de cada processo worker (definido no init_worker)
+worker_state = {}
+
+
+def init_worker(results_queue, llm_semaphore, embed_semaphore, threads):
+    worker_state["queue"] = results_queue
+    worker_state["llm_semaphore"] = llm_semaphore
+    worker_state["embed_semaphore"] = embed_semaphore
+    worker_state["threads"] = threads
+
 
 def process_incentive(incentive):
     """Processa um único incentivo, obtendo empresas e retornando dados formatados."""
+    # Import aqui para cada processo criar as suas próprias ligações (DB, OpenAI)
+    from tool_calling import create_incentive_query, database
+
     incentive_id, title = incentive
-    companies = get_companies_by_incentive(incentive_id, on_string=False)
+    with worker_state["llm_semaphore"]:
+        query = create_incentive_query(incentive_id)
+    with worker_state["embed_semaphore"]:
+        embedding = database.embedder.get_embedding(query, model="text-embedding-3-small")['embedding'][0].embedding
+    companies = database.query_companies_by_vector(embedding, 5)
+    if companies is False:
+        raise RuntimeError("Error querying database")
     company_names = [c['company_name'] for c in companies[:5]]  # Limita a 5 empresas
     company_names.extend([''] * (5 - len(company_names)))  # Preenche com vazios, se necessário
     return [incentive_id, title] + company_names
 
-if __name__ == "__main__":
+
+def process_and_report(incentive):
+    try:
+        worker_state["queue"].put(("row", incentive[0], process_incentive(incentive)))
+    except Exception as e:
+        worker_state["queue"].put(("error", incentive[0], str(e)))
+
+
+def process_shard(shard):
+    """Corre num processo worker, processa o shard com várias threads"""
+    with ThreadPoolExecutor(max_workers=worker_state["threads"]) as executor:
+        list(executor.map(process_and_report, shard))
+    return len(shard)
+
+
+class Checkpoint:
+    """
+    Ficheiro com um ID de incentivo por linha, dos incentivos que já estão no output.
+    A linha vai para o disco antes do ID, se o job crashar entre os dois o incentivo é refeito
+    e fica com duas linhas no output (o compact() do writer tira a repetida)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done = set()
+        # Já existia, este run continua um anterior (que pode ter deixado linhas repetidas)
+        self.resumed = os.path.exists(path)
+        if self.resumed:
+            with open(path) as f:
+                self.done = {int(line) for line in f if line.strip()}
+        self.file = open(path, "a")
+
+    def mark(self, incentive_ids: list):
+        for incentive_id in incentive_ids:
+            self.file.write(f"{incentive_id}\n")
+            self.done.add(int(incentive_id))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class CsvRowWriter:
+    """Escreve cada linha no CSV assim que chega"""
+
+    def __init__(self, path: str, fresh: bool = False):
+        """fresh: começa o output do zero (sem checkpoint as linhas que lá estão são de um run antigo)"""
+        new_file = fresh or not os.path.exists(path) or os.path.getsize(path) == 0
+        self.path = path
+        self.file = open(path, "w" if fresh else "a", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        if new_file:
+            self.writer.writerow(COLUMNS)
+
+    def write(self, row: list) -> list:
+        """Returns the incentive ids that are now safely on disk"""
+        self.writer.writerow(row)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return [row[0]]
+
+    def close(self) -> list:
+        self.file.close()
+        return []
+
+    def compact(self):
+        """Quando um incentivo é refeito fica a linha mais recente"""
+        df = pd.read_csv(self.path)
+        df.drop_duplicates(subset="incentive_id", keep="last").to_csv(self.path, index=False)
+
+
+class ParquetRowWriter:
+    """
+    Parquet não dá para fazer append, por isso o output é uma pasta com vários ficheiros
+    (um por cada flush), que se lê com pd.read_parquet(pasta)
+    """
+
+    def __init__(self, path: str, flush_every: int = 50, fresh: bool = False):
+        if pyarrow is None:
+            raise RuntimeError("pyarrow is required for --format parquet (pip install pyarrow)")
+        os.makedirs(path, exist_ok=True)
+        if fresh:
+            for f in os.listdir(path):
+                if f.endswith(".parquet"):
+                    os.remove(os.path.join(path, f))
+        self.path = path
+        self.flush_every = flush_every
+        self.run_id = time.strftime("%Y%m%d%H%M%S")
+        self.part = 0
+        self.rows = []
+
+    def write(self, row: list) -> list:
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_every:
+            return self.flush()
+        return []
+
+    def flush(self) -> list:
+        if not self.rows:
+            return []
+        df = pd.DataFrame(self.rows, columns=COLUMNS)
+        df = df.astype({c: str for c in COLUMNS[1:]})
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        part_path = os.path.join(self.path, f"part-{self.run_id}-{self.part:05d}.parquet")
+        pyarrow.parquet.write_table(table, part_path + ".tmp")
+        os.replace(part_path + ".tmp", part_path)  # ficheiro só aparece quando está completo
+        self.part += 1
+        flushed = [row[0] for row in self.rows]
+        self.rows = []
+        return flushed
+
+    def close(self) -> list:
+        return self.flush()
+
+    def compact(self):
+        parts = [os.path.join(self.path, f) for f in sorted(os.listdir(self.path)) if f.endswith(".parquet")]
+        if not parts:
+            return
+        df = pd.concat([pd.read_parquet(p) for p in parts], ignore_index=True)
+        df = df.drop_duplicates(subset="incentive_id", keep="last")
+        compacted = os.path.join(self.path, f"part-{self.run_id}-compacted.parquet.tmp")
+        df.to_parquet(compacted, index=False)
+        for p in parts:
+            os.remove(p)
+        os.replace(compacted, compacted[:-len(".tmp")])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Gera o CSV incentivo -> empresas")
+    parser.add_argument("--output", default=None, help="default: incentivos_com_empresas.csv (csv) / incentivos_com_empresas_parquet (parquet)")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--checkpoint", default=None, help="default: <output>.checkpoint")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4, help="threads por processo")
+    parser.add_argument("--llm-concurrency", type=int, default=8, help="máximo de chamadas ao LLM em simultâneo")
+    parser.add_argument("--embed-concurrency", type=int, default=8, help="máximo de chamadas de embeddings em simultâneo")
+    parser.add_argument("--flush-every", type=int, default=50, help="linhas por ficheiro (só parquet)")
+    parser.add_argument("--only", default=None, help="IDs separados por vírgula, refaz só estes incentivos")
+    args = parser.parse_args()
+    args.output = args.output or DEFAULT_OUTPUT[args.format]
+    return args
+
+
+def main():
+    args = parse_args()
+    checkpoint = Checkpoint(args.checkpoint or args.output.rstrip("/") + ".checkpoint")
+
     db = PostgreSQLManager(**DB_CONFIG)
-    
     # Obter todos os incentivos
-    results = db.general_query("SELECT incentive_id, title FROM incentives")
-    print(len(results))
-    exit()
-    # Inicializar uma lista de dados a serem processados
+    results = db.general_query("SELECT incentive_id, title FROM incentives ORDER BY incentive_id")
+    if results is False:
+        print("❌ Could not read the incentives")
+        return
     incentives = [(result[0], result[1]) for result in results]
-    
-    # Criar uma lista para armazenar os resultados
-    data = []
-    
-    # Usar ThreadPoolExecutor para paralelizar o processo
-    with ThreadPoolExecutor(max_workers=5) as executor:  # Ajuste o número de workers conforme necessário
-        futures = {executor.submit(process_incentive, incentive): incentive for incentive in incentives}
-        
-        # Barra de progresso com tqdm
-        for future in tqdm(as_completed(futures), total=len(futures), desc="Processando incentivos"):
-            data.append(future.result())
-    
-    # Criar o DataFrame e salvar como CSV
-    df = pd.DataFrame(data, columns=['incentive_id', 'title', 'company_1', 'company_2', 'company_3', 'company_4', 'company_5'])
-    df.to_csv('incentivos_com_empresas.csv', index=False)
-
-    print("CSV gerado com sucesso!")
+
+    if args.only:
+        only = {int(i) for i in args.only.split(",") if i.strip()}
+        pending = [incentive for incentive in incentives if incentive[0] in only]
+    else:
+        pending = [incentive for incentive in incentives if incentive[0] not in checkpoint.done]
+    print(f"📦 {len(incentives)} incentives, {len(checkpoint.done)} already done, {len(pending)} to process")
+
+    # Sem checkpoint as linhas que já estão no output são de um run antigo (e não estão no checkpoint), começa do zero
+    fresh = not checkpoint.resumed and not args.only
+    if args.format == "parquet":
+        writer = ParquetRowWriter(args.output, args.flush_every, fresh)
+    else:
+        writer = CsvRowWriter(args.output, fresh)
+    # Refeitos com --only, ou repetidos por um crash de um run anterior: fica a linha mais recente
+    compact = args.only or checkpoint.resumed
+    if not pending:
+        checkpoint.close()
+        writer.close()
+        if compact:
+            writer.compact()
+        return
+
+    # Um shard por processo
+    processes = max(1, min(args.processes, len(pending)))
+    shards = [pending[i::processes] for i in range(processes)]
+
+    results_queue = multiprocessing.Queue()
+    llm_semaphore = multiprocessing.BoundedSemaphore(args.llm_concurrency)
+    embed_semaphore = multiprocessing.BoundedSemaphore(args.embed_concurrency)
+
+    time_start = time.time()
+    done, errors = 0, []
+    with multiprocessing.Pool(
+        processes,
+        initializer=init_worker,
+        initargs=(results_queue, llm_semaphore, embed_semaphore, args.threads)
+    ) as pool:
+        shards_result = pool.map_async(process_shard, shards)
+        with tqdm(total=len(pending), desc="Processando incentivos") as progress:
+            while done + len(errors) < len(pending):
+                try:
+                    kind, incentive_id, payload = results_queue.get(timeout=1)
+                except Empty:
+                    if shards_result.ready():
+                        shards_result.get()  # levanta a exceção se um worker morreu
+                        break
+                    continue
+                if kind == "row":
+                    checkpoint.mark(writer.write(payload))
+                    done += 1
+                else:
+                    errors.append((incentive_id, payload))
+                progress.update(1)
+                progress.set_postfix(
+                    rate=f"{(done + len(errors)) / (time.time() - time_start):.2f}/s",
+                    errors=len(errors)
+                )
+    checkpoint.mark(writer.close())
+    checkpoint.close()
+
+    if compact:
+        writer.compact()
+
+    elapsed = time.time() - time_start
+    print(f"\n🎉 Processed {done} incentives in {elapsed:.1f} seconds ({done / elapsed:.2f} incentives/s)")
+    if errors:
+        print(f"⚠️ {len(errors)} incentives failed (run again to retry them):")
+        for incentive_id, error in errors[:20]:
+            print(f"  - {incentive_id}: {error}")
+
+
+if __name__ == "__main__":
+    main()
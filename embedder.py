@@ -1,16 +1,28 @@
 from openai import OpenAI
+from openai.types import Embedding
 from typing import List, Union
 from datetime import datetime
 import os
 import json
+import base64
+import numpy as np
 from dotenv import load_dotenv
+from outbound import scheduler, estimate_tokens
+from singleflight import SingleFlight
+from embedding_batcher import EmbeddingBatcher
+import embedding_batcher
+
+# Identical embeddings requested at the same time are only computed once
+embedding_flight = SingleFlight("embeddings")
 # Load environment variables from .env file
 load_dotenv()
 
 class OpenAIEmbeder:
     def __init__(self):
-        self.client = OpenAI(api_key=os.getenv('THEIR_GPT_API_KEY'))
+        self.client = OpenAI(api_key=os.getenv('THEIR_GPT_API_KEY'), max_retries=0)  # retries are done by the outbound scheduler
         self.history_file = "embedding_history.json"
+        # Single-text embeddings of concurrent requests are sent together (see embedding_batcher.py)
+        self.batcher = EmbeddingBatcher(self.get_embedding_matrix) if embedding_batcher.ENABLED else None
         spent = self.get_total_spent()
         print(f"Total spent on embeddings so far: ${spent:.6f}")
 
@@ -32,10 +44,33 @@ class OpenAIEmbeder:
             print(f"Error saving embedding to history: {e}")
 
     def get_embedding(self, text: Union[str, List[str]], model: str = "text-embedding-3-small") -> dict:
-        response = self.client.embeddings.create(
+        if isinstance(text, str):
+            create = self.create_batched_embedding if self.batcher is not None else self.create_embedding
+            return embedding_flight.do((model, text), create, text, model)
+        return self.create_embedding(text, model)
+
+    def create_batched_embedding(self, text: str, model: str = "text-embedding-3-small") -> dict:
+        """Same result as create_embedding for one text, but the request is shared with the other queued texts"""
+        vector = self.batcher.embed(text, model)
+        tokens = estimate_tokens(text)
+        return {
+            "embedding_model": model,
+            "embedding_size": len(vector),
+            "created_at": str(datetime.now()),
+            "token_count": tokens,
+            "money_cost": tokens * self.get_cost_per_model(model) / 1_000_000,
+            "embedding": [Embedding(embedding=vector.tolist(), index=0, object="embedding")]
+        }
+
+    def create_embedding(self, text: Union[str, List[str]], model: str = "text-embedding-3-small") -> dict:
+        response = scheduler.call(
+            "openai-embeddings",
+            self.client.embeddings.create,
             model=model,
             input=text,
-            encoding_format="float"
+            encoding_format="float",
+            estimated_tokens=estimate_tokens(text),
+            usage_tokens=lambda response: response.usage.total_tokens
         )
 
         result = {
@@ -51,6 +86,30 @@ class OpenAIEmbeder:
 
         return result
     
+    def get_embedding_matrix(self, texts: List[str], model: str = "text-embedding-3-small") -> np.ndarray:
+        """
+        Embeddings of many texts as a (len(texts), dim) float32 matrix.
+        Asked as base64 (raw float32 bytes): ~4x smaller response than the float lists and decoded by numpy,
+        instead of parsing len(texts) * dim JSON floats while holding the GIL
+        """
+        response = scheduler.call(
+            "openai-embeddings",
+            self.client.embeddings.create,
+            model=model,
+            input=texts,
+            encoding_format="base64",
+            estimated_tokens=estimate_tokens(texts),
+            usage_tokens=lambda response: response.usage.total_tokens
+        )
+        self.save_embedding_to_history({
+            "embedding_model": model,
+            "created_at": str(datetime.now()),
+            "token_count": response.usage.total_tokens,
+            "money_cost": response.usage.total_tokens * self.get_cost_per_model(model) / 1_000_000
+        })
+        data = sorted(response.data, key=lambda item: item.index)
+        return np.stack([np.frombuffer(base64.b64decode(item.embedding), dtype="<f4") for item in data])
+
     def get_cost_per_model(self, model: str = "text-embedding-3-small") -> float:
         model_costs = {
             "text-embedding-3-small": 0.02,  # cost per 1M tokens
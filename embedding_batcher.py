@@ -0,0 +1,115 @@
+"""
+Cross-request micro-batching of the query embeddings.
+
+Every company search embeds its query with its own single-text request, although the embeddings endpoint
+takes a list. OpenAIEmbeder.get_embedding(str) puts the text into this batcher instead: a dispatcher thread
+takes what arrives within EMBEDDING_BATCH_WINDOW_MS of the first text (or EMBEDDING_BATCH_MAX texts), sends one
+request for all of them and hands each caller its own vector. Batches run in parallel, the window only delays
+the start of a request, never waits for the previous one.
+
+    EMBEDDING_BATCH=0               disables it (one request per text, like before)
+    EMBEDDING_BATCH_WINDOW_MS=5
+    EMBEDDING_BATCH_MAX=64
+
+Identical texts asked at the same time are already collapsed before getting here (embedding_flight).
+stats() has the requests saved and how long the texts waited for their batch.
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Empty, Queue
+
+import numpy as np
+
+import cancellation
+
+ENABLED = os.getenv("EMBEDDING_BATCH", "1") == "1"
+WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", 5))
+MAX_BATCH = int(os.getenv("EMBEDDING_BATCH_MAX", 64))
+
+
+class EmbeddingBatcher:
+    def __init__(self, embed_many, window_ms: float = WINDOW_MS, max_batch: int = MAX_BATCH, max_workers: int = 16):
+        self.embed_many = embed_many        # embed_many(texts, model) -> (len(texts), dim) matrix
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.queue = Queue()                # (model, text, future, time queued)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="embedding-batch")
+        self.thread = None
+        self.lock = threading.Lock()
+        self.waits = deque(maxlen=2000)     # seconds between queued and sent
+        self.counters = {"texts": 0, "requests": 0, "errors": 0, "max_batch_size": 0}
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="embedding-batcher", daemon=True)
+                self.thread.start()
+
+    def embed(self, text: str, model: str) -> np.ndarray:
+        """Vector of one text, sent together with the other texts queued at the same time"""
+        cancellation.check()
+        self.start()
+        future = Future()
+        self.queue.put((model, text, future, time.monotonic()))
+        token = cancellation.current()
+        try:
+            return future.result(timeout=token.remaining() if token is not None else None)
+        except TimeoutError:
+            # The batch goes on for the other callers, only this request gives up
+            token.cancel("deadline")
+            raise cancellation.RequestCancelled(token.reason)
+
+    def next_batch(self) -> list:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            by_model = {}
+            for item in batch:
+                by_model.setdefault(item[0], []).append(item)
+            for model, items in by_model.items():
+                self.executor.submit(self.send, model, items)
+
+    def send(self, model: str, items: list):
+        now = time.monotonic()
+        with self.lock:
+            self.counters["texts"] += len(items)
+            self.counters["requests"] += 1
+            self.counters["max_batch_size"] = max(self.counters["max_batch_size"], len(items))
+            self.waits.extend(now - queued for _, _, _, queued in items)
+        try:
+            matrix = self.embed_many([text for _, text, _, _ in items], model)
+        except Exception as e:
+            with self.lock:
+                self.counters["errors"] += 1
+            for _, _, future, _ in items:
+                future.set_exception(e)
+            return
+        for (_, _, future, _), vector in zip(items, matrix):
+            future.set_result(vector)
+
+    def stats(self) -> dict:
+        with self.lock:
+            waits = list(self.waits)
+            texts, requests = self.counters["texts"], self.counters["requests"]
+            return {
+                "window_ms": self.window * 1000,
+                "max_batch": self.max_batch,
+                **self.counters,
+                "requests_saved": texts - requests,
+                "avg_batch_size": round(texts / requests, 2) if requests else None,
+                "wait_ms_p50": round(float(np.percentile(waits, 50)) * 1000, 2) if waits else None,
+                "wait_ms_p99": round(float(np.percentile(waits, 99)) * 1000, 2) if waits else None,
+            }
@@ -0,0 +1,108 @@
+"""
+In-process catalog of the incentives.
+
+There are only ~538 incentives, so instead of opening a connection and running similarity() on every row
+for each tool call, PostgreSQLManager keeps all of them in memory:
+    - a dict id -> incentive for the lookups by ID
+    - an inverted trigram index (same trigrams as pg_trgm) for the fuzzy search by title
+    - the compact cards of every incentive, the text the tools give to the LLM (see rendering.py)
+The catalog is reloaded when the incentives table changes (see change_listener.py).
+"""
+import re
+import time
+from collections import Counter, defaultdict
+from threading import Lock
+
+import rendering
+
+WORD_PATTERN = re.compile(r"[^\W_]+")
+
+
+def trigrams(text: str) -> set:
+    """Same trigrams as pg_trgm: lowercase words, padded with two spaces before and one after"""
+    result = set()
+    for word in WORD_PATTERN.findall(text.lower()):
+        padded = f"  {word} "
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+class IncentiveCatalog:
+    def __init__(self, database):
+        self.database = database
+        # (id -> incentive, trigram -> ids, id -> number of trigrams of the title, version, id -> cards)
+        # swapped as a whole on reload so readers never see half of an update
+        self.data = None
+        self.lock = Lock()
+
+    def load(self) -> bool:
+        """Load (or reload) every incentive from the database"""
+        time_start = time.time()
+        incentives = self.database.load_incentives()
+        if incentives is False:
+            return False
+        by_id = {}
+        trigram_index = defaultdict(list)
+        trigram_counts = {}
+        for incentive in incentives:
+            by_id[incentive["incentive_id"]] = incentive
+            title_trigrams = trigrams(incentive["title"] or "")
+            trigram_counts[incentive["incentive_id"]] = len(title_trigrams)
+            for trigram in title_trigrams:
+                trigram_index[trigram].append(incentive["incentive_id"])
+        cards = rendering.build_cards(incentives)
+        with self.lock:
+            version = self.data[3] + 1 if self.data else 1
+            self.data = (by_id, dict(trigram_index), trigram_counts, version, cards)
+        print(f"✅ Loaded {len(by_id)} incentives into the catalog in {time.time() - time_start:.2f} seconds")
+        return True
+
+    def is_loaded(self) -> bool:
+        return self.data is not None
+
+    def version(self) -> int:
+        return self.data[3] if self.data else 0
+
+    def cards(self) -> dict:
+        """incentive_id -> (full card, short card, one line), see rendering.build_cards"""
+        return self.data[4] if self.data else {}
+
+    def get(self, incentive_id: int):
+        """Incentive by ID, None if it doesn't exist"""
+        incentive = self.data[0].get(incentive_id)
+        return dict(incentive) if incentive else None
+
+    def trigram_scores(self, title: str) -> dict:
+        """incentive_id -> similarity(title, %s) of pg_trgm, only the incentives with a score > 0"""
+        _, trigram_index, trigram_counts, _, _ = self.data
+        query_trigrams = trigrams(title)
+        # Only titles that share at least one trigram can have a similarity > 0
+        shared = Counter()
+        for trigram in query_trigrams:
+            shared.update(trigram_index.get(trigram, ()))
+        return {
+            incentive_id: count / (len(query_trigrams) + trigram_counts[incentive_id] - count)
+            for incentive_id, count in shared.items()
+        }
+
+    def search(self, title: str, threshold: float = 0.0, limit: int = 10, after: tuple = None) -> list:
+        """
+        Incentives with the most similar title, same scores as similarity(title, %s) of pg_trgm.
+        after: (similarity_score, incentive_id) of the last incentive of the previous page
+        """
+        by_id = self.data[0]
+        scored = []
+        for incentive_id, score in self.trigram_scores(title).items():
+            if score <= threshold:
+                continue
+            if after is not None and (score > after[0] or (score == after[0] and incentive_id <= after[1])):
+                continue
+            scored.append((-score, incentive_id))
+        scored.sort()
+
+        results = []
+        for negative_score, incentive_id in scored[:limit]:
+            incentive = dict(by_id[incentive_id])
+            incentive["similarity_score"] = -negative_score
+            results.append(incentive)
+        return results
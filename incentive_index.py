@@ -0,0 +1,284 @@
+"""
+In-memory index of the incentive embeddings, used to match companies -> incentives.
+
+There are only ~538 incentives, so all the embeddings fit in a small matrix (538 x 1536 floats, ~3MB),
+ranking every incentive for a company is a single matrix product and doesn't need the LLM or a vector query.
+
+The same matrix backs the hybrid search of incentives by text (hybrid_search, used by get_incentive_by_title):
+the trigram similarity of the title alone misses incentives worded differently from the user ("apoio a painéis solares"
+vs "Autoconsumo e comunidades de energia renovável"), the embeddings (title + description + ai_description, built once
+at ingest) don't. The score of an incentive is
+    HYBRID_SEMANTIC_WEIGHT * cosine(query, incentive) + (1 - HYBRID_SEMANTIC_WEIGHT) * trigram similarity of the title
+so an exact title still wins and a paraphrase is still found, incentives under HYBRID_MIN_SCORE are not returned. The query embedding is the only outside call
+(batched with the other searches, see embedding_batcher.py), the vectors of the last HYBRID_QUERY_CACHE queries are kept.
+If the query can't be embedded the search falls back to the trigram scores only.
+"""
+import os
+import sys
+import time
+from threading import Lock
+
+import numpy as np
+from cachetools import LRUCache
+
+from sql import PostgreSQLManager, DB_CONFIG
+from result_cache import normalize
+import cancellation
+import logs
+
+SEMANTIC_WEIGHT = float(os.getenv("HYBRID_SEMANTIC_WEIGHT", 0.6))
+# Under this combined score an incentive doesn't match (an unrelated text still has a cosine of ~0.1 with everything)
+MIN_SCORE = float(os.getenv("HYBRID_MIN_SCORE", 0.2))
+QUERY_CACHE = int(os.getenv("HYBRID_QUERY_CACHE", 10_000))
+# Without the in-memory catalog, how many trigram matches are asked to the database to merge with the semantic ones
+TRIGRAM_CANDIDATES = 50
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+log = logs.get_logger(__name__)
+
+
+class IncentiveIndex:
+    def __init__(self, database: PostgreSQLManager, cache_size: int = 100_000):
+        self.database = database
+        # (incentive ids, titles, (n_incentives, dim) float32 matrix, squared norms of the rows)
+        # swapped as a whole on reload so readers never see half of an update
+        self.data = None
+        self.lock = Lock()
+        # (company_id, top_k) -> ranking, cleared every time the index is reloaded or the companies change
+        self.company_cache = LRUCache(maxsize=cache_size)
+        # normalized query text -> embedding, the model doesn't change so it's never invalidated
+        self.query_cache = LRUCache(maxsize=QUERY_CACHE)
+        self.counters = {"hybrid_searches": 0, "trigram_fallbacks": 0, "query_cache_hits": 0}
+
+    def load(self) -> bool:
+        """Load (or reload) the incentive embeddings from the database"""
+        time_start = time.time()
+        rows = self.database.get_incentive_embeddings()
+        if not rows:
+            log.warning("❌ No incentive embeddings found, run update_incentive_embeddings first")
+            return False
+        matrix = np.array([row["embeddings"] for row in rows], dtype=np.float32)
+        data = (
+            np.array([row["incentive_id"] for row in rows]),
+            [row["title"] for row in rows],
+            matrix,
+            np.einsum("ij,ij->i", matrix, matrix)
+        )
+        with self.lock:
+            self.data = data
+            self.company_cache.clear()
+        log.info(f"✅ Loaded {len(rows)} incentive embeddings in {time.time() - time_start:.2f} seconds")
+        return True
+
+    def forget_companies(self, company_ids: list):
+        """Drop the cached rankings of these companies (their embeddings changed)"""
+        company_ids = set(company_ids)
+        with self.lock:
+            for key in [key for key in self.company_cache if key[0] in company_ids]:
+                del self.company_cache[key]
+
+    def clear_company_cache(self):
+        with self.lock:
+            self.company_cache.clear()
+
+    def is_loaded(self) -> bool:
+        return self.data is not None
+
+    def distances(self, vectors: np.ndarray, data: tuple = None) -> np.ndarray:
+        """
+        L2 distance between each vector and every incentive (same metric as the <-> operator).
+        data: the self.data the caller read, so the scores match its ids even if the index is reloaded meanwhile
+        """
+        _, _, matrix, norms = data or self.data
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        squared = (
+            np.einsum("ij,ij->i", vectors, vectors)[:, None]
+            + norms[None, :]
+            - 2.0 * vectors @ matrix.T
+        )
+        return np.sqrt(np.maximum(squared, 0.0))
+
+    def similarities(self, vector: np.ndarray, data: tuple = None) -> np.ndarray:
+        """Cosine similarity between the vector and every incentive (1 - the <=> operator), data: see distances()"""
+        _, _, matrix, norms = data or self.data
+        vector = np.asarray(vector, dtype=np.float32)
+        denominator = np.sqrt(norms) * float(np.linalg.norm(vector))
+        return (matrix @ vector) / np.maximum(denominator, 1e-12)
+
+    def query_vector(self, query: str):
+        """Embedding of a search text (cached), None if it couldn't be embedded"""
+        key = normalize(query)
+        with self.lock:
+            vector = self.query_cache.get(key)
+            if vector is not None:
+                self.counters["query_cache_hits"] += 1
+                return vector
+        try:
+            response = self.database.embedder.get_embedding(key, model=EMBEDDING_MODEL)
+        except cancellation.RequestCancelled:
+            raise
+        except Exception as e:
+            log.warning(f"⚠️ Could not embed the incentive search '{query}' ({e}), using the title similarity only")
+            return None
+        vector = np.asarray(response["embedding"][0].embedding, dtype=np.float32)
+        with self.lock:
+            self.query_cache[key] = vector
+        return vector
+
+    def trigram_scores(self, query: str) -> dict:
+        """incentive_id -> trigram similarity of the title (> 0 only), from the catalog or the database"""
+        if self.database.incentive_catalog is not None:
+            return self.database.incentive_catalog.trigram_scores(query)
+        results = self.database.query_incentives_by_name(query, 0.0, TRIGRAM_CANDIDATES) or []
+        return {result["incentive_id"]: result["similarity_score"] for result in results}
+
+    def hybrid_search(self, query: str, limit: int = 10, after: tuple = None, weight: float = SEMANTIC_WEIGHT,
+                      min_score: float = MIN_SCORE):
+        """
+        Incentives that best match the text, by semantic + title similarity (see the top of the file).
+        Same results as query_incentives_by_name (the full incentives with a "similarity_score", best first,
+        after: (similarity_score, incentive_id) of the last incentive of the previous page), plus the
+        "semantic_score" and "trigram_score" the similarity_score was made of. None if nothing scores over min_score,
+        False on error.
+        """
+        recorder = self.database.query_recorder
+        if recorder is not None and after is None:
+            recorder.record("incentives", query, limit)
+        if not self.is_loaded() and not self.load():
+            return self.database.query_incentives_by_name(query, 0.0, limit, after)
+        vector = self.query_vector(query)
+        if vector is None:
+            with self.lock:
+                self.counters["trigram_fallbacks"] += 1
+            return self.database.query_incentives_by_name(query, 0.0, limit, after)
+        with self.lock:
+            self.counters["hybrid_searches"] += 1
+        data = self.data
+        ids, _, _, _ = data
+        semantic = self.similarities(vector, data)
+        trigram = np.zeros(len(ids), dtype=np.float32)
+        positions = {int(incentive_id): i for i, incentive_id in enumerate(ids)}
+        for incentive_id, score in self.trigram_scores(query).items():
+            if incentive_id in positions:
+                trigram[positions[incentive_id]] = score
+        # Rounded before sorting, the keyset cursor compares the rounded scores the results show
+        scores = np.round(weight * semantic.astype(np.float64) + (1 - weight) * trigram.astype(np.float64), 6)
+        # Best first, ties by id like the trigram search, so the keyset cursor works the same way
+        order = np.lexsort((ids, -scores))
+        results = []
+        for i in order:
+            score = float(scores[i])
+            if score < min_score:
+                # Sorted, the rest are under it too
+                break
+            incentive_id = int(ids[i])
+            if after is not None and (score > after[0] or (score == after[0] and incentive_id <= after[1])):
+                continue
+            incentive = self.database.query_incentives_by_id(incentive_id)
+            if not incentive:
+                continue
+            incentive["similarity_score"] = score
+            incentive["semantic_score"] = round(float(semantic[i]), 6)
+            incentive["trigram_score"] = round(float(trigram[i]), 6)
+            results.append(incentive)
+            if len(results) == limit:
+                break
+        return results or None
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "loaded": self.is_loaded(),
+                "incentives": len(self.data[0]) if self.data else 0,
+                "semantic_weight": SEMANTIC_WEIGHT,
+                "min_score": MIN_SCORE,
+                **self.counters,
+                "query_cache_entries": len(self.query_cache),
+            }
+
+    def vector(self, incentive_id: int):
+        """Embedding of an incentive, None if it doesn't exist (or has no embedding), False if the index can't load"""
+        if not self.is_loaded() and not self.load():
+            return False
+        ids, _, matrix, _ = self.data
+        position = np.flatnonzero(ids == incentive_id)
+        return matrix[position[0]] if len(position) else None
+
+    def rank(self, vectors: np.ndarray, top_k: int = 5) -> list:
+        """Top k incentives for each vector, returns one list of results per vector, False if the index can't load"""
+        if not self.is_loaded() and not self.load():
+            return False
+        data = self.data
+        ids, titles, _, _ = data
+        distances = self.distances(vectors, data)
+        top_k = min(top_k, distances.shape[1])
+        if top_k < 1:
+            return [[] for _ in range(len(distances))]
+        # argpartition is O(n), only the top k are actually sorted
+        top = np.argpartition(distances, top_k - 1, axis=1)[:, :top_k]
+        rankings = []
+        for row, candidates in enumerate(top):
+            order = candidates[np.argsort(distances[row, candidates])]
+            rankings.append([
+                {
+                    "incentive_id": int(ids[i]),
+                    "title": titles[i],
+                    "distance_score": float(distances[row, i])
+                }
+                for i in order
+            ])
+        return rankings
+
+    def rank_for_companies(self, company_ids: list, top_k: int = 5) -> dict:
+        """
+        Top k incentives for each company, returns {company_id: ranking}, False if the index can't load.
+        Companies that are not cached are fetched in one query and ranked in one matrix product.
+        """
+        results = {}
+        missing = []
+        with self.lock:
+            for company_id in company_ids:
+                cached = self.company_cache.get((company_id, top_k))
+                if cached is not None:
+                    results[company_id] = cached
+                else:
+                    missing.append(company_id)
+
+        if missing:
+            embeddings = self.database.get_company_embeddings(missing) or {}
+            found = [company_id for company_id in missing if company_id in embeddings]
+            if found:
+                rankings = self.rank(np.array([embeddings[c] for c in found], dtype=np.float32), top_k)
+                if rankings is False:
+                    return False
+                with self.lock:
+                    for company_id, ranking in zip(found, rankings):
+                        self.company_cache[(company_id, top_k)] = ranking
+                        results[company_id] = ranking
+        return results
+
+    def rank_for_company(self, company_id: int, top_k: int = 5) -> list:
+        """Top k incentives for a company, None if the company has no embedding, False if the index can't load"""
+        rankings = self.rank_for_companies([company_id], top_k)
+        if rankings is False:
+            return False
+        return rankings.get(company_id)
+
+
+if __name__ == "__main__":
+    database = PostgreSQLManager(**DB_CONFIG)
+    if "--update" in sys.argv:
+        # Adds the embeddings column + missing embeddings to an existing database
+        database.update_incentive_embeddings()
+    index = IncentiveIndex(database)
+    index.load()
+    names = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if "--search" in sys.argv:
+        for r in index.hybrid_search(" ".join(names)) or []:
+            print(r["incentive_id"], r["title"], f"{r['similarity_score']:.4f}",
+                  f"(semantic {r['semantic_score']:.4f}, trigram {r['trigram_score']:.4f})")
+        sys.exit()
+    company = database.query_company_by_name(names[0] if names else "PADARIA")
+    if company:
+        for r in index.rank_for_company(company["company_id"]) or []:
+            print(r["incentive_id"], r["title"], f"{r['distance_score']:.4f}")
@@ -0,0 +1,145 @@
+"""
+Small intent router that sits in front of the LLM.
+
+Some questions are so predictable that the LLM only ever answers them with the same function call,
+like "Qual é o incentivo 1060". For those we call the tool directly and render the answer from a template,
+everything else keeps going through api.converse like before.
+"""
+import re
+import time
+import textwrap
+from collections import deque
+from statistics import median
+from threading import Lock
+from typing import Optional, Tuple
+
+from tool_calling import execute_function
+
+INCENTIVE_REF = r"(?:o\s+|do\s+|ao\s+|de\s+|para\s+o\s+)?incentivo\s*(?:id\s*|n\.?\s*º\s*|nº\s*|n[úu]mero\s*)?#?\s*(?P<id>\d+)"
+
+# (compiled pattern, function to call, llm calls the function does on its own)
+INTENT_PATTERNS = [
+    (
+        re.compile(
+            r"^\s*(?:(?:qual|quais)\s+(?:é|e|são|sao)\s+|o\s+que\s+(?:é|e)\s+|mostra(?:-me)?\s+|d[áa](?:-me)?\s+|"
+            r"fala(?:-me)?\s+(?:sobre\s+|do\s+|de\s+)?|info(?:rma[çc][ãa]o|rma[çc][õo]es)?\s+(?:sobre|do|de)\s+)?"
+            + INCENTIVE_REF + r"\s*[?.!]*\s*$",
+            re.IGNORECASE
+        ),
+        "get_incentive_by_id",
+        0
+    ),
+    (
+        re.compile(
+            r"^\s*(?:que|quais)\s+(?:s[ãa]o\s+as\s+)?empresas\s+(?:que\s+)?(?:beneficiam|podem\s+beneficiar|s[ãa]o\s+eleg[íi]veis)\s+"
+            + INCENTIVE_REF + r"\s*[?.!]*\s*$",
+            re.IGNORECASE
+        ),
+        "get_companies_by_incentive",
+        1  # the query rewrite inside get_companies_by_incentive
+    ),
+]
+
+TEMPLATES = {
+    "get_incentive_by_id": "Aqui está a informação sobre o incentivo {parameter}:\n{info}",
+    "get_companies_by_incentive": "Estas são as empresas que mais provavelmente beneficiam do incentivo {parameter}:\n{info}",
+}
+
+NOT_FOUND_TEMPLATES = {
+    "Incentive not found": "Não encontrei nenhum incentivo com o ID {parameter}.",
+    "Company not found": "Não encontrei empresas relacionadas com o incentivo {parameter}.",
+}
+
+# If the tool answers with one of these we rather let the LLM deal with it
+FALLBACK_RESULTS = {"Invalid ID", "Error querying database", "Function not found"}
+
+
+class FastPathStats:
+    """Keeps track of how many turns were answered without the LLM and how long they took"""
+
+    def __init__(self, max_samples: int = 1000):
+        self.lock = Lock()
+        self.total_turns = 0
+        self.fast_turns = 0
+        self.zero_llm_turns = 0
+        self.fast_latencies = deque(maxlen=max_samples)
+        self.zero_llm_latencies = deque(maxlen=max_samples)
+
+    def record(self, fast: bool, latency: float = 0.0, llm_calls: int = 0):
+        with self.lock:
+            self.total_turns += 1
+            if not fast:
+                return
+            self.fast_turns += 1
+            self.fast_latencies.append(latency)
+            if llm_calls == 0:
+                self.zero_llm_turns += 1
+                self.zero_llm_latencies.append(latency)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            total = self.total_turns or 1
+            return {
+                "total_turns": self.total_turns,
+                "fast_path_turns": self.fast_turns,
+                "zero_llm_turns": self.zero_llm_turns,
+                "zero_llm_fraction": self.zero_llm_turns / total,
+                "fast_path_p50_ms": median(self.fast_latencies) * 1000 if self.fast_latencies else None,
+                "zero_llm_p50_ms": median(self.zero_llm_latencies) * 1000 if self.zero_llm_latencies else None,
+            }
+
+
+stats = FastPathStats()
+
+
+def match_intent(prompt: str) -> Optional[Tuple[str, str, int]]:
+    """Returns (function, parameter, llm_calls) if the prompt is one of the deterministic intents"""
+    for pattern, function, llm_calls in INTENT_PATTERNS:
+        match = pattern.match(prompt)
+        if match:
+            return function, match.group("id"), llm_calls
+    return None
+
+
+def render(function: str, parameter: str, info: str) -> Optional[str]:
+    """Render the tool result with the template of that function, None means the LLM should handle it"""
+    if info.strip() in FALLBACK_RESULTS:
+        return None
+    if info.strip() in NOT_FOUND_TEMPLATES:
+        return NOT_FOUND_TEMPLATES[info.strip()].format(parameter=parameter)
+    # The tools return indented f-strings, with one block per result
+    info = info.replace("Possible results:", "", 1)
+    info = "\n\n".join(textwrap.dedent(block).strip() for block in info.split("\n\n") if block.strip())
+    return TEMPLATES[function].format(parameter=parameter, info=info)
+
+
+def try_fast_path(prompt: str, session_id: str = None) -> Optional[str]:
+    """
+    Answers the prompt without the conversation LLM if possible.
+    Returns None when the prompt is not a deterministic intent (or the tool failed), in that case use the LLM.
+    """
+    intent = match_intent(prompt)
+    if intent is None:
+        stats.record(fast=False)
+        return None
+    function, parameter, llm_calls = intent
+    time_start = time.perf_counter()
+    response = render(function, parameter, execute_function(function, parameter, session_id))
+    if response is None:
+        stats.record(fast=False)
+        return None
+    stats.record(fast=True, latency=time.perf_counter() - time_start, llm_calls=llm_calls)
+    return response
+
+
+if __name__ == "__main__":
+    for test_prompt in [
+        "Qual é o incentivo 1060",
+        "qual e o incentivo nº 1060?",
+        "incentivo 3406",
+        "Que empresas beneficiam do incentivo 1060?",
+        "Quais empresas podem beneficiar do incentivo 1060",
+        "Que incentivos existem para padarias?",
+        "Compara o incentivo 1060 com o 3406",
+    ]:
+        print(f"{test_prompt!r} -> {match_intent(test_prompt)}")
@@ -0,0 +1,182 @@
+"""
+Local stand-in for the OpenAI API, so the chat API can be load tested without paying (or waiting) for the real LLM.
+
+Speaks the two endpoints the app uses, /v1/chat/completions and /v1/embeddings, with a configurable latency,
+and answers like the assistant would: the first turn of a question ends with the function call json
+(see ASSISTANT_SYSTEM_PROMPT), the turn after the function result is plain text.
+
+    python llm_stub.py --port 8100
+    OPENAI_BASE_URL=http://localhost:8100/v1 THEIR_GPT_API_KEY=stub uvicorn api_server:app --port 8000
+
+Latency of a completion = LLM_STUB_FIRST_TOKEN_MS + completion tokens / LLM_STUB_TOKENS_PER_SECOND (with +-20% jitter),
+plus prompt tokens / LLM_STUB_PREFILL_TOKENS_PER_SECOND if set (so bigger prompts are slower, like the real API).
+LLM_STUB_SLOW_RATE makes that fraction of the completions LLM_STUB_SLOW_FACTOR times slower (the tail that hedging is for),
+LLM_STUB_CONCURRENCY caps the completions served at the same time (like a provider per-key limit),
+LLM_STUB_ERROR_RATE answers that fraction of the requests with a 429 + Retry-After.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import time
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+FIRST_TOKEN_MS = float(os.getenv("LLM_STUB_FIRST_TOKEN_MS", 400))
+TOKENS_PER_SECOND = float(os.getenv("LLM_STUB_TOKENS_PER_SECOND", 80))
+PREFILL_TOKENS_PER_SECOND = float(os.getenv("LLM_STUB_PREFILL_TOKENS_PER_SECOND", 0))
+EMBEDDING_MS = float(os.getenv("LLM_STUB_EMBEDDING_MS", 60))
+CONCURRENCY = int(os.getenv("LLM_STUB_CONCURRENCY", 256))
+ERROR_RATE = float(os.getenv("LLM_STUB_ERROR_RATE", 0.0))
+SLOW_RATE = float(os.getenv("LLM_STUB_SLOW_RATE", 0.0))
+SLOW_FACTOR = float(os.getenv("LLM_STUB_SLOW_FACTOR", 10))
+DIM = 1536
+
+CONTINUE_MARKER = "[System: Continue your previous response]"
+
+# (pattern on the user question, function the assistant would call, group with the parameter)
+FUNCTION_PATTERNS = [
+    (re.compile(r"empresas.*(?:beneficiam|eleg[íi]veis).*incentivo\D*(\d+)", re.IGNORECASE), "get_companies_by_incentive"),
+    (re.compile(r"incentivo\D*(\d+)", re.IGNORECASE), "get_incentive_by_id"),
+    (re.compile(r"incentivos\s+(?:s[ãa]o\s+)?sobre\s+(.+?)\s*\??$", re.IGNORECASE), "get_incentive_by_title"),
+    (re.compile(r"empresas\s+(?:que\s+)?(?:fazem|trabalham\s+(?:em|com)|vendem)\s+(.+?)\s*\??$", re.IGNORECASE), "get_company_by_title"),
+    (re.compile(r"incentivos.*(?:empresa|para\s+a)\s+(.+?)\s*\??$", re.IGNORECASE), "get_incentives_by_company"),
+]
+
+app = FastAPI(title="LLM stub")
+slots = None    # asyncio.Semaphore, created in the event loop
+counters = {"completions": 0, "embeddings": 0, "rate_limited": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def jitter(seconds: float) -> float:
+    return seconds * random.uniform(0.8, 1.2)
+
+
+def answer(messages: list) -> str:
+    """What the assistant would say to the last user message"""
+    last = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+    if CONTINUE_MARKER in last:
+        return "Encontrei a informação que pediste. " + "Segue um pequeno resumo dos resultados mais relevantes. " * 3
+    if not any(m["role"] == "system" and "IA-go" in m["content"] for m in messages):
+        # Helper calls (query rewrite of get_companies_by_incentive...)
+        return "Empresas de " + " ".join(last.split()[:20])
+    for pattern, function in FUNCTION_PATTERNS:
+        match = pattern.search(last)
+        if match:
+            call = json.dumps({"function": function, "parameter": match.group(1)}, ensure_ascii=False, indent=4)
+            return f"Claro, vou procurar essa informação.\n```json\n{call}\n```"
+    return "Olá! Posso ajudar com incentivos, empresas ou com as empresas que beneficiam de um incentivo."
+
+
+def rate_limited() -> JSONResponse:
+    counters["rate_limited"] += 1
+    return JSONResponse(
+        status_code=429,
+        content={"error": {"message": "Rate limit reached (stub)", "type": "rate_limit_error", "code": "rate_limit_exceeded"}},
+        headers={"retry-after-ms": "500"}
+    )
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    global slots
+    if slots is None:
+        slots = asyncio.Semaphore(CONCURRENCY)
+    body = await request.json()
+    if random.random() < ERROR_RATE:
+        return rate_limited()
+    content = answer(body["messages"])
+    prompt_tokens = sum(count_tokens(m.get("content") or "") for m in body["messages"])
+    completion_tokens = count_tokens(content)
+    latency = jitter(FIRST_TOKEN_MS / 1000 + completion_tokens / TOKENS_PER_SECOND)
+    if PREFILL_TOKENS_PER_SECOND:
+        latency += prompt_tokens / PREFILL_TOKENS_PER_SECOND
+    if random.random() < SLOW_RATE:
+        latency *= SLOW_FACTOR
+    async with slots:
+        await asyncio.sleep(latency)
+    counters["completions"] += 1
+    counters["prompt_tokens"] += prompt_tokens
+    counters["completion_tokens"] += completion_tokens
+    return {
+        "id": f"chatcmpl-stub-{counters['completions']}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stub"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": 0},
+        },
+    }
+
+
+def stub_embedding(text: str) -> np.ndarray:
+    """Deterministic unit vector per text (same text, same vector)"""
+    seed = int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+    vector = np.random.default_rng(seed).standard_normal(DIM).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def encode(vector: np.ndarray, encoding_format: str):
+    """Float list, or base64 of the little-endian float32 bytes (encoding_format="base64", like the real API)"""
+    if encoding_format == "base64":
+        return base64.b64encode(vector.astype("<f4").tobytes()).decode("ascii")
+    return vector.tolist()
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    if random.random() < ERROR_RATE:
+        return rate_limited()
+    texts = [body["input"]] if isinstance(body["input"], str) else body["input"]
+    await asyncio.sleep(jitter(EMBEDDING_MS / 1000))
+    counters["embeddings"] += 1
+    tokens = sum(count_tokens(text) for text in texts)
+    return {
+        "object": "list",
+        "model": body.get("model", "text-embedding-3-small"),
+        "data": [{"object": "embedding", "index": i, "embedding": encode(stub_embedding(text), body.get("encoding_format"))}
+                 for i, text in enumerate(texts)],
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+@app.get("/stats")
+async def stats():
+    return {
+        "first_token_ms": FIRST_TOKEN_MS,
+        "tokens_per_second": TOKENS_PER_SECOND,
+        "prefill_tokens_per_second": PREFILL_TOKENS_PER_SECOND,
+        "concurrency": CONCURRENCY,
+        "error_rate": ERROR_RATE,
+        "slow_rate": SLOW_RATE,
+        **counters
+    }
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stub for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,255 @@
+"""
+Open-loop load generator for the chat API (testing.py drives one interactive session, this drives thousands).
+
+Requests arrive as a Poisson process at the given rate whether or not the previous ones finished
+(like real users, so a saturated server shows up as growing latency and errors, not as a slower client).
+Each arrival takes an idle session_id from a pool and asks a question from the README mix:
+    id_lookup               "Qual é o incentivo <id>?"
+    incentive_search        "Que incentivos são sobre <tema>?"
+    company_search          "Que empresas fazem <atividade>?"
+    incentive_to_company    "Que empresas beneficiam do incentivo <id>?"
+sent to /chat or /chat/stream (--stream-ratio).
+
+Every stage of --rates runs for --duration seconds and reports throughput, error rate, p50/p95/p99 latency
+and time to the first SSE chunk. The first stage that can't keep up (throughput under 90% of the offered rate,
+or p95 over --slo) is where the server saturates.
+
+Against the LLM stub (see llm_stub.py):
+    python llm_stub.py --port 8100 &
+    OPENAI_BASE_URL=http://localhost:8100/v1 THEIR_GPT_API_KEY=stub uvicorn api_server:app --port 8000 --workers 2 &
+    python load_test.py --rates 5,10,20,40 --duration 30 --sessions 5000 --output load_test.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter, deque
+
+import httpx
+import numpy as np
+
+QUESTION_MIX = {
+    # kind: (weight, templates)
+    "id_lookup": (0.3, ["Qual é o incentivo {id}?", "Fala-me do incentivo {id}", "Mostra o incentivo nº {id}"]),
+    "incentive_search": (0.25, ["Que incentivos são sobre {topic}?", "Quais incentivos são sobre {topic}?"]),
+    "company_search": (0.25, ["Que empresas fazem {activity}?", "Que empresas trabalham em {activity}?"]),
+    "incentive_to_company": (0.2, ["Que empresas beneficiam do incentivo {id}?", "Quais empresas podem beneficiar do incentivo {id}?"]),
+}
+TOPICS = [
+    "energia renovável", "digitalização", "eficiência energética", "inovação produtiva", "formação profissional",
+    "internacionalização", "agricultura", "turismo", "investigação e desenvolvimento", "economia circular",
+]
+ACTIVITIES = [
+    "software", "construção civil", "panificação", "transportes de mercadorias", "painéis solares",
+    "consultoria", "restauração", "vinho", "têxteis", "metalomecânica",
+]
+PERCENTILES = (50, 95, 99)
+
+
+class Question:
+    def __init__(self, incentive_ids: list, seed: int = None):
+        self.incentive_ids = incentive_ids
+        self.random = random.Random(seed)
+        self.kinds = list(QUESTION_MIX)
+        self.weights = [QUESTION_MIX[kind][0] for kind in self.kinds]
+
+    def next(self) -> tuple:
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        template = self.random.choice(QUESTION_MIX[kind][1])
+        prompt = template.format(
+            id=self.random.choice(self.incentive_ids),
+            topic=self.random.choice(TOPICS),
+            activity=self.random.choice(ACTIVITIES)
+        )
+        return kind, prompt
+
+
+class Sessions:
+    """Pool of session ids, a session is never used by two requests at the same time (one user = one request)"""
+
+    def __init__(self, count: int, prefix: str):
+        self.idle = deque(f"{prefix}-{i}" for i in range(count))
+        random.shuffle(self.idle)
+        self.prefix = prefix
+        self.extra = 0
+
+    def take(self) -> str:
+        if self.idle:
+            return self.idle.popleft()
+        self.extra += 1     # every session is busy, more concurrent users than --sessions
+        return f"{self.prefix}-extra-{self.extra}"
+
+    def release(self, session_id: str):
+        self.idle.append(session_id)
+
+
+async def chat(client: httpx.AsyncClient, session_id: str, prompt: str) -> dict:
+    response = await client.post("/chat", json={"prompt": prompt, "session_id": session_id})
+    if response.status_code != 200:
+        return {"status": f"http_{response.status_code}"}
+    return {"status": "ok", "first_chunk": None}
+
+
+async def chat_stream(client: httpx.AsyncClient, session_id: str, prompt: str, time_start: float) -> dict:
+    first_chunk = None
+    async with client.stream("POST", "/chat/stream", json={"prompt": prompt, "session_id": session_id},
+                             headers={"Accept": "text/event-stream"}) as response:
+        if response.status_code != 200:
+            return {"status": f"http_{response.status_code}"}
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            if first_chunk is None:
+                first_chunk = time.perf_counter() - time_start
+            try:
+                data = json.loads(line[6:])
+            except json.JSONDecodeError:
+                continue
+            if "error" in data:
+                return {"status": "sse_error", "first_chunk": first_chunk}
+            if data.get("done"):
+                break
+    return {"status": "ok", "first_chunk": first_chunk}
+
+
+async def one_request(client, sessions: Sessions, kind: str, prompt: str, stream: bool, results: list):
+    session_id = sessions.take()
+    time_start = time.perf_counter()
+    try:
+        if stream:
+            result = await chat_stream(client, session_id, prompt, time_start)
+        else:
+            result = await chat(client, session_id, prompt)
+    except httpx.TimeoutException:
+        result = {"status": "timeout"}
+    except httpx.HTTPError as e:
+        result = {"status": type(e).__name__}
+    finally:
+        sessions.release(session_id)
+    result.update(kind=kind, stream=stream, latency=time.perf_counter() - time_start, finished=time.perf_counter())
+    results.append(result)
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {f"p{p}": None for p in PERCENTILES}
+    return {f"p{p}": round(float(v) * 1000, 1) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))}
+
+
+def summarize(rate: float, duration: float, results: list, dropped: int, unfinished: int) -> dict:
+    statuses = Counter(r["status"] for r in results)
+    if dropped:
+        statuses["client_dropped"] = dropped
+    if unfinished:
+        statuses["unfinished"] = unfinished
+    ok = [r for r in results if r["status"] == "ok"]
+    total = len(results) + dropped + unfinished
+    return {
+        "offered_rate": rate,
+        "requests": total,
+        "throughput": round(len(ok) / duration, 2),
+        "error_rate": round((total - len(ok)) / total, 4) if total else 0.0,
+        "statuses": dict(statuses),
+        "latency_ms": percentiles([r["latency"] for r in ok]),
+        "first_chunk_ms": percentiles([r["first_chunk"] for r in ok if r.get("first_chunk") is not None]),
+        "latency_ms_by_kind": {
+            kind: percentiles([r["latency"] for r in ok if r["kind"] == kind]) for kind in QUESTION_MIX
+        },
+    }
+
+
+async def run_stage(client, rate: float, duration: float, questions: Question, sessions: Sessions,
+                    stream_ratio: float, max_inflight: int, drain_timeout: float) -> dict:
+    results, tasks = [], set()
+    dropped = 0
+    time_start = time.perf_counter()
+    next_arrival = time_start
+    while True:
+        next_arrival += random.expovariate(rate)
+        if next_arrival - time_start >= duration:
+            break
+        await asyncio.sleep(max(0.0, next_arrival - time.perf_counter()))
+        if len(tasks) >= max_inflight:
+            dropped += 1    # the client itself is the bottleneck, don't block the arrivals
+            continue
+        kind, prompt = questions.next()
+        task = asyncio.create_task(one_request(client, sessions, kind, prompt, random.random() < stream_ratio, results))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    # Let the requests of this stage finish before the next one, the ones still running after the timeout are errors
+    if tasks:
+        await asyncio.wait(tasks, timeout=drain_timeout)
+    unfinished = len(tasks)
+    for task in list(tasks):
+        task.cancel()
+    return summarize(rate, duration, results, dropped, unfinished)
+
+
+async def fetch_incentive_ids(client: httpx.AsyncClient) -> list:
+    """Real ids from the search endpoint, so id lookups hit existing incentives"""
+    ids = set()
+    for topic in TOPICS:
+        try:
+            response = await client.get("/incentives/search", params={"q": topic, "limit": 50})
+            ids.update(item["incentive_id"] for item in response.json()["items"])
+        except (httpx.HTTPError, KeyError, ValueError):
+            continue
+    return sorted(ids)
+
+
+def print_stage(summary: dict):
+    latency, first_chunk = summary["latency_ms"], summary["first_chunk_ms"]
+    print(
+        f"{summary['offered_rate']:>8.1f} {summary['throughput']:>8.2f} {summary['error_rate']:>7.1%} "
+        f"{latency['p50'] or 0:>8.0f} {latency['p95'] or 0:>8.0f} {latency['p99'] or 0:>8.0f} "
+        f"{first_chunk['p50'] or 0:>8.0f} {first_chunk['p95'] or 0:>8.0f}   {summary['statuses']}"
+    )
+
+
+async def main(args):
+    limits = httpx.Limits(max_connections=args.max_inflight, max_keepalive_connections=args.max_inflight)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        incentive_ids = [int(i) for i in args.incentive_ids.split(",")] if args.incentive_ids else await fetch_incentive_ids(client)
+        if not incentive_ids:
+            raise SystemExit("❌ No incentive ids (is the API running? or pass --incentive-ids)")
+        questions = Question(incentive_ids, args.seed)
+        sessions = Sessions(args.sessions, f"load-{int(time.time())}")
+        print(f"🚀 {args.url}, {len(incentive_ids)} incentive ids, {args.sessions} sessions, {args.stream_ratio:.0%} streaming")
+        print(f"{'rate':>8} {'tput':>8} {'errors':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'ttfc50':>8} {'ttfc95':>8}   statuses")
+        stages = []
+        for rate in args.rates:
+            summary = await run_stage(client, rate, args.duration, questions, sessions,
+                                      args.stream_ratio, args.max_inflight, args.timeout)
+            print_stage(summary)
+            stages.append(summary)
+
+    saturated = next(
+        (s for s in stages if s["throughput"] < 0.9 * s["offered_rate"] or (s["latency_ms"]["p95"] or 0) > args.slo * 1000),
+        None
+    )
+    if saturated:
+        print(f"📈 Saturates at ~{saturated['offered_rate']} req/s (max sustained throughput {max(s['throughput'] for s in stages)} req/s)")
+    else:
+        print(f"📈 No saturation up to {args.rates[-1]} req/s")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "stages": stages}, f, indent=4)
+        print(f"✅ Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Open-loop load test of /chat and /chat/stream")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--rates", type=lambda s: [float(r) for r in s.split(",")], default=[1, 2, 5, 10],
+                        help="arrival rates (requests/s), one stage each")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per stage")
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--stream-ratio", type=float, default=0.5, help="fraction of the requests sent to /chat/stream")
+    parser.add_argument("--max-inflight", type=int, default=2000, help="requests in flight before the client starts dropping arrivals")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--slo", type=float, default=5.0, help="p95 latency (seconds) considered saturated")
+    parser.add_argument("--incentive-ids", default=None, help="comma separated ids (default: taken from /incentives/search)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", default=None, help="JSON file with every stage")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,258 @@
+"""
+Structured logging of the API, instead of print() on the hot paths.
+
+print() writes to stdout right away in the thread of the request: under load every query and tool call of every
+request waits on the same stdout lock, and the container logs get one "✅ Query executed successfully!" per query.
+Here:
+    - every record has a level, the ones below LOG_LEVEL cost one isEnabledFor() check
+    - the request threads only put the record in a queue (QueueHandler), one writer thread formats them and writes
+      everything that is waiting with one write + flush. The queue holds LOG_QUEUE records, when it's full the new
+      records are dropped (and counted), a request never waits
+    - the records of a chat turn carry its session_id and a request_id (bind(), a ContextVar, so it follows the
+      work that cancellation.run_in_executor sends to the executor threads)
+    - high-frequency events (event()) can be sampled: LOG_SAMPLE=query_executed=100 keeps 1 of every 100,
+      the kept ones have "sample_rate": 100. Warnings and errors are never sampled
+
+    LOG_LEVEL=INFO
+    LOG_FORMAT=json         (or text)
+    LOG_QUEUE=10000
+    LOG_SAMPLE=query_executed=100
+
+stats() (in /stats) has the records written, dropped and sampled out.
+"""
+import atexit
+import contextvars
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+import uuid
+from queue import Empty, Full, Queue
+
+LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+FORMAT = os.getenv("LOG_FORMAT", "json")
+QUEUE_SIZE = int(os.getenv("LOG_QUEUE", 10000))
+SAMPLE = {
+    name.strip(): max(1, int(rate))
+    for name, _, rate in (item.partition("=") for item in os.getenv("LOG_SAMPLE", "query_executed=100").split(","))
+    if name.strip() and rate.strip()
+}
+
+ROOT = "app"
+
+# (session_id, request_id) of the chat turn being served, None outside of a request
+current_request = contextvars.ContextVar("log_request", default=None)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks: a full queue drops the record"""
+
+    def __init__(self, queue: Queue):
+        super().__init__(queue)
+        self.lock_counters = threading.Lock()
+        self.counters = {"queued": 0, "dropped": 0}
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            with self.lock_counters:
+                self.counters["dropped"] += 1
+            return
+        with self.lock_counters:
+            self.counters["queued"] += 1
+
+    def prepare(self, record):
+        # Only the message is built here (args can be objects that change later), the JSON in the writer thread.
+        # No copy of the record like QueueHandler does, this is the only handler of the "app" logger
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.request = current_request.get()
+        return record
+
+
+class Writer(threading.Thread):
+    """Formats and writes the queued records, everything that is waiting goes out in one write + flush"""
+
+    STOP = object()
+
+    def __init__(self, queue: Queue, stream, formatter: logging.Formatter, batch: int = 512):
+        super().__init__(name="log-writer", daemon=True)
+        self.queue = queue
+        self.stream = stream
+        self.formatter = formatter
+        self.batch = batch
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            while len(records) < self.batch:
+                try:
+                    records.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            stop = any(record is self.STOP for record in records)
+            lines = []
+            for record in records:
+                if record is self.STOP:
+                    continue
+                try:
+                    lines.append(self.formatter.format(record))
+                except Exception as e:
+                    lines.append(f"⚠️ Could not format a log record ({e}): {record.msg!r}")
+            if lines:
+                try:
+                    self.stream.write("\n".join(lines) + "\n")
+                    self.stream.flush()
+                except (OSError, ValueError):
+                    pass
+            if stop:
+                return
+
+    def stop(self):
+        self.queue.put(self.STOP)
+        self.join(timeout=5)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        request = getattr(record, "request", None)
+        if request is not None:
+            entry["session_id"], entry["request_id"] = request
+        event = getattr(record, "event", None)
+        if event is not None:
+            entry["event"] = event
+        entry.update(getattr(record, "fields", None) or {})
+        if getattr(record, "sample_rate", 1) > 1:
+            entry["sample_rate"] = record.sample_rate
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record) -> str:
+        text = super().format(record)
+        request = getattr(record, "request", None)
+        extra = dict(getattr(record, "fields", None) or {})
+        if request is not None:
+            extra["request_id"] = request[1]
+        if getattr(record, "sample_rate", 1) > 1:
+            extra["sample_rate"] = record.sample_rate
+        if extra:
+            text += " " + " ".join(f"{key}={value}" for key, value in extra.items())
+        return text
+
+
+class Logging:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handler = None
+        self.writer = None
+        self.counters = {name: itertools.count() for name in SAMPLE}
+        self.sampled_out = 0
+
+    def setup(self, level: str = LEVEL, format: str = FORMAT, queue_size: int = QUEUE_SIZE, stream=None):
+        """Start the writer thread (once), called by the first get_logger()"""
+        with self.lock:
+            if self.handler is not None:
+                return
+            queue = Queue(maxsize=queue_size)
+            self.handler = DroppingQueueHandler(queue)
+            self.writer = Writer(queue, stream or sys.stdout, JsonFormatter() if format == "json" else TextFormatter())
+            root = logging.getLogger(ROOT)
+            root.setLevel(level)
+            root.addHandler(self.handler)
+            # Not to the root logger of the process (uvicorn has its own handlers there)
+            root.propagate = False
+            self.writer.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """Write what is still queued (at exit)"""
+        with self.lock:
+            if self.writer is not None:
+                self.writer.stop()
+                self.writer = None
+
+    def keep(self, name: str) -> int:
+        """Sample rate of the event if this one is kept, 0 if it's sampled out"""
+        rate = SAMPLE.get(name, 1)
+        if rate == 1:
+            return 1
+        if next(self.counters[name]) % rate == 0:
+            return rate
+        self.sampled_out += 1
+        return 0
+
+    def stats(self) -> dict:
+        if self.handler is None:
+            return {}
+        with self.handler.lock_counters:
+            counters = dict(self.handler.counters)
+        return {
+            "level": logging.getLevelName(logging.getLogger(ROOT).level),
+            **counters,
+            "waiting": self.handler.queue.qsize(),
+            "sampled_out": self.sampled_out,
+            "sample": SAMPLE,
+        }
+
+
+logs = Logging()
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger of a module (get_logger(__name__)), under the "app" logger"""
+    logs.setup()
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+def event(logger: logging.Logger, level: int, name: str, message: str, **fields):
+    """
+    Log a named event with structured fields (they are JSON keys of the record).
+    Events in LOG_SAMPLE below WARNING keep 1 of every N.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    rate = logs.keep(name) if level < logging.WARNING else 1
+    if rate:
+        # makeRecord + handle instead of logger.log(): skips findCaller (walks the stack, most of the cost of a record)
+        record = logger.makeRecord(logger.name, level, "", 0, message, None, None,
+                                   extra={"event": name, "fields": fields, "sample_rate": rate})
+        logger.handle(record)
+
+
+def bind(session_id: str, request_id: str = None):
+    """Make the records of the current request (context) carry its session_id and a request_id, returns the reset token"""
+    return current_request.set((session_id, request_id or uuid.uuid4().hex[:12]))
+
+
+def unbind(token):
+    current_request.reset(token)
+
+
+def request_id():
+    request = current_request.get()
+    return request[1] if request is not None else None
+
+
+def stats() -> dict:
+    return logs.stats()
@@ -25,6 +25,7 @@ As funçoes possiveis que podes usar são:
 - get_incentive_by_title(<title>)               # Returns the 3 most probable incentives in the database given that title/name
 - get_company_by_title(<title>)                 # Returns the 3 most probable companies in the database given that title/name
 - get_companies_by_incentive(<id_incentive>)    # Returns the 5 most probable companies that benefit from that incentive
+- get_incentives_by_company(<company_name>)     # Returns the 5 incentives that best fit that company
 Só podes chamar uma função de cada vez.
 Se uma função for chamada para dar informação, dá uma resposta simples e pequena a menos que seja pedido uma descrição detalhada.
 """.strip()
@@ -40,7 +41,7 @@ def main():
             break
         api.add_user_prompt(prompt, messages)
         full_response = ""
-        response = api.converse(messages)
+        response = api.converse(messages, site="turn")
         #print(f"\n[First Response]: {response}\n")
         for part in analyze_response(response, messages, api):
             print(part.strip())
@@ -0,0 +1,310 @@
+"""
+Shared scheduler for every outbound call to the LLM / embedding providers (used by API and OpenAIEmbeder).
+
+- Per provider concurrency limit (semaphore)
+- Token buckets for requests per minute and tokens per minute
+- Retries with jittered exponential backoff, honoring the Retry-After header of 429s
+- Admission control: when the queue is so long that a new request would wait more than the latency budget,
+  admit() raises Overloaded right away so the API can answer a fast 503 with a Retry-After hint
+
+Limits are configured with env variables, for example:
+    OUTBOUND_OPENAI_CONCURRENCY=16  OUTBOUND_OPENAI_RPM=500  OUTBOUND_OPENAI_TPM=200000
+    OUTBOUND_LATENCY_BUDGET=10      (seconds)
+
+Run `python outbound.py` to simulate 2x overload with and without admission control.
+"""
+import argparse
+import os
+import random
+import threading
+import time
+from statistics import median
+
+import openai
+
+DEFAULT_LIMITS = {
+    # provider: (concurrency, requests per minute, tokens per minute)
+    "openai": (16, 500, 200_000),
+    "openai-embeddings": (16, 3000, 1_000_000),
+    "deepseek": (16, 1000, 1_000_000),
+}
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class Overloaded(Exception):
+    """The provider is saturated (queue over the latency budget, or still 429 after every retry)"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` would be available"""
+        with self.lock:
+            self.refill()
+            return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def acquire(self, amount: float):
+        """Blocks until `amount` is available and takes it"""
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def adjust(self, amount: float):
+        """Correct an estimate after the fact (can leave the bucket in debt)"""
+        with self.lock:
+            self.tokens -= amount
+
+
+class ProviderLimiter:
+    def __init__(self, name: str, concurrency: int, rpm: float, tpm: float):
+        self.name = name
+        self.concurrency = concurrency
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.latency = 1.0              # EWMA of the call duration (seconds)
+        self.calls = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.rejected = 0
+
+    def estimated_wait(self, estimated_tokens: int = 0) -> float:
+        """How long a new request would wait before starting"""
+        with self.lock:
+            ahead = max(0, self.queued + self.active - self.concurrency + 1)
+            queue_wait = ahead / self.concurrency * self.latency
+        return max(queue_wait, self.requests.wait_time(1), self.tokens.wait_time(estimated_tokens))
+
+    def record_latency(self, seconds: float):
+        with self.lock:
+            self.latency = 0.8 * self.latency + 0.2 * seconds
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "concurrency": self.concurrency,
+                "active": self.active,
+                "queued": self.queued,
+                "latency_ewma_ms": self.latency * 1000,
+                "calls": self.calls,
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+                "rejected": self.rejected,
+            }
+
+
+def retry_after_of(error: Exception):
+    """Seconds asked by the provider in Retry-After / retry-after-ms, None if not present"""
+    if getattr(error, "retry_after", None) is not None:
+        return float(error.retry_after)
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    return isinstance(error, RETRYABLE_ERRORS) or getattr(error, "status_code", None) in RETRYABLE_STATUS
+
+
+def is_rate_limit(error: Exception) -> bool:
+    return isinstance(error, openai.RateLimitError) or getattr(error, "status_code", None) == 429
+
+
+class OutboundScheduler:
+    def __init__(self, latency_budget: float = None, max_retries: int = 5, base_delay: float = 0.5, max_delay: float = 30.0):
+        self.latency_budget = latency_budget or float(os.getenv("OUTBOUND_LATENCY_BUDGET", 10))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.providers = {}
+        self.lock = threading.Lock()
+
+    def provider(self, name: str) -> ProviderLimiter:
+        with self.lock:
+            if name not in self.providers:
+                concurrency, rpm, tpm = DEFAULT_LIMITS.get(name, DEFAULT_LIMITS["openai"])
+                prefix = "OUTBOUND_" + name.upper().replace("-", "_")
+                self.providers[name] = ProviderLimiter(
+                    name,
+                    int(os.getenv(f"{prefix}_CONCURRENCY", concurrency)),
+                    float(os.getenv(f"{prefix}_RPM", rpm)),
+                    float(os.getenv(f"{prefix}_TPM", tpm))
+                )
+            return self.providers[name]
+
+    def admit(self, name: str, estimated_tokens: int = 0):
+        """Raises Overloaded if a new request to this provider would wait more than the latency budget"""
+        limiter = self.provider(name)
+        wait = limiter.estimated_wait(estimated_tokens)
+        if wait + limiter.latency > self.latency_budget:
+            with limiter.lock:
+                limiter.rejected += 1
+            raise Overloaded(f"{name} is overloaded, try again later", retry_after=max(1.0, wait))
+
+    def backoff(self, attempt: int, retry_after: float = None) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))  # full jitter
+        if retry_after is not None:
+            # Capped, a Retry-After of minutes would park the request thread in time.sleep
+            delay = min(self.max_delay, retry_after + random.uniform(0, self.base_delay))
+        return delay
+
+    def call(self, name: str, function, *args, estimated_tokens: int = 0, usage_tokens=None, **kwargs):
+        """
+        Run function(*args, **kwargs) under the limits of the provider, retrying transient errors.
+        usage_tokens(result) -> real number of tokens, used to correct the token bucket.
+        """
+        limiter = self.provider(name)
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            with limiter.lock:
+                limiter.queued += 1
+            try:
+                limiter.requests.acquire(1)
+                limiter.tokens.acquire(estimated_tokens)
+                limiter.semaphore.acquire()
+            finally:
+                with limiter.lock:
+                    limiter.queued -= 1
+            with limiter.lock:
+                limiter.active += 1
+                limiter.calls += 1
+            time_start = time.monotonic()
+            try:
+                result = function(*args, **kwargs)
+                limiter.record_latency(time.monotonic() - time_start)
+                if usage_tokens is not None:
+                    limiter.tokens.adjust(usage_tokens(result) - estimated_tokens)
+                return result
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                last_error = e
+            finally:
+                with limiter.lock:
+                    limiter.active -= 1
+                limiter.semaphore.release()
+
+            retry_after = retry_after_of(last_error)
+            with limiter.lock:
+                limiter.retries += 1
+                if is_rate_limit(last_error):
+                    limiter.rate_limited += 1
+            if attempt < self.max_retries:
+                if retry_after is not None and retry_after > self.latency_budget:
+                    # The provider asks for a longer wait than the budget, fail fast so the client retries later
+                    raise Overloaded(f"{name} asked to retry in {retry_after:.0f}s", retry_after=retry_after) from last_error
+                time.sleep(self.backoff(attempt, retry_after))
+
+        if is_rate_limit(last_error):
+            raise Overloaded(f"{name} is rate limiting us", retry_after=retry_after_of(last_error) or self.max_delay) from last_error
+        raise last_error
+
+    def stats(self) -> dict:
+        with self.lock:
+            providers = dict(self.providers)
+        return {name: limiter.stats() for name, limiter in providers.items()}
+
+
+scheduler = OutboundScheduler()
+
+
+def estimate_tokens(messages) -> int:
+    """Rough estimate (4 characters per token) used before we know the real usage"""
+    if isinstance(messages, str):
+        return len(messages) // 4 + 1
+    if messages and isinstance(messages[0], dict):
+        return sum(len(m.get("content") or "") for m in messages) // 4 + 1
+    return sum(len(m) for m in messages) // 4 + 1
+
+
+def simulate(admission: bool, capacity: int, service_time: float, overload: float, duration: float, deadline: float) -> dict:
+    """Open-loop arrivals at `overload` x the capacity of a fake provider, goodput = answers within the deadline"""
+    os.environ["OUTBOUND_SIMULATED_CONCURRENCY"] = str(capacity)
+    os.environ["OUTBOUND_SIMULATED_RPM"] = "1000000000"
+    os.environ["OUTBOUND_SIMULATED_TPM"] = "1000000000"
+    sim_scheduler = OutboundScheduler(latency_budget=deadline / 2)
+    sim_scheduler.provider("simulated").latency = service_time
+    arrival_rate = overload * capacity / service_time
+    results = []
+    lock = threading.Lock()
+
+    def request():
+        time_start = time.monotonic()
+        try:
+            if admission:
+                sim_scheduler.admit("simulated")
+            sim_scheduler.call("simulated", time.sleep, random.expovariate(1 / service_time))
+            outcome = "ok"
+        except Overloaded:
+            outcome = "rejected"
+        with lock:
+            results.append((outcome, time.monotonic() - time_start))
+
+    threads = []
+    time_start = time.monotonic()
+    while time.monotonic() - time_start < duration:
+        thread = threading.Thread(target=request, daemon=True)
+        thread.start()
+        threads.append(thread)
+        time.sleep(random.expovariate(arrival_rate))
+    for thread in threads:
+        thread.join()
+
+    ok = [latency for outcome, latency in results if outcome == "ok"]
+    good = [latency for latency in ok if latency <= deadline]
+    rejected = [latency for outcome, latency in results if outcome == "rejected"]
+    return {
+        "requests": len(results),
+        "goodput_per_s": len(good) / duration,
+        "completed_late": len(ok) - len(good),
+        "rejected": len(rejected),
+        "p50_ms": median(ok) * 1000 if ok else None,
+        "reject_p50_ms": median(rejected) * 1000 if rejected else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Goodput of the outbound scheduler under overload (simulated provider)")
+    parser.add_argument("--capacity", type=int, default=8, help="concurrent requests the provider can serve")
+    parser.add_argument("--service-time", type=float, default=0.2, help="mean seconds per request")
+    parser.add_argument("--overload", type=float, default=2.0, help="offered load / capacity")
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--deadline", type=float, default=2.0, help="seconds after which an answer is useless")
+    args = parser.parse_args()
+    print(f"Capacity: {args.capacity / args.service_time:.0f} req/s, offered: {args.overload * args.capacity / args.service_time:.0f} req/s")
+    for admission in (False, True):
+        result = simulate(admission, args.capacity, args.service_time, args.overload, args.duration, args.deadline)
+        print(f"admission control {'on ' if admission else 'off'}: {result}")
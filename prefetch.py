@@ -0,0 +1,214 @@
+"""
+Speculative prefetch of the tool call a user is most likely to ask for next.
+
+After "Qual é o incentivo X" the next question is almost always "que empresas beneficiam dele?",
+which costs an LLM query rewrite, an embedding and a vector search. So when a tool returns incentives,
+get_companies_by_incentive for them starts in the background while the user is still reading,
+and the result waits in a small per-session cache.
+
+Limits, so a speculation never competes with real traffic:
+    PREFETCH_TTL=120            seconds a prefetched result stays valid
+    PREFETCH_CONCURRENCY=2      prefetches running at the same time (extra ones are skipped, not queued)
+    PREFETCH_PER_MINUTE=30      prefetches started per minute (each one is ~1 LLM call + 1 embedding)
+    PREFETCH_PER_SESSION=3      cached results per session
+    PREFETCH_WAIT=5             seconds a turn waits for a prefetch still running, then it runs the call itself
+    PREFETCH=0                  disables it
+Nothing is prefetched while the LLM provider of the query rewrite already has a queue (see outbound.py and routing.py).
+
+stats() has the hit rate and the latency saved on follow-up turns (the time the tool would have taken).
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+import cancellation
+import logs
+import singleflight
+from outbound import scheduler, TokenBucket
+from routing import router
+
+ENABLED = os.getenv("PREFETCH", "1") == "1"
+TTL = float(os.getenv("PREFETCH_TTL", 120))
+CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", 2))
+PER_MINUTE = float(os.getenv("PREFETCH_PER_MINUTE", 30))
+PER_SESSION = int(os.getenv("PREFETCH_PER_SESSION", 3))
+WAIT = float(os.getenv("PREFETCH_WAIT", 5))
+
+# Calls that are ever prefetched, the turns asking for them count for the hit rate
+PREFETCHED_FUNCTIONS = {"get_companies_by_incentive"}
+# Routing site of the LLM call a prefetch makes (the query rewrite of get_companies_by_incentive)
+LLM_SITE = "query_rewrite"
+INCENTIVE_ID_PATTERN = re.compile(r"Incentive ID:\s*(\d+)")
+# A tool answering one of these has nothing worth keeping
+FAILED_RESULTS = {"Invalid ID", "Error querying database", "Function not found", "Incentive not found", "Company not found"}
+
+
+def follow_ups(function: str, parameter: str, result: str) -> list:
+    """(function, parameter) calls likely to come after this tool result, the most likely first"""
+    if result.strip() in FAILED_RESULTS:
+        return []
+    if function == "get_incentive_by_id":
+        return [("get_companies_by_incentive", str(parameter).strip())]
+    if function == "get_incentive_by_title":
+        # Only the best match, the other candidates are rarely the one the user picks
+        return [("get_companies_by_incentive", incentive_id) for incentive_id in INCENTIVE_ID_PATTERN.findall(result)[:1]]
+    return []
+
+
+class Entry:
+    def __init__(self, future: Future):
+        self.future = future
+        self.started = time.monotonic()
+        self.duration = None            # seconds the tool took, once done
+        self.expires = self.started + TTL
+
+
+class Prefetcher:
+    def __init__(self, run_function, enabled: bool = ENABLED, concurrency: int = CONCURRENCY,
+                 per_minute: float = PER_MINUTE, per_session: int = PER_SESSION, provider: str = None):
+        self.run_function = run_function        # run_function(function, parameter) -> str
+        self.enabled = enabled
+        self.concurrency = concurrency
+        self.per_session = per_session
+        self.provider = provider                # None: the provider of the LLM_SITE route
+        self.budget = TokenBucket(per_minute)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="prefetch")
+        self.lock = threading.Lock()
+        self.sessions = {}      # session_id -> OrderedDict[(function, parameter)] = Entry
+        self.running = 0
+        self.last_sweep = time.monotonic()
+        self.counters = {
+            "started": 0, "skipped_busy": 0, "skipped_budget": 0, "skipped_provider_queue": 0,
+            "hits": 0, "hits_in_flight": 0, "misses": 0, "expired_unused": 0, "failed": 0,
+            "wait_timeouts": 0,
+        }
+        self.saved_seconds = 0.0
+
+    def purge(self, session_id: str):
+        """Drop the expired results of a session (call with the lock)"""
+        cache = self.sessions.get(session_id)
+        if cache is None:
+            return
+        now = time.monotonic()
+        for key in [key for key, entry in cache.items() if entry.expires < now]:
+            del cache[key]
+            self.counters["expired_unused"] += 1
+        if not cache:
+            del self.sessions[session_id]
+
+    def sweep(self):
+        """Every TTL, drop what expired in the sessions that never came back (call with the lock)"""
+        if time.monotonic() - self.last_sweep < TTL:
+            return
+        self.last_sweep = time.monotonic()
+        for session_id in list(self.sessions):
+            self.purge(session_id)
+
+    def get(self, session_id: str, function: str, parameter: str):
+        """
+        The prefetched result of this call, waiting for it if it's still running (up to PREFETCH_WAIT seconds).
+        None if there is none, or it took too long. The prefetch runs without the request's token,
+        the wait stops (RequestCancelled) when the request is cancelled or past its deadline
+        """
+        if not self.enabled or session_id is None:
+            return None
+        key = (function, str(parameter).strip())
+        with self.lock:
+            self.purge(session_id)
+            entry = self.sessions.get(session_id, {}).pop(key, None)
+            if entry is None:
+                if function in PREFETCHED_FUNCTIONS:
+                    self.counters["misses"] += 1
+                return None
+            in_flight = not entry.future.done()
+        asked = time.monotonic()
+        try:
+            result = singleflight.wait(entry.future, cancellation.current(), WAIT)
+        except cancellation.RequestCancelled:
+            raise
+        except TimeoutError:
+            with self.lock:
+                self.counters["wait_timeouts"] += 1
+            return None
+        except Exception:
+            return None
+        with self.lock:
+            self.counters["hits_in_flight" if in_flight else "hits"] += 1
+            # What the user didn't have to wait: the whole call, or the part that already ran
+            self.saved_seconds += entry.duration if not in_flight else asked - entry.started
+        return result
+
+    def schedule(self, session_id: str, function: str, parameter: str, result: str):
+        """Start the likely follow-ups of a tool result in the background"""
+        if not self.enabled or session_id is None:
+            return
+        for follow_up in follow_ups(function, parameter, result):
+            with self.lock:
+                self.sweep()
+                self.purge(session_id)
+                cache = self.sessions.setdefault(session_id, OrderedDict())
+                if follow_up in cache:
+                    continue
+                if self.running >= self.concurrency:
+                    self.counters["skipped_busy"] += 1
+                    continue
+                if scheduler.provider(self.provider or router.route(LLM_SITE).provider).estimated_wait() > 0:
+                    self.counters["skipped_provider_queue"] += 1
+                    continue
+                if self.budget.wait_time(1) > 0:
+                    self.counters["skipped_budget"] += 1
+                    continue
+                self.budget.acquire(1)
+                self.running += 1
+                self.counters["started"] += 1
+                entry = Entry(Future())
+                cache[follow_up] = entry
+                while len(cache) > self.per_session:
+                    cache.popitem(last=False)
+            # The logs of the prefetch carry the request that triggered it (not its cancel token, it outlives the request)
+            self.executor.submit(self.run, session_id, follow_up, entry, logs.current_request.get())
+
+    def run(self, session_id: str, key: tuple, entry: Entry, request: tuple = None):
+        log_token = logs.current_request.set(request)
+        try:
+            result = self.run_function(*key)
+            entry.duration = time.monotonic() - entry.started
+            if result.strip() in FAILED_RESULTS:
+                raise ValueError(result)
+            entry.future.set_result(result)
+        except Exception as e:
+            entry.future.set_exception(e)
+            with self.lock:
+                self.counters["failed"] += 1
+                cache = self.sessions.get(session_id)
+                if cache is not None and cache.get(key) is entry:
+                    del cache[key]
+        finally:
+            logs.current_request.reset(log_token)
+            with self.lock:
+                self.running -= 1
+
+    def clear(self, session_id: str):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            for session_id in list(self.sessions):
+                self.purge(session_id)
+            hits = self.counters["hits"] + self.counters["hits_in_flight"]
+            follow_up_turns = hits + self.counters["misses"]
+            return {
+                "enabled": self.enabled,
+                **self.counters,
+                "hit_rate": hits / follow_up_turns if follow_up_turns else 0.0,
+                "used_fraction": hits / self.counters["started"] if self.counters["started"] else 0.0,
+                "saved_seconds": round(self.saved_seconds, 3),
+                "saved_ms_per_hit": round(self.saved_seconds / hits * 1000, 1) if hits else None,
+                "running": self.running,
+                "cached": sum(len(cache) for cache in self.sessions.values()),
+                "sessions": len(self.sessions),
+            }
@@ -0,0 +1,219 @@
+"""
+Opt-in profiling of the API (PROFILING=1).
+
+A sample of the requests (PROFILE_SAMPLE_RATE, or any request with the header "X-Profile: 1")
+runs under cProfile, the last PROFILE_KEEP profiles are kept in memory and can be downloaded:
+
+    GET /admin/profiles                 list of the stored profiles
+    GET /admin/profiles/{id}            .prof file (open with snakeviz or pstats)
+    GET /admin/profiles/{id}/text       top functions by cumulative time
+    GET /admin/slow-queries             slow-query log of the database, with EXPLAIN plans (see query_log.py)
+
+The admin endpoints are only mounted if ADMIN_TOKEN is set (they show the SQL and plans of other users' queries),
+and need the header "X-Admin-Token: <token>".
+
+cProfile only sees the thread it runs on, so the request executor of the API is a ProfilingExecutor:
+a job submitted by a sampled request (current_profile is set) runs under its own cProfile on the executor thread,
+and its stats are merged into the profile of the request (chat_turn, analyze_response, rendering, the database calls).
+Work handed to other executors from there (hedged LLM calls, coalesced calls) is not profiled.
+Only one request is profiled at a time, a second sampled request while one is running is skipped.
+"""
+import contextvars
+import cProfile
+import hmac
+import io
+import itertools
+import marshal
+import os
+import pstats
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse, Response
+
+from query_log import slow_query_log
+
+PROFILING = os.getenv("PROFILING", "0") == "1"
+SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0.01))
+KEEP = int(os.getenv("PROFILE_KEEP", 50))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+
+class RequestProfile:
+    """cProfile of a sampled request: one for the event loop and one per executor job it started"""
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def run(self, function, *args):
+        """Runs on the executor thread, under a profiler of its own"""
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already running on this thread
+            return function(*args)
+        try:
+            return function(*args)
+        finally:
+            profiler.disable()
+            with self.lock:
+                self.threads.append(profiler)
+
+    def stats(self) -> dict:
+        """Stats of the event loop and of every executor job, merged (same format as pstats.Stats.stats)"""
+        stats = pstats.Stats(self.profiler)
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for profiler in threads:
+            try:
+                stats.add(profiler)
+            except TypeError:
+                pass    # nothing recorded
+        return stats.stats
+
+
+# Profile of the request being sampled, None for the others
+current_profile = contextvars.ContextVar("profile", default=None)
+
+
+class ProfilingExecutor(ThreadPoolExecutor):
+    """Executor of the requests, the jobs of a sampled request are profiled on the executor thread"""
+
+    def submit(self, function, *args, **kwargs):
+        # Called from the request (run_in_executor), so its context is the current one here
+        profile = current_profile.get()
+        if profile is not None:
+            return super().submit(profile.run, lambda: function(*args, **kwargs))
+        return super().submit(function, *args, **kwargs)
+
+
+class ProfileStore:
+    def __init__(self, keep: int = KEEP):
+        self.profiles = deque(maxlen=keep)
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def add(self, method: str, path: str, status: int, duration: float, profile: RequestProfile):
+        stats = profile.stats()
+        with self.lock:
+            self.profiles.append({
+                "id": next(self.ids),
+                "time": time.time(),
+                "method": method,
+                "path": path,
+                "status": status,
+                "duration_ms": round(duration * 1000, 2),
+                "stats": stats,
+            })
+
+    def list(self) -> list:
+        with self.lock:
+            return [{k: v for k, v in p.items() if k != "stats"} for p in reversed(self.profiles)]
+
+    def get(self, profile_id: int):
+        with self.lock:
+            for profile in self.profiles:
+                if profile["id"] == profile_id:
+                    return profile
+        return None
+
+
+profile_store = ProfileStore()
+
+
+class ProfilingMiddleware:
+    """ASGI middleware, wraps the whole request (including the body of streaming responses)"""
+
+    def __init__(self, app, sample_rate: float = SAMPLE_RATE, store: ProfileStore = profile_store):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.store = store
+        self.busy = threading.Lock()
+
+    def sampled(self, scope) -> bool:
+        if scope["path"].startswith("/admin"):
+            return False
+        forced = (b"x-profile", b"1") in scope.get("headers", [])
+        return forced or random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.sampled(scope) or not self.busy.acquire(blocking=False):
+            return await self.app(scope, receive, send)
+
+        status = {"code": None}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        profile = RequestProfile()
+        context_token = current_profile.set(profile)
+        time_start = time.perf_counter()
+        try:
+            profile.profiler.enable()
+            await self.app(scope, receive, send_with_status)
+        finally:
+            profile.profiler.disable()
+            current_profile.reset(context_token)
+            self.busy.release()
+            self.store.add(scope["method"], scope["path"], status["code"], time.perf_counter() - time_start, profile)
+
+
+def check_admin(token):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not token or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+router = APIRouter(prefix="/admin")
+
+
+@router.get("/profiles")
+async def list_profiles(x_admin_token: str = Header(None)):
+    check_admin(x_admin_token)
+    return {"profiling": PROFILING, "sample_rate": SAMPLE_RATE, "profiles": profile_store.list()}
+
+
+@router.get("/profiles/{profile_id}")
+async def download_profile(profile_id: int, x_admin_token: str = Header(None)):
+    check_admin(x_admin_token)
+    profile = profile_store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    # Same format as pstats.Stats.dump_stats
+    return Response(
+        content=marshal.dumps(profile["stats"]),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="profile_{profile_id}.prof"'}
+    )
+
+
+@router.get("/profiles/{profile_id}/text", response_class=PlainTextResponse)
+async def profile_text(profile_id: int, limit: int = 40, sort: str = "cumulative", x_admin_token: str = Header(None)):
+    check_admin(x_admin_token)
+    profile = profile_store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    output = io.StringIO()
+    stats = pstats.Stats(stream=output)
+    stats.stats = profile["stats"]
+    stats.get_top_level_stats()
+    stats.sort_stats(sort).print_stats(limit)
+    return f"{profile['method']} {profile['path']} ({profile['duration_ms']} ms)\n{output.getvalue()}"
+
+
+@router.get("/slow-queries")
+async def slow_queries(limit: int = 50, x_admin_token: str = Header(None)):
+    check_admin(x_admin_token)
+    log = slow_query_log.snapshot()
+    log["queries"] = log["queries"][:limit]
+    return log
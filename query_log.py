@@ -0,0 +1,164 @@
+"""
+Slow-query log of PostgreSQLManager.
+
+Every connection opened by PostgreSQLManager uses TimedCursor, which times each execute().
+Queries slower than SLOW_QUERY_MS are kept (last SLOW_QUERY_KEEP of them) with:
+    - the SQL (the prepared statement text for EXECUTE), without the parameter values
+    - the shape of the parameters (a 1536 floats vector shows as "ndarray(1536,) float32")
+    - the duration and number of rows
+    - the EXPLAIN (ANALYZE, BUFFERS) plan and the indexes it used, to see for example
+      if a vector search went through the HNSW index or did a sequential scan
+
+Only read queries are explained with ANALYZE (it runs the query again), writes get a plain EXPLAIN.
+The same SQL is explained at most once every SLOW_QUERY_EXPLAIN_INTERVAL seconds.
+
+    SLOW_QUERY_MS=200       (0 disables the log)
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+
+import psycopg2
+import psycopg2.extensions
+
+import logs
+
+INDEX_PATTERN = re.compile(r"(?:Index|Index Only|Bitmap Index) Scan (?:Backward )?using (\w+)")
+READ_STATEMENTS = ("select", "values", "table")
+# a WITH can hide a write, so it only gets a plain EXPLAIN
+EXPLAINABLE_STATEMENTS = READ_STATEMENTS + ("with", "insert", "update", "delete")
+VECTOR_LITERAL_PATTERN = re.compile(r"'\[[-+0-9.e,]{200,}\]'")
+
+log = logs.get_logger(__name__)
+
+
+def describe_value(value) -> str:
+    """Type and size of a parameter, without its content"""
+    shape = getattr(value, "shape", None)
+    if shape is not None:
+        return f"{type(value).__name__}{shape} {value.dtype}"
+    if isinstance(value, (list, tuple, set, dict)):
+        return f"{type(value).__name__}[{len(value)}]"
+    if isinstance(value, (str, bytes)):
+        return f"{type(value).__name__}({len(value)})"
+    return type(value).__name__
+
+
+def describe_params(params):
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: describe_value(value) for key, value in params.items()}
+    return [describe_value(value) for value in params]
+
+
+def query_text(cursor, query) -> str:
+    if isinstance(query, bytes):
+        return query.decode("utf-8", "replace")
+    if not isinstance(query, str):
+        return query.as_string(cursor.connection)     # psycopg2.sql.Composed
+    return query
+
+
+class SlowQueryLog:
+    def __init__(self, threshold_ms: float = None, keep: int = None, explain_interval: float = None):
+        self.threshold_ms = threshold_ms if threshold_ms is not None else float(os.getenv("SLOW_QUERY_MS", 200))
+        self.entries = deque(maxlen=keep or int(os.getenv("SLOW_QUERY_KEEP", 200)))
+        self.explain_interval = explain_interval if explain_interval is not None else float(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL", 60))
+        self.last_explained = {}    # sql -> time of the last EXPLAIN
+        self.lock = threading.Lock()
+        self.total = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold_ms > 0
+
+    def should_explain(self, statement: str) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_explained.get(statement, -self.explain_interval) < self.explain_interval:
+                return False
+            self.last_explained[statement] = now
+            return True
+
+    def explain(self, cursor, query, params, statement: str) -> str:
+        """Plan of the query, run on a separate plain cursor of the same connection"""
+        keyword = statement.lstrip().split(None, 1)[0].lower()
+        if keyword not in EXPLAINABLE_STATEMENTS:
+            return None     # DDL, PREPARE, LISTEN...
+        analyze = keyword in READ_STATEMENTS
+        options = "(ANALYZE, BUFFERS)" if analyze else ""
+        conn = cursor.connection
+        explain_cursor = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+        # Inside a transaction a failed EXPLAIN would abort it, so it goes in a savepoint
+        savepoint = not conn.autocommit
+        try:
+            if savepoint:
+                explain_cursor.execute("SAVEPOINT slow_query_explain")
+            explain_cursor.execute(f"EXPLAIN {options} ".encode() + cursor.mogrify(query, params))
+            plan = "\n".join(row[0] for row in explain_cursor.fetchall())
+            # The vectors inlined in the plan are ~20 KB of digits each
+            plan = VECTOR_LITERAL_PATTERN.sub(lambda m: f"'[{m.group(0).count(',') + 1} floats]'", plan)
+            if savepoint:
+                explain_cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+            return plan
+        except psycopg2.Error as e:
+            if savepoint:
+                explain_cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            return f"EXPLAIN failed: {e}"
+        finally:
+            explain_cursor.close()
+
+    def record(self, cursor, query, params, duration: float):
+        sql_text = query_text(cursor, query)
+        statement = sql_text
+        prepared = re.match(r"\s*EXECUTE\s+(\w+)", sql_text, re.IGNORECASE)
+        if prepared:
+            statement = getattr(cursor.connection, "prepared_statements", {}).get(prepared.group(1), sql_text)
+        statement = " ".join(statement.split())
+        plan = None
+        if self.should_explain(statement):
+            plan = self.explain(cursor, query, params, statement)
+        entry = {
+            "time": time.time(),
+            "duration_ms": round(duration * 1000, 2),
+            "sql": statement[:4000],
+            "prepared": prepared.group(1) if prepared else None,
+            "params": describe_params(params),
+            "rows": cursor.rowcount,
+            "indexes": sorted(set(INDEX_PATTERN.findall(plan))) if plan else None,
+            "plan": plan,
+        }
+        with self.lock:
+            self.entries.append(entry)
+            self.total += 1
+        logs.event(log, logging.WARNING, "slow_query", f"🐢 Slow query ({entry['duration_ms']:.0f} ms): {statement[:120]}",
+                   ms=entry["duration_ms"], rows=entry["rows"], indexes=entry["indexes"])
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {"threshold_ms": self.threshold_ms, "total": self.total, "queries": list(reversed(self.entries))}
+
+
+slow_query_log = SlowQueryLog()
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor that sends the queries slower than the threshold to slow_query_log"""
+
+    def execute(self, query, vars=None):
+        # Named cursors only DECLARE in execute(), the time is spent in the fetches
+        if self.name is not None or not slow_query_log.enabled:
+            return super().execute(query, vars)
+        time_start = time.perf_counter()
+        result = super().execute(query, vars)
+        duration = time.perf_counter() - time_start
+        if duration * 1000 >= slow_query_log.threshold_ms:
+            try:
+                slow_query_log.record(self, query, vars, duration)
+            except Exception as e:
+                log.warning(f"⚠️ Could not record slow query: {e}")
+        return result
@@ -0,0 +1,242 @@
+"""
+Compact, token-budgeted text of the tool results (what analyze_response pastes into the prompt).
+
+The tools used to return indented f-strings with every column: the whole description, the ai_description
+as raw JSON, every document URL... Most of it is never used in the answer but is sent again on every
+continuation call. Here every result is a "card":
+    - fields in order of relevance (id and title, summary, period/budget, description, source), a field is
+      only added if it still fits
+    - long texts are cut at the last sentence that fits (or at a token boundary with "…")
+    - no indentation, empty/None/NaN fields are skipped, the document URLs are only counted
+and every tool has a token budget (tokens counted with tiktoken, encoding of the conversation model):
+    RENDER_BUDGET_GET_INCENTIVE_BY_ID=350  ...  (see BUDGETS)
+Results that don't fit in the budget of the tool are dropped, the first (most relevant) ones are kept.
+
+The incentive cards are built once when the incentives are loaded into the catalog (see IncentiveCatalog),
+so a lookup only does a dict access.
+"""
+import json
+import os
+import re
+from functools import lru_cache
+
+import tiktoken
+
+from outbound import estimate_tokens
+
+MODEL = os.getenv("RENDER_TOKENIZER_MODEL", "gpt-4o-mini")
+
+# Tokens for the whole result of each tool
+BUDGETS = {
+    "get_incentive_by_id": 350,
+    "get_incentive_by_title": 450,
+    "get_company_by_title": 250,
+    "get_companies_by_incentive": 350,
+    "get_incentives_by_company": 200,
+}
+BUDGETS = {function: int(os.getenv(f"RENDER_BUDGET_{function.upper()}", budget)) for function, budget in BUDGETS.items()}
+
+# Card sizes (tokens): a full card for a lookup by id, a short one per result of a search
+CARD_TOKENS = 300
+SHORT_CARD_TOKENS = 110
+# Results of a search after the first SHORT_CARDS only get id + title
+SHORT_CARDS = 3
+# A long field is not started with less than this left (a few words cut with "…" say nothing)
+MIN_FIELD_TOKENS = 12
+
+SPACES = re.compile(r"\s+")
+SENTENCE_END = re.compile(r"(?<=[.!?;])\s")
+
+
+@lru_cache(maxsize=1)
+def encoding():
+    try:
+        return tiktoken.encoding_for_model(MODEL)
+    except Exception as e:
+        # The encoding is downloaded the first time, without it fall back to ~4 characters per token
+        print(f"⚠️ Could not load the tiktoken encoding of {MODEL} ({e}), token counts are estimates")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    enc = encoding()
+    if enc is None:
+        return estimate_tokens(text)
+    return len(enc.encode(text))
+
+
+def clean(value):
+    """Text of a field on one line, None if there is nothing to show (None, NaN, "", [], JSON null...)"""
+    if value is None or isinstance(value, float) and value != value:
+        return None
+    if not isinstance(value, str):
+        value = json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else str(value)
+    # ai_description is a JSON string, sometimes encoded twice
+    for _ in range(2):
+        if value[:1] in ('"', '[', '{'):
+            try:
+                decoded = json.loads(value)
+            except ValueError:
+                break
+            value = decoded if isinstance(decoded, str) else " ".join(str(item) for item in flatten(decoded))
+    value = SPACES.sub(" ", value).strip()
+    return value or None
+
+
+def flatten(value):
+    """Values of a JSON object/list, in order"""
+    if isinstance(value, dict):
+        for item in value.values():
+            yield from flatten(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from flatten(item)
+    elif value is not None:
+        yield value
+
+
+def truncate(text: str, max_tokens: int) -> str:
+    """The text if it fits, otherwise its first sentences that fit, otherwise cut at max_tokens with "…" """
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    kept = ""
+    for sentence in SENTENCE_END.split(text):
+        candidate = f"{kept} {sentence}".strip()
+        if count_tokens(candidate) > max_tokens:
+            break
+        kept = candidate
+    if kept:
+        return kept
+    enc = encoding()
+    if enc is None:
+        return text[:max_tokens * 4 - 1].rstrip() + "…"
+    return enc.decode(enc.encode(text)[:max_tokens - 1]).rstrip() + "…"
+
+
+def card(fields: list, max_tokens: int) -> str:
+    """
+    fields: (label, value, max tokens of the value or None) in order of relevance.
+    A field is added if it fits in what is left, long values are truncated to what is left.
+    """
+    lines = []
+    used = 0
+    for label, value, field_max in fields:
+        value = clean(value)
+        if value is None:
+            continue
+        prefix = f"{label}: "
+        left = max_tokens - used - count_tokens(prefix) - 1    # 1 for the newline
+        if field_max is not None:
+            left = min(left, field_max)
+        if left <= 0:
+            continue
+        if count_tokens(value) > left:
+            if left < MIN_FIELD_TOKENS:
+                continue
+            value = truncate(value, left)
+        if not value:
+            continue
+        lines.append(prefix + value)
+        used += count_tokens(lines[-1]) + 1
+    return "\n".join(lines)
+
+
+def period(incentive: dict) -> str:
+    start, end = incentive.get("start_date"), incentive.get("end_date")
+    if not start and not end:
+        return None
+    return f"{start or '?'} to {end or '?'}"
+
+
+def document_count(document_urls) -> str:
+    urls = clean(document_urls)
+    if urls is None:
+        return None
+    try:
+        count = len(json.loads(document_urls)) if isinstance(document_urls, str) else len(document_urls)
+    except (ValueError, TypeError):
+        count = 1
+    return f"{count} document(s), see the source" if count else None
+
+
+def incentive_card(incentive: dict, max_tokens: int = CARD_TOKENS) -> str:
+    """Card of an incentive, the first two fields always fit"""
+    short = max_tokens < CARD_TOKENS
+    return card([
+        ("Incentive ID", incentive.get("incentive_id"), None),
+        ("Title", incentive.get("title"), 60),
+        ("Summary", incentive.get("ai_description"), 80),
+        ("Period", period(incentive), None),
+        ("Total Budget", incentive.get("total_budget"), None),
+        ("Published", incentive.get("date_publication"), None),
+        ("Description", incentive.get("description"), None),
+        ("Source", None if short else incentive.get("source_link"), 60),
+        ("Documents", None if short else document_count(incentive.get("document_urls")), None),
+    ], max_tokens)
+
+
+def incentive_line(incentive: dict) -> str:
+    return card([
+        ("Incentive ID", incentive.get("incentive_id"), None),
+        ("Title", incentive.get("title"), 40),
+    ], 60)
+
+
+def company_card(company: dict, max_tokens: int = SHORT_CARD_TOKENS) -> str:
+    return card([
+        ("Company Name", company.get("company_name"), 30),
+        ("CAE Primary Label", company.get("cae_primary_label"), 30),
+        ("Trade Description", company.get("trade_description_native"), None),
+        ("Website", company.get("website"), 20),
+    ], max_tokens)
+
+
+def fit(blocks: list, budget: int, header: str = "Possible results:") -> str:
+    """header + the blocks (blank line between them) that fit in the budget, at least the first one"""
+    text = header
+    for i, block in enumerate(blocks):
+        candidate = f"{text}\n\n{block}" if text else block
+        if i > 0 and count_tokens(candidate) > budget:
+            break
+        text = candidate
+    return text
+
+
+def render_incentive(incentive: dict, cards: dict = None) -> str:
+    """Result of get_incentive_by_id (the precomputed card if there is one)"""
+    if cards is not None and incentive["incentive_id"] in cards:
+        return cards[incentive["incentive_id"]][0]
+    return truncate(incentive_card(incentive, min(CARD_TOKENS, BUDGETS["get_incentive_by_id"])), BUDGETS["get_incentive_by_id"])
+
+
+def render_incentives(incentives: list, cards: dict = None, function: str = "get_incentive_by_title") -> str:
+    """Result of a search of incentives: short cards for the best ones, id + title for the others"""
+    blocks = []
+    for i, incentive in enumerate(incentives):
+        precomputed = cards.get(incentive["incentive_id"]) if cards is not None else None
+        if i < SHORT_CARDS:
+            blocks.append(precomputed[1] if precomputed else incentive_card(incentive, SHORT_CARD_TOKENS))
+        else:
+            blocks.append(precomputed[2] if precomputed else incentive_line(incentive))
+    return fit(blocks, BUDGETS[function])
+
+
+def render_companies(companies: list, function: str = "get_company_by_title") -> str:
+    budget = BUDGETS[function]
+    per_company = max(40, min(SHORT_CARD_TOKENS, budget // max(1, len(companies))))
+    return fit([company_card(company, per_company) for company in companies], budget)
+
+
+def build_cards(incentives) -> dict:
+    """incentive_id -> (full card, short card, one line), built when the incentives are (re)loaded"""
+    full_tokens = min(CARD_TOKENS, BUDGETS["get_incentive_by_id"])
+    return {
+        incentive["incentive_id"]: (
+            incentive_card(incentive, full_tokens),
+            incentive_card(incentive, SHORT_CARD_TOKENS),
+            incentive_line(incentive),
+        )
+        for incentive in incentives
+    }
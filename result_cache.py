@@ -0,0 +1,228 @@
+"""
+Cache of the company vector searches by query text (query_companies_with_embedding).
+
+The same question ("empresas de software", the query rewrite of a popular incentive...) is asked over and over,
+and every time it costs an embedding call and a vector search. A hit skips both.
+
+Key: embedding model + normalized query text (lowercase, NFC, single spaces) + top_k + filters (the keyset cursor...).
+Every entry also carries the version of the companies table (data_versions, bumped by the trigger of
+install_change_notifications on every INSERT/UPDATE/DELETE), and only entries of the current version are used:
+when companies are ingested the NOTIFY bumps the version (see change_listener.py) and the old entries are dropped.
+A search that started before the bump is never stored under the new version.
+
+Two tiers:
+    memory      LRU per worker with a byte budget (RESULT_CACHE_MB, size = the JSON of the results)
+    shared      optional UNLOGGED table in Postgres (RESULT_CACHE_SHARED=1), shared by every worker / replica,
+                checked on a memory miss, rows older than RESULT_CACHE_SHARED_TTL seconds are ignored and swept
+RESULT_CACHE=0 disables it.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+
+import psycopg2
+from cachetools import LRUCache
+
+import logs
+
+ENABLED = os.getenv("RESULT_CACHE", "1") == "1"
+MAX_BYTES = int(float(os.getenv("RESULT_CACHE_MB", 64)) * 1024 * 1024)
+SHARED = os.getenv("RESULT_CACHE_SHARED", "0") == "1"
+SHARED_TTL = int(os.getenv("RESULT_CACHE_SHARED_TTL", 86400))
+# Expired shared rows are deleted every this many stores
+SWEEP_EVERY = 1000
+
+SPACES = re.compile(r"\s+")
+
+log = logs.get_logger(__name__)
+
+
+def normalize(text: str) -> str:
+    return SPACES.sub(" ", unicodedata.normalize("NFC", text)).strip().lower()
+
+
+class Entry:
+    def __init__(self, version: int, results: list, size: int):
+        self.version = version
+        self.results = results
+        self.size = size
+
+
+class SharedTier:
+    """The cache table in Postgres, every error is a miss (the search still works without it)"""
+
+    def __init__(self, database, ttl: int = SHARED_TTL):
+        self.database = database
+        self.ttl = ttl
+        self.stores = 0
+
+    def create(self) -> bool:
+        conn = self.database.get_connection(database=self.database.database_name)
+        if not conn:
+            return False
+        try:
+            cursor = conn.cursor()
+            # UNLOGGED: no WAL, it's only a cache (it's emptied if Postgres crashes)
+            cursor.execute("""
+                CREATE UNLOGGED TABLE IF NOT EXISTS search_result_cache (
+                    key TEXT PRIMARY KEY,
+                    version BIGINT NOT NULL,
+                    results JSONB NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """)
+            conn.commit()
+            return True
+        except psycopg2.Error as e:
+            print(f"❌ Error creating the search result cache table: {e}")
+            conn.rollback()
+            return False
+        finally:
+            cursor.close()
+            conn.close()
+
+    def get(self, key: str, version: int):
+        try:
+            with self.database.pooled_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """
+                    SELECT results::text FROM search_result_cache
+                    WHERE key = %s AND version = %s AND created_at > now() - make_interval(secs => %s)
+                    """,
+                    (key, version, self.ttl)
+                )
+                row = cursor.fetchone()
+                cursor.close()
+            return row[0] if row else None
+        except psycopg2.Error as e:
+            log.warning(f"⚠️ Error reading the search result cache: {e}")
+            return None
+
+    def put(self, key: str, version: int, payload: str):
+        self.stores += 1
+        try:
+            with self.database.pooled_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """
+                    INSERT INTO search_result_cache (key, version, results) VALUES (%s, %s, %s)
+                    ON CONFLICT (key) DO UPDATE SET version = EXCLUDED.version, results = EXCLUDED.results, created_at = now()
+                    WHERE search_result_cache.version <= EXCLUDED.version
+                    """,
+                    (key, version, payload)
+                )
+                if self.stores % SWEEP_EVERY == 0:
+                    self.sweep(cursor, version)
+                cursor.close()
+        except psycopg2.Error as e:
+            log.warning(f"⚠️ Error writing the search result cache: {e}")
+
+    def sweep(self, cursor, version: int):
+        cursor.execute(
+            "DELETE FROM search_result_cache WHERE version < %s OR created_at < now() - make_interval(secs => %s)",
+            (version, self.ttl)
+        )
+
+    def drop_older(self, version: int):
+        try:
+            with self.database.pooled_connection() as conn:
+                cursor = conn.cursor()
+                self.sweep(cursor, version)
+                cursor.close()
+        except psycopg2.Error as e:
+            log.warning(f"⚠️ Error sweeping the search result cache: {e}")
+
+
+class ResultCache:
+    def __init__(self, database, max_bytes: int = MAX_BYTES, shared: bool = SHARED):
+        self.database = database
+        self.lock = threading.Lock()
+        self.memory = LRUCache(maxsize=max_bytes, getsizeof=lambda entry: entry.size)
+        self.shared = SharedTier(database) if shared else None
+        self.version = None     # version of the companies table, None until load()
+        self.counters = {
+            "hits_memory": 0, "hits_shared": 0, "misses": 0, "stores": 0,
+            "stale_stores": 0, "too_large": 0, "invalidations": 0,
+        }
+
+    def load(self) -> bool:
+        """Read the current companies version (again), called on every change of the table"""
+        version = self.database.get_data_version("companies")
+        if version is None:
+            return False
+        with self.lock:
+            changed = self.version is not None and version != self.version
+            self.version = version
+            if changed:
+                # Old entries can't be hit anymore, free the memory now instead of waiting for the LRU
+                self.memory.clear()
+                self.counters["invalidations"] += 1
+        if changed and self.shared is not None:
+            self.shared.drop_older(version)
+        return True
+
+    def key(self, model: str, query: str, top_k: int, filters: dict = None) -> str:
+        text = json.dumps([model, normalize(query), top_k, filters or {}], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """(results, version): results is None on a miss, the version is the one to give to put()"""
+        with self.lock:
+            version = self.version
+            entry = self.memory.get(key)
+            if entry is not None and entry.version == version:
+                self.counters["hits_memory"] += 1
+                return [dict(row) for row in entry.results], version
+        if version is not None and self.shared is not None:
+            payload = self.shared.get(key, version)
+            if payload is not None:
+                results = json.loads(payload)
+                self.store(key, version, results, len(payload))
+                with self.lock:
+                    self.counters["hits_shared"] += 1
+                return results, version
+        with self.lock:
+            self.counters["misses"] += 1
+        return None, version
+
+    def put(self, key: str, version: int, results: list):
+        """Store the results of a search that started at this version (dropped if the data changed meanwhile)"""
+        if version is None or results is False:
+            return
+        payload = json.dumps(results, ensure_ascii=False, default=str)
+        if not self.store(key, version, [dict(row) for row in results], len(payload)):
+            return
+        if self.shared is not None:
+            self.shared.put(key, version, payload)
+
+    def store(self, key: str, version: int, results: list, size: int) -> bool:
+        with self.lock:
+            if version != self.version:
+                self.counters["stale_stores"] += 1
+                return False
+            try:
+                self.memory[key] = Entry(version, results, size)
+            except ValueError:
+                # Bigger than the whole budget
+                self.counters["too_large"] += 1
+                return False
+            self.counters["stores"] += 1
+            return True
+
+    def stats(self) -> dict:
+        with self.lock:
+            hits = self.counters["hits_memory"] + self.counters["hits_shared"]
+            lookups = hits + self.counters["misses"]
+            return {
+                "version": self.version,
+                "shared": self.shared is not None,
+                **self.counters,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "entries": len(self.memory),
+                "bytes": self.memory.currsize,
+                "max_bytes": self.memory.maxsize,
+            }
@@ -0,0 +1,411 @@
+"""
+Quality vs speed of the company vector search: what does a faster search mode cost in results?
+
+incentivos_com_empresas.csv has the top-5 companies of every incentive found with the exact search.
+The same incentives are replayed through one or more search backends and, per backend, one line with:
+    recall@k        share of the companies of the CSV that the backend also found
+    ndcg@k          same, but a company of the CSV counts more the higher it is in the CSV and in the results
+    overlap         average overlap of the first 1..k results (1.0 = same companies in the same order)
+    p50/p95 ms      latency of one search
+    qps             searches per second with --threads searches at the same time
+    MB              memory of the vectors of the in-memory backends
+
+Backends (--backends, comma separated):
+    exact           pgvector, exact scan (what the API does, index scans disabled)
+    hnsw:<ef>       pgvector HNSW index with hnsw.ef_search = ef (the index is built if there isn't one, and dropped at the end,
+                    sequential scans are disabled so the index is used even on a small table)
+    memory          numpy, exact, float32 matrix (like IncentiveIndex / all_pairs_matching)
+    float16         numpy, vectors stored as float16 (half the memory, same as a halfvec column)
+    int8            numpy, vectors quantized to int8 per dimension (a quarter of the memory)
+    dims:<d>        numpy, first d dimensions renormalized (what the dimensions=d parameter of text-embedding-3 returns)
+The quantized in-memory backends score on the dequantized vectors: their quality is the real one, their latency is
+the one of a float32 scan. Cached results (result_cache.py) are stored exact results, so caching has no quality cost.
+
+Runs offline: the query vectors of the incentives (LLM rewrite + embedding, same as create_csv_matching) are read
+from incentive_query_vectors.npz, created once by all_pairs_matching (or by this script) if it's not there.
+The LLM rewrite is not deterministic, so the exact backend itself doesn't get 100% of a CSV made with other rewrites:
+compare the backends with the exact line, or use --truth exact to measure them against the exact search of the same vectors.
+
+Examples:
+    python retrieval_bench.py
+    python retrieval_bench.py --backends exact,hnsw:40,hnsw:200,float16,dims:256 --threads 8
+    python retrieval_bench.py --truth exact --output retrieval_bench.csv
+
+--paging N walks N pages of --top-k of the API search (search_companies_by_vector, keyset cursor) through the HNSW
+index for every query and checks that no page comes back short and that no company is repeated or out of order:
+    python retrieval_bench.py --paging 30 --limit 20
+"""
+import argparse
+import csv
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+from all_pairs_matching import load_query_vectors
+from sql import PostgreSQLManager, DB_CONFIG, to_vector
+
+DEFAULT_BACKENDS = "exact,hnsw:40,hnsw:100,memory,float16,int8,dims:512,dims:256"
+BENCH_INDEX = "companies_embeddings_bench_idx"
+
+
+class PostgresBackend:
+    """One connection per benchmark thread, the settings of the backend are set when it's opened"""
+
+    def __init__(self, database: PostgreSQLManager, name: str, settings: list):
+        self.database = database
+        self.name = name
+        self.settings = settings
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def setup(self, k: int):
+        return True
+
+    def memory_mb(self):
+        return None
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.database.get_connection(database=self.database.database_name, autocommit=True)
+            cursor = conn.cursor()
+            for setting in self.settings:
+                cursor.execute(setting)
+            cursor.close()
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def search(self, vector: np.ndarray, k: int) -> list:
+        cursor = self.connection().cursor()
+        cursor.execute(
+            "SELECT company_id FROM companies ORDER BY embeddings <-> %s LIMIT %s",
+            (to_vector(vector), k)
+        )
+        company_ids = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        return company_ids
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+        self.connections = []
+
+
+def build_hnsw_index(database: PostgreSQLManager):
+    """True if the benchmark had to build an HNSW index on companies (to drop at the end), None on error"""
+    conn = database.get_connection(database=database.database_name, autocommit=True)
+    if not conn:
+        return None
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT 1 FROM pg_indexes
+            WHERE tablename = 'companies' AND indexdef ILIKE '%%USING hnsw%%embeddings%%'
+        """)
+        if cursor.fetchone() is not None:
+            return False
+        print(f"🔨 No HNSW index on companies, building {BENCH_INDEX}...")
+        time_start = time.time()
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {BENCH_INDEX} ON companies USING hnsw (embeddings vector_l2_ops)")
+        print(f"✅ Built in {time.time() - time_start:.1f} seconds")
+        return True
+    except psycopg2.Error as e:
+        print(f"❌ Error creating the HNSW index: {e}")
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def drop_hnsw_index(database: PostgreSQLManager):
+    conn = database.get_connection(database=database.database_name, autocommit=True)
+    if not conn:
+        return
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"DROP INDEX IF EXISTS {BENCH_INDEX}")
+        cursor.close()
+    except psycopg2.Error as e:
+        print(f"❌ Error dropping {BENCH_INDEX}: {e}")
+    finally:
+        conn.close()
+
+
+class MemoryBackend:
+    """Brute force over every company embedding in a numpy matrix, optionally quantized / truncated"""
+
+    def __init__(self, database: PostgreSQLManager, name: str, dtype: str = "float32", dims: int = None):
+        self.database = database
+        self.name = name
+        self.dtype = dtype
+        self.dims = dims
+        self.ids = None
+        self.matrix = None      # what is scored (float32, dequantized)
+        self.norms = None
+        self.stored_bytes = 0   # what it would take to keep the vectors in this format
+
+    def setup(self, k: int):
+        ids, blocks = [], []
+        for company_ids, block in self.database.iter_company_embeddings():
+            ids.append(company_ids)
+            blocks.append(self.reduce(block))
+        if not ids:
+            return False
+        self.ids = np.concatenate(ids)
+        matrix = np.concatenate(blocks)
+        if self.dtype == "float16":
+            stored = matrix.astype(np.float16)
+            self.matrix = stored.astype(np.float32)
+        elif self.dtype == "int8":
+            # Symmetric per dimension: x ≈ scale * q, q in [-127, 127]
+            scale = np.maximum(np.abs(matrix).max(axis=0), 1e-12) / 127
+            stored = np.round(matrix / scale).astype(np.int8)
+            self.matrix = stored.astype(np.float32) * scale
+        else:
+            stored = self.matrix = matrix
+        self.stored_bytes = stored.nbytes
+        self.norms = np.einsum("ij,ij->i", self.matrix, self.matrix)
+        return True
+
+    def reduce(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if self.dims is None:
+            return vectors
+        truncated = vectors[:, :self.dims]
+        return truncated / np.maximum(np.linalg.norm(truncated, axis=1, keepdims=True), 1e-12)
+
+    def memory_mb(self):
+        return self.stored_bytes / 1024 / 1024
+
+    def search(self, vector: np.ndarray, k: int) -> list:
+        query = self.reduce(vector)[0]
+        # |q - c|^2 without |q|^2 (same for every company)
+        scores = self.norms - 2.0 * (self.matrix @ query)
+        k = min(k, len(scores))
+        top = np.argpartition(scores, k - 1)[:k]
+        return self.ids[top[np.argsort(scores[top])]].tolist()
+
+    def close(self):
+        self.matrix = None
+
+
+def create_backend(database: PostgreSQLManager, spec: str):
+    name, _, argument = spec.partition(":")
+    if name == "exact":
+        # The API has no index on companies, but a snapshot import builds one: force the exact scan
+        return PostgresBackend(database, "exact", ["SET enable_indexscan = off"])
+    if name == "hnsw":
+        # The embeddings are TOASTed so the planner thinks the sequential scan is cheap, the index has to be forced
+        ef_search = int(argument or 40)
+        return PostgresBackend(database, f"hnsw:{ef_search}", [f"SET hnsw.ef_search = {ef_search}", "SET enable_seqscan = off"])
+    if name == "memory":
+        return MemoryBackend(database, "memory")
+    if name in ("float16", "int8"):
+        return MemoryBackend(database, name, dtype=name)
+    if name == "dims":
+        return MemoryBackend(database, f"dims:{int(argument)}", dims=int(argument))
+    raise ValueError(f"Unknown backend: {spec}")
+
+
+def recall(truth: list, results: list) -> float:
+    return len(set(truth) & set(results)) / len(truth)
+
+
+def ndcg(truth: list, results: list) -> float:
+    """The company ranked r (1..k) in the truth has gain k - r + 1"""
+    k = len(truth)
+    gains = {name: k - rank for rank, name in enumerate(truth)}
+    dcg = sum(gains.get(name, 0) / np.log2(position + 2) for position, name in enumerate(results[:k]))
+    ideal = sum((k - rank) / np.log2(rank + 2) for rank in range(k))
+    return dcg / ideal
+
+
+def overlap(truth: list, results: list) -> float:
+    """Average overlap: mean of |truth[:d] & results[:d]| / d for d = 1..k"""
+    k = len(truth)
+    return float(np.mean([len(set(truth[:d]) & set(results[:d])) / d for d in range(1, k + 1)]))
+
+
+def load_truth(path: str, k: int) -> dict:
+    """incentive_id -> company names of the CSV, best first"""
+    df = pd.read_csv(path)
+    columns = [f"company_{i + 1}" for i in range(k)]
+    truth = {}
+    for row in df.itertuples(index=False):
+        names = [getattr(row, column) for column in columns]
+        names = [name for name in names if isinstance(name, str) and name]
+        if names:
+            truth[int(row.incentive_id)] = names
+    return truth
+
+
+def run_backend(backend, vectors: np.ndarray, k: int, threads: int, warmup: int):
+    """(company ids per query, latency per query in seconds, wall seconds)"""
+    for vector in vectors[:warmup]:
+        backend.search(vector, k)
+
+    def timed(vector):
+        time_start = time.perf_counter()
+        company_ids = backend.search(vector, k)
+        return company_ids, time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(timed, vectors))
+    wall = time.perf_counter() - time_start
+    return [r[0] for r in results], np.array([r[1] for r in results]), wall
+
+
+def check_paging(database: PostgreSQLManager, vectors: np.ndarray, k: int, pages: int) -> bool:
+    """Walk `pages` pages of every query with the keyset cursor, compare them with the exact search"""
+    exact = PostgresBackend(database, "exact", ["SET enable_indexscan = off"])
+    problems = {"short_pages": 0, "repeated": 0, "out_of_order": 0, "errors": 0}
+    recalls = []
+    try:
+        for vector in vectors:
+            after, walked = None, []
+            for _ in range(pages):
+                results = database.search_companies_by_vector(vector, k, after)
+                if results is False:
+                    problems["errors"] += 1
+                    break
+                if len(results) < k:
+                    problems["short_pages"] += 1
+                    break
+                walked.extend((company["distance_score"], company["company_id"]) for company in results)
+                after = walked[-1]
+            ids = [company_id for _, company_id in walked]
+            problems["repeated"] += len(ids) - len(set(ids))
+            problems["out_of_order"] += sum(1 for a, b in zip(walked, walked[1:]) if a >= b)
+            truth = exact.search(vector, k * pages)
+            recalls.append(len(set(ids) & set(truth)) / len(truth) if truth else 1.0)
+    finally:
+        exact.close()
+    print(f"📄 {len(vectors)} queries x {pages} pages of {k}: {problems}, "
+          f"recall vs exact {float(np.mean(recalls)):.4f}")
+    return not any(problems.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall / NDCG / latency of the company search backends")
+    parser.add_argument("--truth", default="incentivos_com_empresas.csv", help="CSV with the top companies per incentive, or 'exact'")
+    parser.add_argument("--queries", default="rewrite", help="same as all_pairs_matching: 'rewrite' (cached .npz), 'incentives' or a .npz file")
+    parser.add_argument("--backends", default=DEFAULT_BACKENDS)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=1, help="searches at the same time (for the qps)")
+    parser.add_argument("--limit", type=int, default=None, help="only the first N incentives")
+    parser.add_argument("--warmup", type=int, default=10, help="searches per backend before measuring")
+    parser.add_argument("--keep-index", action="store_true", help="keep the HNSW index if the benchmark built it")
+    parser.add_argument("--output", default=None, help="also write the table to this CSV")
+    parser.add_argument("--paging", type=int, default=None, help="check N pages of the keyset pagination instead")
+    args = parser.parse_args()
+    if args.paging:
+        # Every connection (also the pool of the API search) skips sequential scans, so the index is used
+        os.environ["PGOPTIONS"] = f"{os.getenv('PGOPTIONS', '')} -c enable_seqscan=off".strip()
+
+    database = PostgreSQLManager(**DB_CONFIG)
+    incentive_ids, _, vectors = load_query_vectors(database, args.queries)
+    specs = [spec.strip() for spec in args.backends.split(",") if spec.strip()]
+
+    if args.truth == "exact":
+        if "exact" not in specs:
+            specs.insert(0, "exact")
+        keep = np.arange(len(incentive_ids))
+        truth = None
+    else:
+        truth = load_truth(args.truth, args.top_k)
+        keep = np.array([i for i, incentive_id in enumerate(incentive_ids) if int(incentive_id) in truth], dtype=int)
+        print(f"🔎 {len(keep)} incentives with query vectors and ground truth "
+              f"({len(truth) - len(keep)} of the CSV have no query vector)")
+    if args.limit:
+        keep = keep[:args.limit]
+    incentive_ids, vectors = incentive_ids[keep], vectors[keep]
+
+    if args.paging:
+        built_index = build_hnsw_index(database)
+        try:
+            ok = built_index is not None and check_paging(database, vectors, args.top_k, args.paging)
+        finally:
+            if built_index and not args.keep_index:
+                drop_hnsw_index(database)
+        raise SystemExit(0 if ok else 1)
+
+    built_index = False
+    if any(spec.startswith("hnsw") for spec in specs):
+        built_index = build_hnsw_index(database)
+        if built_index is None:
+            specs = [spec for spec in specs if not spec.startswith("hnsw")]
+    runs = []
+    try:
+        for spec in specs:
+            backend = create_backend(database, spec)
+            try:
+                if not backend.setup(args.top_k):
+                    print(f"❌ Could not set up {backend.name}, skipped")
+                    continue
+                company_ids, latencies, wall = run_backend(backend, vectors, args.top_k, args.threads, args.warmup)
+                runs.append((backend.name, company_ids, latencies, wall, backend.memory_mb()))
+                print(f"✅ {backend.name}: {len(vectors)} searches in {wall:.2f} seconds")
+            except (psycopg2.Error, ValueError) as e:
+                print(f"❌ {backend.name} failed: {e}")
+            finally:
+                backend.close()
+    finally:
+        if built_index and not args.keep_index:
+            drop_hnsw_index(database)
+
+    all_ids = {company_id for _, results, _, _, _ in runs for row in results for company_id in row}
+    companies = database.query_companies_by_ids(list(all_ids)) or {}
+
+    def names(row):
+        return [companies.get(company_id, {}).get("company_name", "") for company_id in row]
+
+    if truth is None:
+        exact = next(run for run in runs if run[0] == "exact")
+        truth = {int(incentive_id): names(row) for incentive_id, row in zip(incentive_ids, exact[1])}
+
+    table = []
+    for name, results, latencies, wall, memory in runs:
+        scores = [
+            (recall(truth[int(i)], names(row)), ndcg(truth[int(i)], names(row)), overlap(truth[int(i)], names(row)))
+            for i, row in zip(incentive_ids, results)
+        ]
+        table.append({
+            "backend": name,
+            "queries": len(results),
+            f"recall@{args.top_k}": round(float(np.mean([s[0] for s in scores])), 4),
+            f"ndcg@{args.top_k}": round(float(np.mean([s[1] for s in scores])), 4),
+            "overlap": round(float(np.mean([s[2] for s in scores])), 4),
+            "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+            "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 2),
+            "qps": round(len(results) / wall, 1),
+            "MB": round(memory, 1) if memory is not None else None,
+        })
+
+    print(f"\n📊 Search backends vs {args.truth} (top {args.top_k}, {args.threads} thread(s))")
+    columns = list(table[0]) if table else []
+    print("  " + "".join(f"{column:>12}" if i else f"{column:<14}" for i, column in enumerate(columns)))
+    for row in table:
+        print("  " + "".join(
+            f"{'-' if row[column] is None else row[column]:>12}" if i else f"{row[column]:<14}"
+            for i, column in enumerate(columns)
+        ))
+
+    if args.output and table:
+        with open(args.output, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(table)
+        print(f"✅ Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""
+Which model answers each LLM call site, with a latency budget and request hedging.
+
+Call sites:
+    turn            first answer to the user message (api.converse in api_server / main.py)
+    continuation    answer after a tool result (analyze_response)
+    query_rewrite   incentive -> small search query (create_incentive_query)
+
+Every site has a primary model and optionally a hedge model. When the primary hasn't answered within the
+budget of the site (set it around its p95), the same request is sent to the hedge model, the first answer wins
+and the other one is cancelled. Every request of a hedged call has its own child cancel token (see cancellation.py):
+a loser still waiting in the outbound scheduler raises as soon as it gets its slot, without sending anything,
+a loser in flight is aborted (the sockets of its http client are shut down). An answer that arrives anyway
+is thrown away and its tokens counted as hedge waste.
+Hedges are skipped when the hedge provider already has a queue or when more than HEDGE_MAX_FRACTION
+of the recent calls were hedged, so a slow provider doesn't double the load.
+
+    ROUTE_QUERY_REWRITE_MODEL=gpt-4o-mini
+    ROUTE_QUERY_REWRITE_HEDGE_MODEL=deepseek-chat       (none = no hedging)
+    ROUTE_QUERY_REWRITE_BUDGET_MS=1500
+The provider comes from the model name (deepseek-* goes to DeepSeek, see API).
+Without MY_DEEPSEEK_API_KEY the default hedge is a second request to the same model.
+
+stats() has p50/p95/p99 per site, how often hedging happened and won, and the cost per user turn.
+"""
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Queue
+
+import numpy as np
+
+from outbound import scheduler
+import cancellation
+
+SITES = ("turn", "continuation", "query_rewrite")
+DEFAULT_BUDGET_MS = {"turn": 4000, "continuation": 4000, "query_rewrite": 1500}
+HEDGE_MAX_FRACTION = float(os.getenv("HEDGE_MAX_FRACTION", 0.1))
+
+# USD per 1M tokens: (input, cached input, output)
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "deepseek-chat": (0.27, 0.07, 1.10),
+}
+
+
+class Cancelled(Exception):
+    """The other request of a hedged call already answered"""
+
+
+# Reason of the child token of a request that lost the race
+LOST = "hedge_lost"
+
+
+def provider_of(model: str) -> str:
+    return "deepseek" if model.startswith("deepseek") else "openai"
+
+
+def cost_of(model: str, usage) -> float:
+    if usage is None:
+        return 0.0
+    price_input, price_cached, price_output = PRICES.get(model, PRICES["gpt-4o-mini"])
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+    return ((usage.prompt_tokens - cached) * price_input + cached * price_cached + usage.completion_tokens * price_output) / 1e6
+
+
+class Route:
+    def __init__(self, site: str):
+        prefix = f"ROUTE_{site.upper()}"
+        self.site = site
+        self.model = os.getenv(f"{prefix}_MODEL", "gpt-4o-mini")
+        default_hedge = "deepseek-chat" if os.getenv("MY_DEEPSEEK_API_KEY") else self.model
+        hedge = os.getenv(f"{prefix}_HEDGE_MODEL", default_hedge)
+        self.hedge_model = None if hedge.lower() == "none" else hedge
+        self.budget = float(os.getenv(f"{prefix}_BUDGET_MS", DEFAULT_BUDGET_MS.get(site, 4000))) / 1000
+
+    @property
+    def provider(self) -> str:
+        return provider_of(self.model)
+
+
+class SiteStats:
+    def __init__(self, max_samples: int = 1000):
+        self.latencies = deque(maxlen=max_samples)
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.errors = 0
+        self.aborted = 0        # losers cancelled before they answered (queued or in flight)
+        self.cost = 0.0
+        self.wasted_cost = 0.0
+
+    def snapshot(self) -> dict:
+        latencies = list(self.latencies)
+        p50, p95, p99 = [round(float(p) * 1000, 1) for p in np.percentile(latencies, (50, 95, 99))] if latencies else (None, None, None)
+        return {
+            "calls": self.calls,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "errors": self.errors,
+            "hedges_aborted": self.aborted,
+            "p50_ms": p50, "p95_ms": p95, "p99_ms": p99,
+            "cost_usd": round(self.cost, 6),
+            "hedge_waste_usd": round(self.wasted_cost, 6),
+        }
+
+
+class HedgedCall:
+    """The requests of one call, the first answer is the result"""
+
+    def __init__(self, router, site: str, messages: list):
+        self.router = router
+        self.site = site
+        self.messages = [dict(message) for message in messages]    # the caller keeps appending to its list
+        self.cancelled = threading.Event()
+        self.results = Queue()
+        self.started = 0
+        self.winner = None
+        self.tokens = []        # child cancel token of every request
+        self.lock = threading.Lock()
+
+    def start(self, model: str):
+        self.started += 1
+        # A child of the token of the request (see cancellation.py), so this request alone can be aborted
+        parent = cancellation.current()
+        token = parent.child() if parent is not None else cancellation.CancelToken(timeout=None, counted=False)
+        with self.lock:
+            self.tokens.append(token)
+        context = contextvars.copy_context()
+        self.router.executor.submit(context.run, self.attempt, model, self.started > 1, token)
+
+    def attempt(self, model: str, hedge: bool, token: cancellation.CancelToken):
+        cancellation.current_token.set(token)
+        try:
+            if self.cancelled.is_set():
+                raise Cancelled()
+            # create_completion checks the token once the scheduler gives it a slot, and aborts the request in flight
+            response = self.router.client(model).create_completion(self.messages)
+            self.finished(model, hedge, token, response, None)
+        except cancellation.RequestCancelled as e:
+            if token.reason == LOST:
+                self.router.record_aborted(self.site)
+                e = Cancelled()
+            self.finished(model, hedge, token, None, e)
+        except Exception as e:
+            self.finished(model, hedge, token, None, e)
+        finally:
+            token.close()
+
+    def finished(self, model: str, hedge: bool, token: cancellation.CancelToken, response, error):
+        with self.lock:
+            won = self.winner is None and error is None
+            if won:
+                self.winner = hedge
+                self.cancelled.set()
+                losers = [other for other in self.tokens if other is not token]
+        if won:
+            for loser in losers:
+                loser.cancel(LOST)
+        if response is not None and not won:
+            self.router.record_waste(self.site, cost_of(model, response.usage))
+        self.results.put((model, hedge, response, error))
+
+
+class Router:
+    def __init__(self, client_factory=None, max_workers: int = 64):
+        self.routes = {site: Route(site) for site in SITES}
+        self.client_factory = client_factory
+        self.clients = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+        self.lock = threading.Lock()
+        self.sites = {site: SiteStats() for site in SITES}
+        self.recent_hedges = deque(maxlen=200)
+
+    def route(self, site: str) -> Route:
+        return self.routes.get(site) or self.routes.setdefault(site, Route(site))
+
+    def client(self, model: str):
+        """One API per model (the OpenAI clients are thread safe)"""
+        with self.lock:
+            if model not in self.clients:
+                if self.client_factory is None:
+                    from api import API
+                    self.clients[model] = API(model)
+                else:
+                    self.clients[model] = self.client_factory(model)
+            return self.clients[model]
+
+    def can_hedge(self, route: Route) -> bool:
+        if route.hedge_model is None:
+            return False
+        with self.lock:
+            if self.recent_hedges and sum(self.recent_hedges) / len(self.recent_hedges) >= HEDGE_MAX_FRACTION:
+                return False
+        return scheduler.provider(provider_of(route.hedge_model)).estimated_wait() <= 0
+
+    def complete(self, site: str, messages: list):
+        """ChatCompletion for the messages from the model(s) of this call site"""
+        route = self.route(site)
+        time_start = time.monotonic()
+        if route.hedge_model is None:
+            try:
+                response = self.client(route.model).create_completion(messages)
+            except Exception:
+                self.record(site, route.model, None, time.monotonic() - time_start, hedged=False, hedge_won=False)
+                raise
+            self.record(site, route.model, response, time.monotonic() - time_start, hedged=False, hedge_won=False)
+            return response
+
+        call = HedgedCall(self, site, messages)
+        call.start(route.model)
+        hedged = False
+        try:
+            model, hedge, response, error = call.results.get(timeout=route.budget)
+        except Empty:
+            if self.can_hedge(route):
+                hedged = True
+                call.start(route.hedge_model)
+            model, hedge, response, error = call.results.get()
+        errors = []
+        # The first request failed, the other one can still answer
+        while error is not None:
+            if isinstance(error, cancellation.RequestCancelled):
+                raise error
+            errors.append(error)
+            if len(errors) == call.started:
+                if not hedged and self.can_hedge(route):
+                    hedged = True
+                    call.start(route.hedge_model)
+                else:
+                    self.record(site, route.model, None, time.monotonic() - time_start, hedged, False)
+                    raise errors[0]
+            model, hedge, response, error = call.results.get()
+        with self.lock:
+            self.recent_hedges.append(hedged)
+        self.record(site, model, response, time.monotonic() - time_start, hedged, hedge)
+        return response
+
+    def record(self, site: str, model: str, response, latency: float, hedged: bool, hedge_won: bool):
+        with self.lock:
+            stats = self.sites.setdefault(site, SiteStats())
+            stats.calls += 1
+            stats.hedged += hedged
+            stats.hedge_wins += hedge_won
+            if response is None:
+                stats.errors += 1
+                return
+            stats.latencies.append(latency)
+            stats.cost += cost_of(model, response.usage)
+
+    def record_aborted(self, site: str):
+        with self.lock:
+            self.sites[site].aborted += 1
+
+    def record_waste(self, site: str, cost: float):
+        with self.lock:
+            self.sites[site].wasted_cost += cost
+
+    def stats(self) -> dict:
+        with self.lock:
+            sites = {site: stats.snapshot() for site, stats in self.sites.items()}
+            turns = self.sites["turn"].calls
+        total = sum(site["cost_usd"] + site["hedge_waste_usd"] for site in sites.values())
+        return {
+            "routes": {
+                site: {"model": route.model, "hedge_model": route.hedge_model, "budget_ms": route.budget * 1000}
+                for site, route in self.routes.items()
+            },
+            "sites": sites,
+            "total_cost_usd": round(total, 6),
+            "cost_per_turn_usd": round(total / turns, 6) if turns else None,
+        }
+
+
+router = Router()
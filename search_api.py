@@ -0,0 +1,151 @@
+"""
+Direct REST endpoints to the data, so front-ends and batch integrations don't need to go through /chat (and the LLM).
+
+- Keyset pagination: every page returns a "next_cursor" that is passed back as ?cursor= to get the next page
+- Responses have an ETag and Cache-Control, a request with a matching If-None-Match gets a 304 without body
+"""
+import asyncio
+import base64
+import hashlib
+import json
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+
+from tool_calling import database, incentive_index
+from singleflight import SingleFlight
+
+router = APIRouter()
+
+MAX_PAGE_SIZE = 100
+INCENTIVE_MAX_AGE = 300     # incentives almost never change
+SEARCH_MAX_AGE = 60
+
+# Identical /companies/search requests at the same time wait for the same result without holding a thread
+company_search_requests = SingleFlight("company_search_requests")
+
+
+def encode_cursor(score: float, row_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([score, row_id]).encode()).decode()
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[tuple]:
+    if not cursor:
+        return None
+    try:
+        score, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(score), int(row_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match is "*" or a comma-separated list of ETags (weak ones compare equal too)"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+def cached_json(request: Request, payload, max_age: int) -> Response:
+    """Compact JSON response with ETag/Cache-Control, 304 if the client already has this version"""
+    body = json.dumps(jsonable_encoder(payload), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={max_age}"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def page(items: list, limit: int, score_key: str, id_key: str) -> dict:
+    next_cursor = None
+    if len(items) == limit:
+        next_cursor = encode_cursor(items[-1][score_key], items[-1][id_key])
+    return {"items": items, "next_cursor": next_cursor}
+
+
+async def run(function, *args):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, function, *args)
+
+
+def search_companies_by_text(q: str, top_k: int, after: tuple):
+    return database.query_companies_with_embedding(q, top_k, after)
+
+
+# /incentives/search has to be declared before /incentives/{incentive_id}
+@router.get("/incentives/search")
+async def search_incentives(
+    request: Request,
+    q: str = Query(..., min_length=1),
+    limit: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    mode: str = Query("hybrid", pattern="^(hybrid|trigram)$")
+):
+    """
+    Incentives that best match the text.
+    mode=hybrid: semantic (embeddings of title + description + ai_description) + title similarity, see incentive_index.py
+    mode=trigram: title similarity only
+    """
+    if mode == "hybrid":
+        results = await run(incentive_index.hybrid_search, q, limit, decode_cursor(cursor))
+    else:
+        results = await run(database.query_incentives_by_name, q, 0.0, limit, decode_cursor(cursor))
+    if results is False:
+        raise HTTPException(status_code=500, detail="Error querying database")
+    return cached_json(request, page(results or [], limit, "similarity_score", "incentive_id"), SEARCH_MAX_AGE)
+
+
+@router.get("/incentives/{incentive_id}")
+async def get_incentive(request: Request, incentive_id: int):
+    """
+    One incentive by its ID
+    """
+    result = await run(database.query_incentives_by_id, incentive_id)
+    if result is False:
+        raise HTTPException(status_code=500, detail="Error querying database")
+    if result is None:
+        raise HTTPException(status_code=404, detail="Incentive not found")
+    return cached_json(request, result, INCENTIVE_MAX_AGE)
+
+
+@router.get("/incentives/{incentive_id}/companies")
+async def get_incentive_companies(
+    request: Request,
+    incentive_id: int,
+    top_k: int = Query(5, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    """
+    Companies closest to the incentive embedding (no LLM query rewrite)
+    """
+    vector = await run(incentive_index.vector, incentive_id)
+    if vector is False:
+        raise HTTPException(status_code=503, detail="Incentive index unavailable")
+    if vector is None:
+        incentive = await run(database.query_incentives_by_id, incentive_id)
+        if incentive is False:
+            raise HTTPException(status_code=500, detail="Error querying database")
+        raise HTTPException(status_code=404, detail="Incentive has no embedding" if incentive else "Incentive not found")
+    results = await run(database.query_companies_by_vector, vector, top_k, decode_cursor(cursor))
+    if results is False:
+        raise HTTPException(status_code=500, detail="Error querying database")
+    return cached_json(request, page(results, top_k, "distance_score", "company_id"), SEARCH_MAX_AGE)
+
+
+@router.get("/companies/search")
+async def search_companies(
+    request: Request,
+    q: str = Query(..., min_length=1),
+    top_k: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    """
+    Companies closest to the query (embedding similarity search)
+    """
+    after = decode_cursor(cursor)
+    results = await company_search_requests.do_async((q, top_k, after), search_companies_by_text, q, top_k, after)
+    if results is False:
+        raise HTTPException(status_code=500, detail="Error querying database")
+    return cached_json(request, page(results, top_k, "distance_score", "company_id"), SEARCH_MAX_AGE)
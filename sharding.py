@@ -0,0 +1,315 @@
+"""
+Companies split over N Postgres shards (separate databases, on the same instance or on different hosts).
+
+PostgreSQLManager uses the shards when COMPANY_SHARDS is set (host:port/database, comma separated):
+    COMPANY_SHARDS="localhost:5432/augusta_labs_db_shard_0,localhost:5432/augusta_labs_db_shard_1"
+
+- The shard of a company is a stable hash of its name, so the rows are spread evenly and
+  the "does this company already exist" check of the ingestion only looks at one shard
+- Vector searches run on every shard in parallel (each shard returns its own top k,
+  the global top k is the k smallest of those), same for the lookups by id
+- Each shard has its own company_id sequence, interleaved (shard i of N gives i+1, i+1+N, ...)
+  so the ids stay unique across shards
+- The incentives stay in the main database
+- Each shard has its own pool of DB_POOL_SIZE threads (as many as its connections), so the requests running
+  at the same time are not queued behind one thread per shard
+
+Local test with several databases on one Postgres:
+    python sharding.py setup --shards 4          creates the shards and copies the companies of the main database
+    python sharding.py bench --shards 1 2 4 8    search latency as shards are added
+"""
+import argparse
+import heapq
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from statistics import median
+
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+from incentive_catalog import trigrams
+
+# Threads per shard, the same as the connections of its pool (sql.py imports this module, it can't import sql.POOL_SIZE)
+SHARD_WORKERS = int(os.getenv("DB_POOL_SIZE", 10))
+
+COMPANY_COLUMNS = ["company_id", "company_name", "cae_primary_label", "trade_description_native", "website"]
+
+
+def parse_shards(config: str) -> list:
+    """'host:port/database,...' -> [(host, port, database), ...]"""
+    shards = []
+    for entry in config.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        address, database = entry.rsplit("/", 1)
+        host, _, port = address.partition(":")
+        shards.append((host, int(port or 5432), database))
+    return shards
+
+
+def shard_of(company_name: str, shard_count: int) -> int:
+    """Shard of a company (crc32 and not hash() because hash() changes between processes)"""
+    return zlib.crc32((company_name or "").encode("utf-8")) % shard_count
+
+
+def name_similarity(a: str, b: str) -> float:
+    """Same score as similarity() of pg_trgm"""
+    trigrams_a, trigrams_b = trigrams(a or ""), trigrams(b or "")
+    if not trigrams_a or not trigrams_b:
+        return 0.0
+    shared = len(trigrams_a & trigrams_b)
+    return shared / (len(trigrams_a) + len(trigrams_b) - shared)
+
+
+class ShardedCompanies:
+    def __init__(self, shards: list):
+        self.shards = shards        # a PostgreSQLManager per shard
+        self.executors = [
+            ThreadPoolExecutor(max_workers=SHARD_WORKERS, thread_name_prefix=f"shard{i}") for i in range(len(shards))
+        ]
+
+    @classmethod
+    def from_config(cls, config: str, manager_class, user: str, password: str):
+        return cls([
+            manager_class(host=host, port=port, user=user, password=password, database_name=database, company_shards=None)
+            for host, port, database in parse_shards(config)
+        ])
+
+    def on_shards(self, calls: list) -> list:
+        """calls: (shard index, function(shard)), run in parallel on the executor of each shard, the results in order"""
+        futures = [self.executors[i].submit(function, self.shards[i]) for i, function in calls]
+        return [future.result() for future in futures]
+
+    def scatter(self, method: str, *args):
+        """Call the same PostgreSQLManager method on every shard in parallel, False if any shard failed"""
+        results = self.on_shards([(i, lambda shard: getattr(shard, method)(*args)) for i in range(len(self.shards))])
+        if any(result is False for result in results):
+            print(f"❌ {method} failed on at least one shard")
+            return False
+        return results
+
+    def search(self, embedding_query, top_k: int = 5, after: tuple = None):
+        """Global top k: the k closest of the top k of each shard (keyset pagination works the same way)"""
+        results = self.scatter("search_companies_by_vector", embedding_query, top_k, after)
+        if results is False:
+            return False
+        return heapq.nsmallest(
+            top_k,
+            (company for shard_results in results for company in shard_results),
+            key=lambda company: (company["distance_score"], company["company_id"])
+        )
+
+    def companies_by_ids(self, company_ids: list):
+        results = self.scatter("query_companies_by_ids", company_ids)
+        if results is False:
+            return False
+        return {company_id: company for shard_results in results for company_id, company in shard_results.items()}
+
+    def embeddings(self, company_ids: list):
+        results = self.scatter("get_company_embeddings", company_ids)
+        if results is False:
+            return False
+        return {company_id: vector for shard_results in results for company_id, vector in shard_results.items()}
+
+    def company_by_name(self, company_name: str):
+        """Exact name on the shard of that name, otherwise the most similar name over every shard"""
+        own = self.shards[shard_of(company_name, len(self.shards))].query_company_by_name(company_name)
+        if own and own["company_name"] == company_name:
+            return own
+        results = self.scatter("query_company_by_name", company_name)
+        if results is False:
+            return False
+        candidates = [company for company in results if company]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda company: name_similarity(company["company_name"], company_name))
+
+    def iter_embeddings(self, block_size: int = 10000):
+        for shard in self.shards:
+            yield from shard.iter_company_embeddings(block_size)
+
+    def existing_company_names(self, company_names) -> set:
+        """Names that are already in the shards, each name is only looked up in its own shard"""
+        by_shard = self.route(company_names, lambda name: name)
+        existing = set()
+        for shard_index, names in by_shard.items():
+            shard = self.shards[shard_index]
+            conn = shard.get_connection(database=shard.database_name)
+            if not conn:
+                continue
+            try:
+                existing |= shard.get_existing_company_names(conn.cursor(), names)
+            finally:
+                conn.close()
+        return existing
+
+    def route(self, items, name_of) -> dict:
+        """shard index -> items of that shard"""
+        by_shard = {}
+        for item in items:
+            by_shard.setdefault(shard_of(name_of(item), len(self.shards)), []).append(item)
+        return by_shard
+
+    def insert(self, companies: list) -> bool:
+        """Insert companies (with embeddings) into their shards, in parallel"""
+        by_shard = self.route(companies, lambda company: company.get("company_name"))
+        results = self.on_shards([
+            (i, lambda shard, rows=rows: shard.insert_company_rows(rows)) for i, rows in by_shard.items()
+        ])
+        return all(results)
+
+    def upsert(self, companies: list):
+        """Upsert companies (with embeddings) into their shards, the company_id of each one (same order), False on error"""
+        by_shard = self.route(companies, lambda company: company.get("company_name"))
+        results = self.on_shards([
+            (i, lambda shard, rows=rows: (rows, shard.upsert_company_rows(rows))) for i, rows in by_shard.items()
+        ])
+        if any(company_ids is False for _, company_ids in results):
+            return False
+        ids = {}
+        for shard_companies, company_ids in results:
+            ids.update(zip((company["company_name"] for company in shard_companies), company_ids))
+        return [ids.get(company["company_name"]) for company in companies]
+
+
+def setup_local_shards(database, shard_count: int, prefix: str = None, index: bool = True) -> str:
+    """
+    Create shard_count databases on the same Postgres as `database`, copy its companies into them
+    (routed by name) and return the COMPANY_SHARDS value to use them
+    """
+    from sql import PostgreSQLManager, TABLE_COMPANIES_SCHEMA, create_company_name_indexes
+
+    prefix = prefix or f"{database.database_name}_shard"
+    params = database.connection_params
+    shards = []
+    for i in range(shard_count):
+        shard = PostgreSQLManager(
+            host=params["host"], port=params["port"], user=params["user"], password=params["password"],
+            database_name=f"{prefix}_{i}", company_shards=None
+        )
+        if not shard.database_exists():
+            # UTF8 whatever the encoding of template1 is (company names have accents)
+            conn = shard.get_connection(autocommit=True)
+            conn.cursor().execute(
+                sql.SQL("CREATE DATABASE {} TEMPLATE template0 ENCODING 'UTF8'").format(sql.Identifier(shard.database_name))
+            )
+            conn.close()
+        conn = shard.get_connection(database=shard.database_name)
+        cursor = conn.cursor()
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS vector")
+        # similarity() of query_company_by_name, if the server has it
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        if cursor.fetchone():
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cursor.execute("DROP TABLE IF EXISTS companies")
+        cursor.execute(TABLE_COMPANIES_SCHEMA)
+        cursor.execute("ALTER SEQUENCE companies_company_id_seq INCREMENT BY %s", (shard_count,))
+        conn.commit()
+        conn.close()
+        shards.append(shard)
+
+    # Copy the companies, keeping their ids, in batches per shard
+    time_start = time.time()
+    columns = COMPANY_COLUMNS + ["embeddings"]
+    conns = [shard.get_connection(database=shard.database_name) for shard in shards]
+    batches = [[] for _ in shards]
+    max_id = 0
+
+    def flush(i):
+        execute_values(
+            conns[i].cursor(),
+            f"INSERT INTO companies ({', '.join(columns)}) VALUES %s",
+            batches[i],
+            template="(%s, %s, %s, %s, %s, %s::vector)"
+        )
+        batches[i].clear()
+
+    total = 0
+    for row in database.iter_query(f"SELECT {', '.join(columns)} FROM companies"):
+        i = shard_of(row[1], shard_count)
+        batches[i].append(row)
+        max_id = max(max_id, row[0])
+        total += 1
+        if len(batches[i]) >= 1000:
+            flush(i)
+    for i, conn in enumerate(conns):
+        if batches[i]:
+            flush(i)
+        cursor = conn.cursor()
+        # Next id of shard i: the first value > max_id with value % N == (i + 1) % N
+        next_id = max_id + 1 + ((i + 1 - (max_id + 1)) % shard_count)
+        cursor.execute("SELECT setval('companies_company_id_seq', %s, false)", (next_id,))
+        if index:
+            cursor.execute("CREATE INDEX IF NOT EXISTS companies_embeddings_idx ON companies USING hnsw (embeddings vector_l2_ops)")
+        create_company_name_indexes(cursor)
+        conn.commit()
+        cursor.execute("ANALYZE companies")
+        conn.commit()
+        conn.close()
+    print(f"✅ Copied {total} companies into {shard_count} shards in {time.time() - time_start:.1f} seconds")
+    return ",".join(f"{params['host']}:{params['port']}/{shard.database_name}" for shard in shards)
+
+
+def bench(database, shard_counts: list, queries: int, top_k: int, index: bool):
+    """Search latency of the main database vs the same companies split over N shards"""
+    from sql import PostgreSQLManager
+
+    rows = database.general_query(
+        "SELECT company_id FROM companies WHERE embeddings IS NOT NULL ORDER BY random() LIMIT %s", (queries,)
+    )
+    vectors = database.get_company_embeddings([row[0] for row in rows])
+    query_vectors = list(vectors.values())
+
+    def measure(search) -> dict:
+        search(query_vectors[0], top_k)     # connections and prepared statements
+        latencies = []
+        for vector in query_vectors:
+            time_start = time.perf_counter()
+            search(vector, top_k)
+            latencies.append(time.perf_counter() - time_start)
+        latencies.sort()
+        return {"p50_ms": median(latencies) * 1000, "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000}
+
+    # Each shard search runs on its own Postgres backend, the speedup is bounded by the cores of the server(s)
+    print(f"{len(query_vectors)} queries, top {top_k}, {os.cpu_count()} cores on this machine")
+    baseline = measure(database.search_companies_by_vector)
+    expected = [[c["company_id"] for c in database.search_companies_by_vector(v, top_k)] for v in query_vectors]
+    print(f"1 database:  p50 {baseline['p50_ms']:.2f} ms  p95 {baseline['p95_ms']:.2f} ms")
+    params = database.connection_params
+    for shard_count in shard_counts:
+        config = setup_local_shards(database, shard_count, f"{database.database_name}_bench{shard_count}", index)
+        sharded = ShardedCompanies.from_config(config, PostgreSQLManager, params["user"], params["password"])
+        result = measure(sharded.search)
+        got = [[c["company_id"] for c in sharded.search(v, top_k)] for v in query_vectors]
+        same = sum(a == b for a, b in zip(expected, got)) / len(expected)
+        print(
+            f"{shard_count} shards:    p50 {result['p50_ms']:.2f} ms  p95 {result['p95_ms']:.2f} ms  "
+            f"speedup {baseline['p50_ms'] / result['p50_ms']:.2f}x  same top {top_k}: {same:.0%}"
+        )
+
+
+if __name__ == "__main__":
+    from sql import PostgreSQLManager
+
+    parser = argparse.ArgumentParser(description="Company shards on one Postgres instance (local testing)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    setup_parser = subparsers.add_parser("setup", help="create the shards and copy the companies of the main database")
+    setup_parser.add_argument("--shards", type=int, default=4)
+    setup_parser.add_argument("--no-index", action="store_true", help="don't build the HNSW index on the shards")
+    bench_parser = subparsers.add_parser("bench", help="search latency as shards are added")
+    bench_parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    bench_parser.add_argument("--queries", type=int, default=50)
+    bench_parser.add_argument("--top-k", type=int, default=5)
+    bench_parser.add_argument("--index", action="store_true",
+                              help="build the HNSW index on the shards (by default exact search, like the main database without index)")
+    args = parser.parse_args()
+
+    database = PostgreSQLManager(company_shards=None)
+    if args.command == "setup":
+        config = setup_local_shards(database, args.shards, index=not args.no_index)
+        print(f'COMPANY_SHARDS="{config}"')
+    else:
+        bench(database, args.shards, args.queries, args.top_k, args.index)
@@ -0,0 +1,135 @@
+"""
+Request coalescing ("single flight").
+
+While a call with some key is in flight, other callers with the same key don't start their own call,
+they wait for the result of the first one. Useful when many users ask about the same thing at the same time
+(same embedding, same vector search, same incentive).
+
+Works from threads (do) and from async code (do_async), both share the same in-flight table,
+so an async request can piggyback on a call started by a thread and vice versa.
+
+The shared call belongs to no request: it runs without a cancel token (see cancellation.py), so one client that
+goes away doesn't cancel the statement or the embedding that the other callers are waiting for. A caller with a
+token starts the call in a thread of its own and waits for it until its own deadline or cancellation.
+"""
+import asyncio
+import contextvars
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from threading import Lock
+
+import cancellation
+
+# Threads of the calls started by requests with a cancel token
+WORKERS = int(os.getenv("SINGLEFLIGHT_WORKERS", 64))
+executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="singleflight")
+
+# name -> SingleFlight, for the metrics
+REGISTRY = {}
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = Lock()
+        self.inflight = {}      # key -> concurrent.futures.Future
+        self.calls = 0          # calls that were actually executed
+        self.collapsed = 0      # calls that waited for someone else's result
+        REGISTRY[name] = self
+
+    def join(self, key):
+        """Returns (future, leader), the leader is the one that has to run the call"""
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is not None:
+                self.collapsed += 1
+                return future, False
+            future = Future()
+            self.inflight[key] = future
+            self.calls += 1
+            return future, True
+
+    def run_leader(self, key, future: Future, function, *args, **kwargs):
+        try:
+            result = function(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+
+    def run_detached(self, key, future: Future, function, *args, **kwargs):
+        try:
+            self.run_leader(key, future, function, *args, **kwargs)
+        except BaseException:
+            pass  # the error gets to every caller through the future
+
+    def do(self, key, function, *args, **kwargs):
+        """Run function(*args, **kwargs), or wait for the identical call that is already running"""
+        token = cancellation.current()
+        while True:
+            future, leader = self.join(key)
+            if leader:
+                if token is None:
+                    return self.run_leader(key, future, function, *args, **kwargs)
+                # Without the token of this request (an empty context), the result is for every caller
+                executor.submit(contextvars.Context().run, self.run_detached, key, future, function, *args, **kwargs)
+            try:
+                return wait(future, token)
+            except cancellation.RequestCancelled:
+                if token is not None and token.cancelled:
+                    raise
+                # Cancelled by a token that is not ours (a call started before this change), run it again
+                continue
+
+    async def do_async(self, key, function, *args):
+        """Same as do, but waits without blocking the event loop (function is sync and runs in the executor)"""
+        future, leader = self.join(key)
+        if leader:
+            loop = asyncio.get_event_loop()
+            loop.run_in_executor(None, self.run_detached, key, future, function, *args)
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.calls + self.collapsed
+            return {
+                "calls": self.calls,
+                "collapsed": self.collapsed,
+                "collapsed_fraction": self.collapsed / total if total else 0.0,
+                "in_flight": len(self.inflight),
+            }
+
+
+def wait(future: Future, token: cancellation.CancelToken = None, timeout: float = None):
+    """
+    Result of the shared call, the caller stops waiting at its own deadline or when it's cancelled.
+    timeout: also stops waiting after that many seconds, raises TimeoutError (the call goes on)
+    """
+    if token is None:
+        return future.result(timeout)
+    woken = threading.Event()
+    future.add_done_callback(lambda _: woken.set())
+    unregister = token.on_cancel(woken.set)
+    remaining = token.remaining()
+    by_timeout = timeout is not None and (remaining is None or timeout < remaining)
+    try:
+        woken.wait(timeout if by_timeout else remaining)
+    finally:
+        unregister()
+    if future.done():
+        return future.result()
+    # The call goes on for the other callers
+    token.check()
+    if by_timeout:
+        raise TimeoutError()
+    token.cancel("deadline")
+    raise cancellation.RequestCancelled(token.reason)
+
+
+def stats() -> dict:
+    return {name: flight.stats() for name, flight in REGISTRY.items()}
@@ -0,0 +1,424 @@
+"""
+Compact snapshot of the database, to bootstrap a deployment without pg_restore or re-embedding the companies.
+
+A snapshot is a directory with:
+    manifest.json
+    incentives.parquet              incentive metadata (ai_description as JSON text)
+    incentive_embeddings.npy        (n_incentives, 1536) float32, same row order as the parquet
+    companies.parquet               company metadata + has_embedding, sorted by company_id
+    company_embeddings.npy          (n_companies, 1536) float32, zeros where has_embedding is false
+
+Import streams the companies in with parallel binary COPY (one process per group of parquet row groups),
+and only builds the primary keys, the HNSW indexes and the triggers after the data is in.
+
+In-process consumers can use the snapshot without any database: Snapshot has the same methods
+PostgreSQLManager offers to IncentiveCatalog, IncentiveIndex and all_pairs_matching
+(the embeddings are memory mapped, so opening a snapshot is instant).
+
+Examples:
+    python snapshot.py export snapshots/2025-10-15
+    python snapshot.py import snapshots/2025-10-15 --workers 4 [--replace]
+    python snapshot.py load snapshots/2025-10-15         # cold start of the in-memory indexes from the snapshot
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import struct
+import time
+
+import numpy as np
+import pyarrow
+import pyarrow.parquet
+import psycopg2
+from psycopg2 import sql
+
+from sql import PostgreSQLManager, TABLE_INCENTIVES_SCHEMA, TABLE_COMPANIES_SCHEMA, binary_vectors, create_company_name_indexes
+
+FORMAT_VERSION = 1
+DIM = 1536
+ROW_GROUP_SIZE = 20000
+
+INCENTIVE_COLUMNS = [
+    "incentive_id", "title", "description", "ai_description", "document_urls",
+    "date_publication", "start_date", "end_date", "total_budget", "source_link"
+]
+COMPANY_COLUMNS = ["company_id", "company_name", "cae_primary_label", "trade_description_native", "website"]
+
+INCENTIVES_SCHEMA = pyarrow.schema([
+    ("incentive_id", pyarrow.int32()),
+    ("title", pyarrow.string()),
+    ("description", pyarrow.string()),
+    ("ai_description", pyarrow.string()),
+    ("document_urls", pyarrow.string()),
+    ("date_publication", pyarrow.date32()),
+    ("start_date", pyarrow.date32()),
+    ("end_date", pyarrow.date32()),
+    ("total_budget", pyarrow.string()),     # NUMERIC as text, no rounding
+    ("source_link", pyarrow.string()),
+    ("has_embedding", pyarrow.bool_()),
+])
+COMPANIES_SCHEMA = pyarrow.schema([
+    ("company_id", pyarrow.int32()),
+    ("company_name", pyarrow.string()),
+    ("cae_primary_label", pyarrow.string()),
+    ("trade_description_native", pyarrow.string()),
+    ("website", pyarrow.string()),
+    ("has_embedding", pyarrow.bool_()),
+])
+
+# Binary COPY format (https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4)
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+COPY_NULL = struct.pack(">i", -1)
+# A vector field: length, then what vector_recv expects (int16 dim, int16 unused, dim big-endian float4)
+VECTOR_FIELD_PREFIX = struct.pack(">ihh", 4 + 4 * DIM, DIM, 0)
+
+
+def paths(directory: str) -> dict:
+    return {
+        "manifest": os.path.join(directory, "manifest.json"),
+        "incentives": os.path.join(directory, "incentives.parquet"),
+        "incentive_embeddings": os.path.join(directory, "incentive_embeddings.npy"),
+        "companies": os.path.join(directory, "companies.parquet"),
+        "company_embeddings": os.path.join(directory, "company_embeddings.npy"),
+    }
+
+
+# ---------------------------------------------------------------- export
+
+def export_snapshot(database: PostgreSQLManager, directory: str, block_size: int = ROW_GROUP_SIZE) -> dict:
+    time_start = time.time()
+    os.makedirs(directory, exist_ok=True)
+    files = paths(directory)
+
+    # Incentives (~500 rows, in one go)
+    incentives = database.load_incentives() or []
+    incentives.sort(key=lambda incentive: incentive["incentive_id"])
+    vectors = {row["incentive_id"]: row["embeddings"] for row in database.get_incentive_embeddings() or []}
+    incentive_matrix = np.zeros((len(incentives), DIM), dtype=np.float32)
+    for i, incentive in enumerate(incentives):
+        if incentive["ai_description"] is not None:     # jsonb, kept as JSON text
+            incentive["ai_description"] = json.dumps(incentive["ai_description"], ensure_ascii=False)
+        if incentive["total_budget"] is not None:
+            incentive["total_budget"] = str(incentive["total_budget"])
+        incentive["has_embedding"] = incentive["incentive_id"] in vectors
+        if incentive["has_embedding"]:
+            incentive_matrix[i] = vectors[incentive["incentive_id"]]
+    pyarrow.parquet.write_table(pyarrow.Table.from_pylist(incentives, schema=INCENTIVES_SCHEMA), files["incentives"])
+    np.save(files["incentive_embeddings"], incentive_matrix)
+
+    # Companies, streamed block by block (one parquet row group per block)
+    n_companies = database.general_query("SELECT count(*) FROM companies")[0][0]
+    company_matrix = np.lib.format.open_memmap(files["company_embeddings"], mode="w+", dtype=np.float32, shape=(n_companies, DIM))
+    writer = pyarrow.parquet.ParquetWriter(files["companies"], COMPANIES_SCHEMA)
+    query = f"SELECT {', '.join(COMPANY_COLUMNS)}, vector_send(embeddings) FROM companies ORDER BY company_id"
+    offset = 0
+    block = []
+
+    def write_block():
+        nonlocal offset
+        has_embedding = [row[-1] is not None for row in block]
+        columns = {name: [row[i] for row in block] for i, name in enumerate(COMPANY_COLUMNS)}
+        columns["has_embedding"] = has_embedding
+        writer.write_table(pyarrow.Table.from_pydict(columns, schema=COMPANIES_SCHEMA))
+        rows = [i for i, has in enumerate(has_embedding) if has]
+        if rows:
+            company_matrix[offset + np.array(rows)] = binary_vectors([block[i][-1] for i in rows])
+        offset += len(block)
+        block.clear()
+
+    for row in database.iter_query(query, itersize=block_size):
+        block.append(row)
+        if len(block) == block_size:
+            write_block()
+    if block:
+        write_block()
+    writer.close()
+    company_matrix.flush()
+    del company_matrix
+
+    manifest = {
+        "format": FORMAT_VERSION,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "source_database": database.database_name,
+        "dim": DIM,
+        "incentives": len(incentives),
+        "companies": offset,
+    }
+    with open(files["manifest"], "w") as f:
+        json.dump(manifest, f, indent=4)
+    size = sum(os.path.getsize(path) for path in files.values()) / 1e6
+    print(f"✅ Exported {len(incentives)} incentives and {offset} companies to {directory} ({size:.0f} MB) in {time.time() - time_start:.1f} seconds")
+    return manifest
+
+
+# ---------------------------------------------------------------- import
+
+def copy_text(value) -> str:
+    """A value in COPY text format"""
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def copy_companies_binary(table: pyarrow.Table, matrix: np.ndarray) -> bytes:
+    """Rows of companies (COMPANY_COLUMNS + embeddings) in binary COPY format"""
+    big_endian = matrix.astype(">f4")
+    ids = table.column("company_id").to_pylist()
+    texts = [table.column(name).to_pylist() for name in COMPANY_COLUMNS[1:]]
+    has_embedding = table.column("has_embedding").to_pylist()
+    field_count = struct.pack(">h", len(COMPANY_COLUMNS) + 1)
+    out = [COPY_HEADER]
+    for i, company_id in enumerate(ids):
+        out.append(field_count)
+        out.append(struct.pack(">ii", 4, company_id))
+        for column in texts:
+            value = column[i]
+            if value is None:
+                out.append(COPY_NULL)
+            else:
+                encoded = value.encode("utf-8")
+                out.append(struct.pack(">i", len(encoded)))
+                out.append(encoded)
+        if has_embedding[i]:
+            out.append(VECTOR_FIELD_PREFIX)
+            out.append(big_endian[i].tobytes())
+        else:
+            out.append(COPY_NULL)
+    out.append(COPY_TRAILER)
+    return b"".join(out)
+
+
+def copy_row_groups(task) -> int:
+    """Worker process: COPY some row groups of companies.parquet into the database"""
+    directory, row_groups, connection_params = task
+    files = paths(directory)
+    parquet_file = pyarrow.parquet.ParquetFile(files["companies"])
+    matrix = np.load(files["company_embeddings"], mmap_mode="r")
+    starts = np.cumsum([0] + [parquet_file.metadata.row_group(g).num_rows for g in range(parquet_file.num_row_groups)])
+    conn = psycopg2.connect(**connection_params)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SET synchronous_commit = off")
+        copied = 0
+        columns = ", ".join(COMPANY_COLUMNS + ["embeddings"])
+        for group in row_groups:
+            table = parquet_file.read_row_group(group)
+            data = copy_companies_binary(table, matrix[starts[group]:starts[group + 1]])
+            cursor.copy_expert(f"COPY companies ({columns}) FROM STDIN WITH (FORMAT binary)", io.BytesIO(data))
+            copied += table.num_rows
+        conn.commit()
+        return copied
+    finally:
+        conn.close()
+
+
+def import_snapshot(database: PostgreSQLManager, directory: str, workers: int = 4, replace: bool = False, index: bool = True) -> bool:
+    files = paths(directory)
+    with open(files["manifest"]) as f:
+        manifest = json.load(f)
+    if manifest["format"] != FORMAT_VERSION:
+        print(f"❌ Snapshot format {manifest['format']} not supported (expected {FORMAT_VERSION})")
+        return False
+    timings = {}
+    time_start = phase_start = time.time()
+
+    # Database and empty tables, without primary keys (they're built after the data is in)
+    if not database.database_exists():
+        conn = database.get_connection(autocommit=True)
+        conn.cursor().execute(
+            sql.SQL("CREATE DATABASE {} TEMPLATE template0 ENCODING 'UTF8'").format(sql.Identifier(database.database_name))
+        )
+        conn.close()
+    conn = database.get_connection(database=database.database_name)
+    if not conn:
+        return False
+    cursor = conn.cursor()
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS vector")
+    cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+    if cursor.fetchone():
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    if replace:
+        cursor.execute("DROP TABLE IF EXISTS incentives, companies CASCADE")
+    cursor.execute(TABLE_INCENTIVES_SCHEMA)
+    cursor.execute(TABLE_COMPANIES_SCHEMA)
+    cursor.execute("SELECT (SELECT count(*) FROM incentives) + (SELECT count(*) FROM companies)")
+    if cursor.fetchone()[0] > 0:
+        print("❌ The tables are not empty, use --replace to overwrite them")
+        conn.rollback()
+        conn.close()
+        return False
+    cursor.execute("ALTER TABLE incentives DROP CONSTRAINT IF EXISTS incentives_pkey")
+    cursor.execute("ALTER TABLE companies DROP CONSTRAINT IF EXISTS companies_pkey")
+    conn.commit()
+
+    # Incentives: few rows, text COPY
+    incentives = pyarrow.parquet.read_table(files["incentives"]).to_pylist()
+    incentive_matrix = np.load(files["incentive_embeddings"])
+    lines = []
+    for incentive, vector in zip(incentives, incentive_matrix):
+        values = [copy_text(incentive[column]) for column in INCENTIVE_COLUMNS]
+        values.append("[" + ",".join(["%.9g" % x for x in vector.tolist()]) + "]" if incentive["has_embedding"] else "\\N")
+        lines.append("\t".join(values))
+    cursor.copy_expert(
+        f"COPY incentives ({', '.join(INCENTIVE_COLUMNS)}, embeddings) FROM STDIN",
+        io.StringIO("\n".join(lines) + "\n" if lines else "")
+    )
+    conn.commit()
+    timings["schema + incentives"] = time.time() - phase_start
+
+    # Companies: parallel binary COPY, row groups spread over the workers
+    phase_start = time.time()
+    n_groups = pyarrow.parquet.ParquetFile(files["companies"]).num_row_groups
+    connection_params = dict(database.connection_params, database=database.database_name)
+    tasks = [(directory, list(range(w, n_groups, workers)), connection_params) for w in range(workers)]
+    tasks = [task for task in tasks if task[1]]
+    if tasks:
+        with multiprocessing.Pool(len(tasks)) as pool:
+            copied = sum(pool.map(copy_row_groups, tasks))
+    else:
+        copied = 0
+    timings["companies COPY"] = time.time() - phase_start
+    print(f"📦 Copied {copied} companies with {len(tasks)} workers ({copied / max(timings['companies COPY'], 1e-9):.0f} rows/s)")
+
+    # Keys, sequences and indexes, now that the data is in
+    phase_start = time.time()
+    cursor.execute("SET maintenance_work_mem = '1GB'")
+    cursor.execute("SET max_parallel_maintenance_workers = %s", (max(workers - 1, 0),))
+    cursor.execute("ALTER TABLE incentives ADD PRIMARY KEY (incentive_id)")
+    cursor.execute("ALTER TABLE companies ADD PRIMARY KEY (company_id)")
+    for table, column in (("incentives", "incentive_id"), ("companies", "company_id")):
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence('{table}', '{column}'), COALESCE(max({column}), 0) + 1, false) FROM {table}"
+        )
+    create_company_name_indexes(cursor)
+    if index:
+        cursor.execute("CREATE INDEX IF NOT EXISTS incentives_embeddings_idx ON incentives USING hnsw (embeddings vector_l2_ops)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS companies_embeddings_idx ON companies USING hnsw (embeddings vector_l2_ops)")
+    conn.commit()
+    cursor.execute("ANALYZE incentives")
+    cursor.execute("ANALYZE companies")
+    conn.commit()
+    cursor.close()
+    conn.close()
+    database.install_change_notifications()
+    timings["keys + indexes"] = time.time() - phase_start
+
+    total = time.time() - time_start
+    for phase, seconds in timings.items():
+        print(f"   {phase:<20} {seconds:7.2f} s")
+    print(f"✅ Imported {len(incentives)} incentives and {copied} companies from {directory} in {total:.1f} seconds")
+    return True
+
+
+# ---------------------------------------------------------------- in-process
+
+class Snapshot:
+    """
+    Read-only view of a snapshot with the same methods as PostgreSQLManager that the in-memory indexes use:
+        IncentiveCatalog(snapshot), IncentiveIndex(snapshot), all_pairs_top_k(snapshot, ...)
+    """
+
+    def __init__(self, directory: str):
+        files = paths(directory)
+        with open(files["manifest"]) as f:
+            self.manifest = json.load(f)
+        self.database_name = f"snapshot:{directory}"
+        self.incentives = pyarrow.parquet.read_table(files["incentives"])
+        self.incentive_embeddings = np.load(files["incentive_embeddings"], mmap_mode="r")
+        self.companies = pyarrow.parquet.read_table(files["companies"], memory_map=True)
+        self.company_embeddings = np.load(files["company_embeddings"], mmap_mode="r")
+        self.company_ids = self.companies.column("company_id").to_numpy()
+        self.company_has_embedding = self.companies.column("has_embedding").to_numpy(zero_copy_only=False)
+
+    def load_incentives(self) -> list:
+        incentives = self.incentives.select(INCENTIVE_COLUMNS).to_pylist()
+        for incentive in incentives:
+            if incentive["ai_description"] is not None:
+                incentive["ai_description"] = json.loads(incentive["ai_description"])
+        return incentives
+
+    def get_incentive_embeddings(self) -> list:
+        ids = self.incentives.column("incentive_id").to_pylist()
+        titles = self.incentives.column("title").to_pylist()
+        has_embedding = self.incentives.column("has_embedding").to_pylist()
+        return [
+            {"incentive_id": ids[i], "title": titles[i], "embeddings": np.array(self.incentive_embeddings[i])}
+            for i in range(len(ids)) if has_embedding[i]
+        ]
+
+    def rows_of(self, company_ids: list) -> tuple:
+        """(ids that exist, their row numbers), the parquet is sorted by company_id"""
+        company_ids = np.asarray(list(company_ids), dtype=np.int64)
+        rows = np.searchsorted(self.company_ids, company_ids)
+        rows = np.minimum(rows, len(self.company_ids) - 1)
+        found = self.company_ids[rows] == company_ids
+        return company_ids[found], rows[found]
+
+    def query_companies_by_ids(self, company_ids: list) -> dict:
+        ids, rows = self.rows_of(company_ids)
+        companies = self.companies.select(COMPANY_COLUMNS).take(pyarrow.array(rows)).to_pylist()
+        return {int(company_id): company for company_id, company in zip(ids, companies)}
+
+    def get_company_embeddings(self, company_ids: list) -> dict:
+        ids, rows = self.rows_of(company_ids)
+        return {
+            int(company_id): np.array(self.company_embeddings[row])
+            for company_id, row in zip(ids, rows) if self.company_has_embedding[row]
+        }
+
+    def iter_company_embeddings(self, block_size: int = 10000):
+        for start in range(0, len(self.company_ids), block_size):
+            mask = self.company_has_embedding[start:start + block_size]
+            yield (
+                self.company_ids[start:start + block_size][mask].astype(np.int64),
+                np.asarray(self.company_embeddings[start:start + block_size][mask])
+            )
+
+
+def load_snapshot(directory: str) -> Snapshot:
+    return Snapshot(directory)
+
+
+def cold_start(directory: str):
+    """Time to get the in-memory incentive catalog and index ready from a snapshot"""
+    from incentive_catalog import IncentiveCatalog
+    from incentive_index import IncentiveIndex
+
+    time_start = time.time()
+    snapshot = load_snapshot(directory)
+    opened = time.time() - time_start
+    IncentiveCatalog(snapshot).load()
+    index = IncentiveIndex(snapshot)
+    index.load()
+    total = time.time() - time_start
+    print(f"   open snapshot        {opened:7.3f} s ({snapshot.manifest['companies']} companies, memory mapped)")
+    print(f"✅ Catalog and incentive index ready in {total:.3f} seconds")
+    return snapshot
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export / import / load a compact snapshot of the database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="write the database to a snapshot directory")
+    export_parser.add_argument("directory")
+    export_parser.add_argument("--block-size", type=int, default=ROW_GROUP_SIZE)
+    import_parser = subparsers.add_parser("import", help="load a snapshot into the database (parallel COPY)")
+    import_parser.add_argument("directory")
+    import_parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1))
+    import_parser.add_argument("--replace", action="store_true", help="drop the existing incentives/companies tables")
+    import_parser.add_argument("--no-index", action="store_true", help="don't build the HNSW indexes")
+    import_parser.add_argument("--database", default=None, help="database name (default: the one of sql.py)")
+    load_parser = subparsers.add_parser("load", help="time the in-process cold start from a snapshot")
+    load_parser.add_argument("directory")
+    args = parser.parse_args()
+
+    if args.command == "load":
+        cold_start(args.directory)
+    elif args.command == "export":
+        export_snapshot(PostgreSQLManager(), args.directory, args.block_size)
+    else:
+        database = PostgreSQLManager(database_name=args.database) if args.database else PostgreSQLManager()
+        import_snapshot(database, args.directory, args.workers, args.replace, not args.no_index)
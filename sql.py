@@ -1,29 +1,138 @@
 import psycopg2
 from psycopg2 import sql
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2 import pool as pg_pool
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, AsIs, register_adapter, new_type, register_type
+from psycopg2.extras import execute_values
 from langchain_community.embeddings.fastembed import FastEmbedEmbeddings
 import pandas as pd
+import numpy as np
 import sys
 from embedder import OpenAIEmbeder
+from incentive_catalog import IncentiveCatalog
+from change_listener import ChangeListener
+from singleflight import SingleFlight
+from query_log import TimedCursor
+from sharding import ShardedCompanies
+from result_cache import ResultCache
+import result_cache
+import cancellation
+import logs
+import logging
 import tiktoken
 from tqdm import tqdm
+from contextlib import contextmanager, ExitStack
+import threading
 import time
 import os
 import json
+import csv
 
+log = logs.get_logger(__name__)
 
 DATABASE_NAME = "augusta_labs_db"
 
+# Identical searches/lookups running at the same time are only executed once
+company_search_flight = SingleFlight("company_search")
+incentive_lookup_flight = SingleFlight("incentive_lookup")
+
+# Hot queries, run as prepared statements (see PostgreSQLManager.execute_prepared)
+# Embeddings are read with vector_send() (binary, see binary_vector), ~10x less CPU than parsing the text
+# The ORDER BY stays only on the distance so the vector index can be used (a second sort key makes the planner
+# sort the whole table), ties are broken by company_id in search_companies_by_vector, which cuts the keyset pages
+SEARCH_COMPANIES = """
+    SELECT company_id, company_name, cae_primary_label, trade_description_native, website,
+           embeddings <-> $1 AS distance_score
+    FROM companies
+    ORDER BY distance_score ASC
+    LIMIT $2
+"""
+INCENTIVE_BY_ID = """
+    SELECT incentive_id, title, description, ai_description, document_urls,
+           date_publication, start_date, end_date, total_budget, source_link
+    FROM incentives
+    WHERE incentive_id = $1
+"""
+COMPANY_EMBEDDINGS = """
+    SELECT company_id, vector_send(embeddings)
+    FROM companies
+    WHERE company_id = ANY($1) AND embeddings IS NOT NULL
+"""
+
+# Rows fetched per round trip by the server-side cursors (see iter_query)
+ITERSIZE = int(os.getenv("DB_ITERSIZE", 2000))
+
+# Candidates the HNSW index returns by default (hnsw.ef_search), and the most it can be set to
+EF_SEARCH = 40
+MAX_EF_SEARCH = 1000
+
+# Max connections kept open by the pool used by the hot queries
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+# Idle connections the pool keeps (and opens when it's created), a connection given back over this is closed
+POOL_MIN = min(int(os.getenv("DB_POOL_MIN", POOL_SIZE)), POOL_SIZE)
+
+# Prepared on every pooled connection by warm_connections (name -> statement)
+HOT_STATEMENTS = {
+    "search_companies": SEARCH_COMPANIES,
+    "incentive_by_id": INCENTIVE_BY_ID,
+}
+
+
+def adapt_vector(array: np.ndarray):
+    """
+    numpy arrays are sent as a pgvector literal ('[0.1,0.2,...]'::vector) instead of ARRAY[...] of numerics.
+    9 significant digits are enough to get back exactly the same float32.
+    """
+    return AsIs("'[" + ",".join(["%.9g" % x for x in array.tolist()]) + "]'::vector")
+
+
+register_adapter(np.ndarray, adapt_vector)
+
+
+def cast_vector(value, cursor):
+    """vector columns come back as float32 numpy arrays (parsed in C by numpy)"""
+    if value is None:
+        return None
+    return np.fromstring(value[1:-1], dtype=np.float32, sep=",")
+
+
+def to_vector(embedding) -> np.ndarray:
+    """Embedding (list from the OpenAI response, or array) as float32, the type that is adapted to vector"""
+    return np.asarray(embedding, dtype=np.float32)
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Connection of the pool, remembers the statements already prepared on its server session"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = {}   # name -> statement
+        self.statement_timeout_ms = None    # last SET statement_timeout sent (None = server default)
+        self.ef_search = EF_SEARCH          # last SET hnsw.ef_search sent
+        self.configured = False
+
+
 class PostgreSQLManager:
-    def __init__(self, host=os.getenv('DB_HOST', 'localhost'), user='postgres', password='123', port=5432):
+    def __init__(self, host=os.getenv('DB_HOST', 'localhost'), user='postgres', password='123', port=5432,
+                 database_name=DATABASE_NAME, company_shards=os.getenv('COMPANY_SHARDS')):
         self.connection_params = {
             'host': host,
             'user': user,
             'password': password,
             'port': port
         }
+        self.database_name = database_name
         # print(f"Connection parameters: \n{json.dumps(self.connection_params, indent=4)}")
         self.embedder = OpenAIEmbeder()
+        self.incentive_catalog = None   # in-memory incentives, see enable_incentive_catalog
+        self.result_cache = None        # company searches by query text, see enable_result_cache
+        self.query_recorder = None      # counts the searches asked the most, see warmup.py
+        self.change_listener = None
+        self.pool = None                # see pooled_connection
+        self.pool_lock = threading.Lock()
+        self.pool_slots = threading.BoundedSemaphore(POOL_SIZE)
+        # Companies split over several databases (see sharding.py), None = the companies table of this database
+        self.company_shards = None
+        if company_shards:
+            self.company_shards = ShardedCompanies.from_config(company_shards, PostgreSQLManager, user, password)
     
     def get_connection(self, database='postgres', autocommit=False):
         """Establish connection to PostgreSQL database"""
@@ -31,15 +140,159 @@ class PostgreSQLManager:
             conn_params = self.connection_params.copy()
             conn_params['database'] = database
             
-            conn = psycopg2.connect(**conn_params)
+            conn = psycopg2.connect(**conn_params, cursor_factory=TimedCursor)
             if autocommit:
                 conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
             
             return conn
         except psycopg2.Error as e:
-            print(f"Connection error: {e}")
+            log.error(f"Connection error: {e}")
             return None
     
+    def get_pool(self):
+        if self.pool is None:
+            with self.pool_lock:
+                if self.pool is None:
+                    conn_params = self.connection_params.copy()
+                    conn_params['database'] = self.database_name
+                    self.pool = pg_pool.ThreadedConnectionPool(
+                        POOL_MIN, POOL_SIZE, connection_factory=PooledConnection, cursor_factory=TimedCursor, **conn_params
+                    )
+        return self.pool
+
+    @contextmanager
+    def pooled_connection(self):
+        """
+        Connection to the database taken from the pool (autocommit, vector columns come back as numpy arrays).
+        Waits for a free connection if all of them are in use, raises psycopg2.Error if it can't connect.
+        """
+        self.pool_slots.acquire()
+        try:
+            pool = self.get_pool()
+            conn = pool.getconn()
+            broken = False
+            token = None
+            try:
+                if not conn.configured:
+                    conn.autocommit = True
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT 'vector'::regtype::oid")
+                    register_type(new_type((cursor.fetchone()[0],), "VECTOR", cast_vector), conn)
+                    cursor.close()
+                    conn.configured = True
+                # Chat requests: statement_timeout until their deadline, and the query is cancelled if the client goes away
+                timeout_ms = cancellation.statement_timeout_ms()
+                if timeout_ms != conn.statement_timeout_ms:
+                    cursor = conn.cursor()
+                    cursor.execute("SET statement_timeout = %s", (timeout_ms or 0,))
+                    cursor.close()
+                    conn.statement_timeout_ms = timeout_ms
+                token = cancellation.current()
+                unregister = None
+                if token is not None:
+                    token.check()
+                    unregister = token.on_cancel(conn.cancel)
+                try:
+                    yield conn
+                finally:
+                    if unregister is not None:
+                        unregister()
+            except psycopg2.extensions.QueryCanceledError as e:
+                # The connection is still fine, only the statement was cancelled
+                if token is not None and (token.cancelled or token.remaining() == 0):
+                    token.cancel("deadline")    # no-op if it was already cancelled
+                    cancellation.stats.add("queries_cancelled")
+                    raise cancellation.RequestCancelled(token.reason) from e
+                raise
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+                raise
+            finally:
+                pool.putconn(conn, close=broken or bool(conn.closed))
+        finally:
+            self.pool_slots.release()
+
+    def execute_prepared(self, cursor, name: str, statement: str, params: list):
+        """
+        Run a statement (with $1, $2... placeholders) as a server-side prepared statement,
+        so it's parsed and planned only once per pooled connection
+        """
+        self.prepare(cursor, name, statement)
+        cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+    def prepare(self, cursor, name: str, statement: str):
+        """PREPARE the statement on the connection of the cursor, if it isn't already"""
+        conn = cursor.connection
+        if name not in conn.prepared_statements:
+            cursor.execute(f"PREPARE {name} AS {statement}")
+            conn.prepared_statements[name] = statement
+
+    def warm_connections(self, count: int = POOL_SIZE) -> int:
+        """
+        Open and configure count pooled connections (vector type, prepared HOT_STATEMENTS) before the first
+        requests need them, returns how many are ready. They stay in the pool up to POOL_MIN.
+        """
+        count = min(count, POOL_SIZE)
+        try:
+            with ExitStack() as stack:
+                # All of them checked out at the same time, otherwise the pool would hand back the same one
+                connections = [stack.enter_context(self.pooled_connection()) for _ in range(count)]
+                for conn in connections:
+                    cursor = conn.cursor()
+                    for name, statement in HOT_STATEMENTS.items():
+                        self.prepare(cursor, name, statement)
+                    cursor.close()
+            return len(connections)
+        except psycopg2.Error as e:
+            log.error(f"❌ Error opening the pooled connections: {e}")
+            return 0
+
+    def prewarm_tables(self, tables: list) -> dict:
+        """
+        Load the tables, their TOAST (the embeddings) and their indexes (the vector index) into shared_buffers
+        with pg_prewarm, relation -> blocks loaded. Without the extension the tables are read with a query
+        instead (fills the OS page cache, not shared_buffers, and not the indexes).
+        """
+        conn = self.get_connection(database=self.database_name, autocommit=True)
+        if not conn:
+            return {}
+        cursor = conn.cursor()
+        blocks = {}
+        try:
+            try:
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_prewarm")
+                prewarm = True
+            except psycopg2.Error as e:
+                log.warning(f"⚠️ pg_prewarm not available ({e.diag.message_primary}), reading the tables instead")
+                prewarm = False
+            for table in tables:
+                if not prewarm:
+                    # Every column, so the TOASTed embeddings are read too
+                    cursor.execute(sql.SQL("SELECT count(*), sum(pg_column_size(t.*)) FROM {} t").format(sql.Identifier(table)))
+                    blocks[table] = None
+                    continue
+                # Table, its TOAST table, then the indexes of both (the last ones loaded are the last evicted)
+                cursor.execute("""
+                    SELECT relation::regclass::text, pg_prewarm(relation)
+                    FROM (
+                        SELECT c.oid AS relation, 0 AS step FROM pg_class c WHERE c.oid = %s::regclass
+                        UNION ALL
+                        SELECT c.reltoastrelid, 1 FROM pg_class c WHERE c.oid = %s::regclass AND c.reltoastrelid <> 0
+                        UNION ALL
+                        SELECT i.indexrelid, 2 FROM pg_index i JOIN pg_class c ON i.indrelid IN (c.oid, c.reltoastrelid)
+                        WHERE c.oid = %s::regclass
+                    ) relations
+                    ORDER BY step
+                """, (table, table, table))
+                blocks.update(cursor.fetchall())
+            return blocks
+        except psycopg2.Error as e:
+            log.error(f"❌ Error prewarming {tables}: {e}")
+            return blocks
+        finally:
+            cursor.close()
+            conn.close()
+
     def database_exists(self):
         """Check if database already exists"""
         conn = self.get_connection(autocommit=True)
@@ -50,7 +303,7 @@ class PostgreSQLManager:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT 1 FROM pg_catalog.pg_database WHERE datname = %s",
-                (DATABASE_NAME,)
+                (self.database_name,)
             )
             exists = cursor.fetchone() is not None
             cursor.close()
@@ -63,8 +316,8 @@ class PostgreSQLManager:
     
     def create_database(self):
         """Create a new database"""
-        if self.database_exists(DATABASE_NAME):
-            print(f"Database '{DATABASE_NAME}' already exists.")
+        if self.database_exists():
+            print(f"Database '{self.database_name}' already exists.")
             return True
         
         conn = self.get_connection(autocommit=True)
@@ -74,10 +327,10 @@ class PostgreSQLManager:
         try:
             cursor = conn.cursor()
             create_query = sql.SQL("CREATE DATABASE {}").format(
-                sql.Identifier(DATABASE_NAME)
+                sql.Identifier(self.database_name)
             )
             cursor.execute(create_query)
-            print(f"✅ Database '{DATABASE_NAME}' created successfully!")
+            print(f"✅ Database '{self.database_name}' created successfully!")
             return True
         except psycopg2.Error as e:
             print(f"❌ Error creating database: {e}")
@@ -88,7 +341,7 @@ class PostgreSQLManager:
     
     def create_table(self, table_name, table_schema):
         """Create a table in the specified database"""
-        conn = self.get_connection(database=DATABASE_NAME)
+        conn = self.get_connection(database=self.database_name)
         if not conn:
             return False
         # Check if table already exists
@@ -108,7 +361,7 @@ class PostgreSQLManager:
     
     def verify_database(self):
         """Verify database creation and contents"""
-        conn = self.get_connection(database=DATABASE_NAME)
+        conn = self.get_connection(database=self.database_name)
         if not conn:
             return False
         
@@ -150,15 +403,17 @@ class PostgreSQLManager:
             print("No incentives to insert.")
             return False
         
-        conn = self.get_connection(database=DATABASE_NAME)
+        conn = self.get_connection(database=self.database_name)
         if not conn:
             return False
 
         try:
             cursor = conn.cursor()
+            # Embeddings of the incentives are used to match companies -> incentives
+            self.add_embeddings_incentives(incentives)
             insert_query = """
-                INSERT INTO incentives (incentive_id, title, description, ai_description, document_urls, date_publication, start_date, end_date, total_budget, source_link)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                INSERT INTO incentives (incentive_id, title, description, ai_description, document_urls, date_publication, start_date, end_date, total_budget, source_link, embeddings)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
             """
             for data in incentives:
                 cursor.execute(insert_query, (
@@ -171,7 +426,8 @@ class PostgreSQLManager:
                     data.get("start_date") if data.get("start_date") else None,
                     data.get("end_date") if data.get("end_date") else None,
                     data.get("total_budget") if data.get("total_budget") else None,
-                    data.get("source_link") if data.get("source_link") else None
+                    data.get("source_link") if data.get("source_link") else None,
+                    data.get("embeddings")
                 ))
             conn.commit()
             print(f"✅ Inserted {len(incentives)} incentives from CSV successfully!")
@@ -191,7 +447,7 @@ class PostgreSQLManager:
             print("No companies to insert.")
             return False
         
-        conn = self.get_connection(database=DATABASE_NAME)
+        conn = self.get_connection(database=self.database_name)
         if not conn:
             return False
 
@@ -199,7 +455,11 @@ class PostgreSQLManager:
             cursor = conn.cursor()
             
             # Get existing company names to skip them
-            existing_companies = self.get_existing_company_names(cursor)
+            company_names = {c.get("company_name") for c in companies if isinstance(c.get("company_name"), str)}
+            if self.company_shards is not None:
+                existing_companies = self.company_shards.existing_company_names(company_names)
+            else:
+                existing_companies = self.get_existing_company_names(cursor, company_names)
             print(f"Found {len(existing_companies)} existing companies in database")
             
             # Filter out companies that already exist
@@ -225,21 +485,13 @@ class PostgreSQLManager:
                 
                 # Add embeddings for this chunk only
                 self.add_embeddings_companies(chunk)
-                # Insert this chunk
-                insert_query = """
-                    INSERT INTO companies (company_name, cae_primary_label, trade_description_native, website, embeddings)
-                    VALUES (%s, %s, %s, %s, %s)
-                """
-                for data in chunk:
-                    cursor.execute(insert_query, (
-                        data.get("company_name"),
-                        data.get("cae_primary_label"), 
-                        data.get("trade_description_native") if not isinstance(data.get("trade_description_native"), float) else None,
-                        data.get("website") if not isinstance(data.get("website"), float) else None,
-                        data.get("embeddings") if not isinstance(data.get("embeddings"), float) else None
-                    ))
-                
-                conn.commit()
+                # Insert this chunk (into the shard of each company if the companies are sharded)
+                if self.company_shards is not None:
+                    if not self.company_shards.insert(chunk):
+                        return False
+                else:
+                    self.insert_company_rows(chunk, cursor)
+                    conn.commit()
                 total_inserted += len(chunk)
                 print(f"✅ Chunk {chunk_num}/{total_chunks} inserted successfully! (Total: {total_inserted}/{len(companies_to_insert)})")
             
@@ -254,37 +506,313 @@ class PostgreSQLManager:
             cursor.close()
             conn.close()
 
-    def get_existing_company_names(self, cursor) -> set:
-        """Get set of company names that already exist in database"""
+    def insert_company_rows(self, companies: list, cursor=None):
+        """
+        Insert companies (dicts with their embeddings) into the companies table of this database.
+        With a cursor the rows go into its transaction, without one they are committed here.
+        """
+        insert_query = """
+            INSERT INTO companies (company_name, cae_primary_label, trade_description_native, website, embeddings)
+            VALUES (%s, %s, %s, %s, %s)
+        """
+        rows = [(
+            data.get("company_name"),
+            data.get("cae_primary_label"),
+            data.get("trade_description_native") if not isinstance(data.get("trade_description_native"), float) else None,
+            data.get("website") if not isinstance(data.get("website"), float) else None,
+            data.get("embeddings") if not isinstance(data.get("embeddings"), float) else None
+        ) for data in companies]
+        if cursor is not None:
+            cursor.executemany(insert_query, rows)
+            return True
+
+        conn = self.get_connection(database=self.database_name)
+        if not conn:
+            return False
         try:
-            cursor.execute("SELECT company_name FROM companies")
-            return {row[0] for row in cursor.fetchall()}
+            cursor = conn.cursor()
+            cursor.executemany(insert_query, rows)
+            conn.commit()
+            return True
+        except psycopg2.Error as e:
+            print(f"❌ Error inserting companies into '{self.database_name}': {e}")
+            conn.rollback()
+            return False
+        finally:
+            cursor.close()
+            conn.close()
+
+    def upsert_company_rows(self, companies: list, cursor=None):
+        """
+        Insert or update (by company_name) companies with their embeddings in one statement.
+        Returns the company_id of each company (same order), False on error.
+        With a cursor the rows go into its transaction, without one they are committed here.
+        Two upserts of the same new name must not run at the same time (CompanyWriter runs them one by one).
+        """
+        # Last version of each name wins inside the batch
+        by_name = {company["company_name"]: company for company in companies}
+        rows = [(
+            data["company_name"],
+            data.get("cae_primary_label"),
+            data.get("trade_description_native"),
+            data.get("website"),
+            data.get("embeddings")
+        ) for data in by_name.values()]
+        upsert_query = """
+            WITH input (company_name, cae_primary_label, trade_description_native, website, embeddings) AS (
+                VALUES %s
+            ),
+            updated AS (
+                UPDATE companies c
+                SET cae_primary_label = i.cae_primary_label,
+                    trade_description_native = i.trade_description_native,
+                    website = i.website,
+                    embeddings = i.embeddings
+                FROM input i
+                WHERE c.company_name = i.company_name
+                RETURNING c.company_id, c.company_name
+            ),
+            inserted AS (
+                INSERT INTO companies (company_name, cae_primary_label, trade_description_native, website, embeddings)
+                SELECT * FROM input i
+                WHERE NOT EXISTS (SELECT 1 FROM companies c WHERE c.company_name = i.company_name)
+                RETURNING company_id, company_name
+            )
+            SELECT company_id, company_name FROM updated
+            UNION ALL
+            SELECT company_id, company_name FROM inserted
+        """
+        template = "(%s, %s, %s, %s, %s::vector)"
+
+        def run(cursor):
+            results = execute_values(cursor, upsert_query, rows, template=template, page_size=len(rows), fetch=True)
+            ids = {}
+            for company_id, company_name in results:
+                # Names that were already duplicated in the table: the oldest row
+                ids[company_name] = min(company_id, ids.get(company_name, company_id))
+            return [ids.get(company["company_name"]) for company in companies]
+
+        if cursor is not None:
+            return run(cursor)
+
+        conn = self.get_connection(database=self.database_name)
+        if not conn:
+            return False
+        try:
+            cursor = conn.cursor()
+            company_ids = run(cursor)
+            conn.commit()
+            return company_ids
+        except psycopg2.Error as e:
+            log.error(f"❌ Error upserting companies into '{self.database_name}': {e}")
+            conn.rollback()
+            return False
+        finally:
+            cursor.close()
+            conn.close()
+
+    def get_existing_company_names(self, cursor, company_names: list = None, chunk_size: int = 10000) -> set:
+        """
+        Get set of company names that already exist in database.
+        With company_names only those are checked (in chunks, using the index on company_name),
+        so the 250k names of the table don't have to be loaded.
+        """
+        try:
+            existing = set()
+            if company_names is not None:
+                company_names = list(company_names)
+                for i in range(0, len(company_names), chunk_size):
+                    cursor.execute(
+                        "SELECT company_name FROM companies WHERE company_name = ANY(%s)",
+                        (company_names[i:i + chunk_size],)
+                    )
+                    existing.update(row[0] for row in cursor)
+                return existing
+            # Every name, streamed with a server-side cursor in the same transaction
+            names_cursor = cursor.connection.cursor(name="existing_company_names")
+            names_cursor.itersize = ITERSIZE
+            names_cursor.execute("SELECT company_name FROM companies")
+            existing.update(row[0] for row in names_cursor)
+            names_cursor.close()
+            return existing
         except psycopg2.Error as e:
             print(f"⚠️ Could not fetch existing companies: {e}")
+            cursor.connection.rollback()
             return set()
 
     def add_embeddings_companies(self, companies: list):
         """Add embeddings to a list of companies (modifies in place)"""
         docs_to_embed = []
         for company in companies:
-            primary_label = company.get('cae_primary_label') if not isinstance(company.get('cae_primary_label'), float) else ''
-            trade_description = company.get('trade_description_native') if not isinstance(company.get('trade_description_native'), float) else ''
+            # NaN from the CSVs, None from the API
+            primary_label = company.get('cae_primary_label') if isinstance(company.get('cae_primary_label'), str) else ''
+            trade_description = company.get('trade_description_native') if isinstance(company.get('trade_description_native'), str) else ''
             doc = f"{company['company_name']}\n{primary_label}\n{trade_description}"
             docs_to_embed.append(doc)
         
-        embeddings_response = self.embedder.get_embedding(docs_to_embed, model="text-embedding-3-small")
-        embeddings = embeddings_response['embedding']
+        embeddings = self.embedder.get_embedding_matrix(docs_to_embed, model="text-embedding-3-small")
         
         for i, company in enumerate(companies):
-            company["embeddings"] = embeddings[i].embedding
+            company["embeddings"] = embeddings[i]
         
-        print(f"✅ Added embeddings to {len(companies)} companies in this chunk.")
+        log.info(f"✅ Added embeddings to {len(companies)} companies in this chunk.")
         return companies
 
 
+    def add_embeddings_incentives(self, incentives: list, chunk_size: int = 100):
+        """Add embeddings (title + description + ai_description) to a list of incentives (modifies in place)"""
+        docs_to_embed = [incentive_document(incentive) for incentive in incentives]
+        for i in range(0, len(docs_to_embed), chunk_size):
+            embeddings_response = self.embedder.get_embedding(docs_to_embed[i:i + chunk_size], model="text-embedding-3-small")
+            for incentive, embedding in zip(incentives[i:i + chunk_size], embeddings_response['embedding']):
+                incentive["embeddings"] = to_vector(embedding.embedding)
+
+        log.info(f"✅ Added embeddings to {len(incentives)} incentives.")
+        return incentives
+
+    def update_incentive_embeddings(self):
+        """
+        Adds the embeddings column to an existing incentives table, fills the missing embeddings
+        and creates the indexes used by the company -> incentive matching
+        """
+        conn = self.get_connection(database=self.database_name)
+        if not conn:
+            return False
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute("ALTER TABLE incentives ADD COLUMN IF NOT EXISTS embeddings VECTOR(1536)")
+            cursor.execute("""
+                SELECT incentive_id, title, description, ai_description
+                FROM incentives
+                WHERE embeddings IS NULL
+            """)
+            incentives = [
+                {"incentive_id": row[0], "title": row[1], "description": row[2], "ai_description": row[3]}
+                for row in cursor.fetchall()
+            ]
+            if incentives:
+                self.add_embeddings_incentives(incentives)
+                for incentive in incentives:
+                    cursor.execute(
+                        "UPDATE incentives SET embeddings = %s WHERE incentive_id = %s",
+                        (incentive["embeddings"], incentive["incentive_id"])
+                    )
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS incentives_embeddings_idx
+                ON incentives USING hnsw (embeddings vector_l2_ops)
+            """)
+            # To find the company the user is talking about by its name
+            cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+            if cursor.fetchone():
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            create_company_name_indexes(cursor)
+            conn.commit()
+            print(f"✅ Updated embeddings of {len(incentives)} incentives!")
+            return True
+        except psycopg2.Error as e:
+            print(f"❌ Error updating incentive embeddings: {e}")
+            conn.rollback()
+            return False
+        finally:
+            cursor.close()
+            conn.close()
+
+    def install_change_notifications(self):
+        """
+        Triggers that bump data_versions and send a NOTIFY on 'data_changed' when incentives/companies change,
+        used to refresh the in-memory caches (statement level, so a bulk insert only notifies once)
+        """
+        conn = self.get_connection(database=self.database_name)
+        if not conn:
+            return False
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS data_versions (
+                    table_name TEXT PRIMARY KEY,
+                    version BIGINT NOT NULL DEFAULT 0
+                )
+            """)
+            cursor.execute("""
+                INSERT INTO data_versions (table_name) VALUES ('incentives'), ('companies')
+                ON CONFLICT DO NOTHING
+            """)
+            cursor.execute("""
+                CREATE OR REPLACE FUNCTION notify_data_change() RETURNS trigger AS $$
+                BEGIN
+                    UPDATE data_versions SET version = version + 1 WHERE table_name = TG_TABLE_NAME;
+                    PERFORM pg_notify('data_changed', TG_TABLE_NAME);
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+            """)
+            for table in ("incentives", "companies"):
+                cursor.execute(sql.SQL("""
+                    CREATE OR REPLACE TRIGGER {} AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {}
+                    FOR EACH STATEMENT EXECUTE FUNCTION notify_data_change()
+                """).format(sql.Identifier(f"{table}_data_changed"), sql.Identifier(table)))
+            conn.commit()
+            return True
+        except psycopg2.Error as e:
+            print(f"❌ Error installing change notifications: {e}")
+            conn.rollback()
+            return False
+        finally:
+            cursor.close()
+            conn.close()
+
+    def on_change(self, table: str, callback):
+        """Call callback() every time the table changes (starts the change listener if needed)"""
+        if self.change_listener is None:
+            self.install_change_notifications()
+            self.change_listener = ChangeListener(self.connection_params, self.database_name)
+            self.change_listener.start()
+        self.change_listener.subscribe(table, callback)
+
+    def enable_incentive_catalog(self):
+        """Keep every incentive in memory, the incentive queries stop going to the database"""
+        catalog = IncentiveCatalog(self)
+        if not catalog.load():
+            return False
+        self.incentive_catalog = catalog
+        self.on_change("incentives", catalog.load)
+        return True
+
+    def enable_result_cache(self):
+        """Cache the company searches by query text, invalidated when the companies table changes (see result_cache.py)"""
+        if not result_cache.ENABLED:
+            return False
+        if self.company_shards is not None:
+            # The shards have their own data_versions, the listener only follows this database
+            log.warning("⚠️ Result cache disabled with company shards")
+            return False
+        cache = ResultCache(self)
+        if cache.shared is not None and not cache.shared.create():
+            cache.shared = None
+        self.on_change("companies", cache.load)
+        if not cache.load():
+            return False
+        self.result_cache = cache
+        return True
+
+    def get_data_version(self, table: str):
+        """Version of the table in data_versions (bumped on every change), None on error"""
+        try:
+            with self.pooled_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT version FROM data_versions WHERE table_name = %s", (table,))
+                row = cursor.fetchone()
+                cursor.close()
+            return row[0] if row else 0
+        except psycopg2.Error as e:
+            log.error(f"❌ Error reading the data version of '{table}': {e}")
+            return None
+
     def check_pgvector(self):
         query = "SELECT * FROM pg_available_extensions WHERE name = 'vector';"
-        conn = self.get_connection(database=DATABASE_NAME)
+        conn = self.get_connection(database=self.database_name)
         if not conn:
             return False
         cursor = conn.cursor()
@@ -300,82 +828,101 @@ class PostgreSQLManager:
             print(f"Error checking pgvector: {e}")
             return False
 
-    def query_companies_with_embedding(self, user_query: str, top_k: int = 5):
+    def query_companies_with_embedding(self, user_query: str, top_k: int = 5, after: tuple = None):
         """Query companies based on embedding similarity with the query string"""
-        time_start = time.time()
-        conn = self.get_connection(database=DATABASE_NAME)
-        
+        model = "text-embedding-3-small"
+        recorder = self.query_recorder
+        if recorder is not None and after is None:
+            recorder.record("companies", user_query, top_k)
+        cache = self.result_cache
+        if cache is not None:
+            key = cache.key(model, user_query, top_k, {"after": after})
+            results, version = cache.get(key)
+            if results is not None:
+                return results
         # embedding for the query
-        embedding_query = self.embedder.get_embedding(user_query, model="text-embedding-3-small")['embedding'][0].embedding
-        if not conn:
-            return False
+        embedding_query = self.embedder.get_embedding(user_query, model=model)['embedding'][0].embedding
+        results = self.query_companies_by_vector(embedding_query, top_k, after)
+        if cache is not None:
+            cache.put(key, version, results)
+        return results
+
+    def query_companies_by_vector(self, embedding_query: list, top_k: int = 5, after: tuple = None):
+        """
+        Query companies based on embedding similarity with an already computed embedding.
+        after: (distance_score, company_id) of the last company of the previous page (keyset pagination)
+        """
+        key = (np.asarray(embedding_query, dtype=np.float32).tobytes(), top_k, after)
+        return company_search_flight.do(key, self.search_companies_by_vector, embedding_query, top_k, after)
 
+    def search_companies_by_vector(self, embedding_query: list, top_k: int = 5, after: tuple = None):
+        """
+        The actual vector search of query_companies_by_vector (without coalescing).
+        A page after the cursor is cut from the first `window` results, not filtered in SQL: with an HNSW index
+        a WHERE on the distance is applied to the hnsw.ef_search candidates the index returns, and the pages
+        past them would come back short or empty. The window (and ef_search with it) grows until the page is
+        full or the window reaches MAX_EF_SEARCH (so paging stops about 1000 results deep).
+        """
+        if self.company_shards is not None:
+            return self.company_shards.search(embedding_query, top_k, after)
+        time_start = time.time()
+        # One more than the page, so the last company of the page is certain unless there's a tie
+        window = top_k + 1 if after is None else min(max(top_k * 4, EF_SEARCH), MAX_EF_SEARCH)
         try:
-            cursor = conn.cursor()
-            # Assuming the embedding is stored as a string in the database
-            # Adjust the query to use the embedding column and the L2 distance function
-            query = """
-                SELECT 
-                    company_name, 
-                    cae_primary_label, 
-                    trade_description_native, 
-                    website,
-                    embeddings <-> %s::vector as distance_score
-                FROM companies
-                ORDER BY distance_score ASC
-                LIMIT %s
-            """
-            cursor.execute(query, (embedding_query, top_k))
-            results = cursor.fetchall()
-            print(f"✅ Query executed successfully!")
+            with self.pooled_connection() as conn:
+                cursor = conn.cursor()
+                while True:
+                    ef_search = max(EF_SEARCH, window)
+                    if ef_search != conn.ef_search:
+                        cursor.execute("SET hnsw.ef_search = %s", (ef_search,))
+                        conn.ef_search = ef_search
+                    self.execute_prepared(cursor, "search_companies", SEARCH_COMPANIES, [to_vector(embedding_query), window])
+                    rows = cursor.fetchall()
+                    last_window = len(rows) < window or window >= MAX_EF_SEARCH
+                    # Sorted by (distance, company_id). If the window is full, the companies at the same distance as
+                    # its last one may continue after it, so only the ones strictly closer are certain
+                    rows.sort(key=lambda row: (row[5], row[0]))
+                    certain = rows if last_window else [row for row in rows if row[5] < rows[-1][5]]
+                    results = [row for row in certain if after is None or (row[5], row[0]) > after][:top_k]
+                    if len(results) >= top_k or last_window:
+                        break
+                    window = min(window * 4, MAX_EF_SEARCH)
+                cursor.close()
+            logs.event(log, logging.INFO, "query_executed", "✅ Query executed successfully!", query="search_companies",
+                       rows=len(results), window=window, ms=round((time.time() - time_start) * 1000, 2))
 
             # ✅ Convert to list/dict with similarity score
             formatted_results = []
             for row in results:
                 formatted_results.append({
-                    'company_name': row[0],
-                    'cae_primary_label': row[1],
-                    'trade_description_native': row[2],
-                    'website': row[3],
-                    'distance_score': row[4]
+                    'company_id': row[0],
+                    'company_name': row[1],
+                    'cae_primary_label': row[2],
+                    'trade_description_native': row[3],
+                    'website': row[4],
+                    'distance_score': row[5]
                 })
-            time_end = time.time() - time_start
-            # print(f"🕒 Query took {time_end:.2f} seconds.")
             return formatted_results
         except psycopg2.Error as e:
-            print(f"❌ Error executing query: {e}")
+            log.error(f"❌ Error executing query: {e}")
             return False
-        finally:
-            cursor.close()
-            conn.close()
     
     def query_incentives_by_id(self, id: int):
         """Query incentives by ID"""
-        conn = self.get_connection(database=DATABASE_NAME)
-        if not conn:
-            return False
+        if self.incentive_catalog is not None:
+            return self.incentive_catalog.get(id)
+        return incentive_lookup_flight.do(id, self.fetch_incentive_by_id, id)
 
+    def fetch_incentive_by_id(self, id: int):
+        """The actual database query of query_incentives_by_id"""
         try:
-            cursor = conn.cursor()
-            query = """
-                SELECT
-                    incentive_id,
-                    title,
-                    description,
-                    ai_description,
-                    document_urls,
-                    date_publication,
-                    start_date,
-                    end_date,
-                    total_budget,
-                    source_link
-                FROM incentives
-                WHERE incentive_id = %s
-            """
-            cursor.execute(query, (id,))
-            result = cursor.fetchone()
+            with self.pooled_connection() as conn:
+                cursor = conn.cursor()
+                self.execute_prepared(cursor, "incentive_by_id", INCENTIVE_BY_ID, [id])
+                result = cursor.fetchone()
+                cursor.close()
             if result:
-                print(f"✅ Query executed successfully!")
+                logs.event(log, logging.INFO, "query_executed", "✅ Query executed successfully!", query="incentive_by_id", rows=1)
                 return {
                     'incentive_id': result[0],
                     'title': result[1],
@@ -389,25 +936,35 @@ class PostgreSQLManager:
                     'source_link': result[9]
                 }
             else:
-                print(f"❌ No incentive found with ID {id}")
+                logs.event(log, logging.DEBUG, "not_found", f"❌ No incentive found with ID {id}", incentive_id=id)
                 return None
         except psycopg2.Error as e:
-            print(f"❌ Error executing query: {e}")
+            log.error(f"❌ Error executing query: {e}")
             return False
-        finally:
-            cursor.close()
-            conn.close()
     
-    def query_incentives_by_name(self, incentive_title: str, threshold: float = 0.0):
-        """Query incentives by name using fuzzy matching with trigram similarity"""
-        conn = self.get_connection(database=DATABASE_NAME)
+    def query_incentives_by_name(self, incentive_title: str, threshold: float = 0.0, limit: int = 10, after: tuple = None):
+        """
+        Query incentives by name using fuzzy matching with trigram similarity.
+        after: (similarity_score, incentive_id) of the last incentive of the previous page (keyset pagination)
+        """
+        if self.incentive_catalog is not None:
+            return self.incentive_catalog.search(incentive_title, threshold, limit, after) or None
+        conn = self.get_connection(database=self.database_name)
         if not conn:
             return False
 
         try:
             cursor = conn.cursor()
             
-            query = """
+            keyset_filter = ""
+            params = [incentive_title, incentive_title, threshold]
+            if after is not None:
+                keyset_filter = """
+                    AND (similarity(title, %s) < %s
+                         OR (similarity(title, %s) = %s AND incentive_id > %s))
+                """
+                params += [incentive_title, after[0], incentive_title, after[0], after[1]]
+            query = f"""
                 SELECT
                     incentive_id,
                     title,
@@ -422,14 +979,15 @@ class PostgreSQLManager:
                     similarity(title, %s) as similarity_score
                 FROM incentives
                 WHERE similarity(title, %s) > %s
-                ORDER BY similarity_score DESC
-                LIMIT 10
+                {keyset_filter}
+                ORDER BY similarity_score DESC, incentive_id ASC
+                LIMIT %s
             """
             
-            cursor.execute(query, (incentive_title, incentive_title, threshold))
+            cursor.execute(query, params + [limit])
             results = cursor.fetchall()
             if results:
-                print(f"✅ Query executed successfully!")
+                logs.event(log, logging.INFO, "query_executed", "✅ Query executed successfully!", query="incentives_by_name", rows=len(results))
                 formatted_results = []
                 for row in results:
                     formatted_results.append({
@@ -447,34 +1005,259 @@ class PostgreSQLManager:
                     })
                 return formatted_results
             else:
-                print(f"❌ No incentive found with name {incentive_title}")
+                logs.event(log, logging.DEBUG, "not_found", f"❌ No incentive found with name {incentive_title}")
                 return None
         except psycopg2.Error as e:
-            print(f"❌ Error executing query: {e}")
+            log.error(f"❌ Error executing query: {e}")
             return False
         finally:
             cursor.close()
             conn.close()
     
-    def general_query(self, query: str):
-        """Execute a general query on the database"""
-        conn = self.get_connection(database=DATABASE_NAME)
+    def load_incentives(self):
+        """Every incentive (without the embeddings), used by the in-memory catalog"""
+        conn = self.get_connection(database=self.database_name)
         if not conn:
             return False
 
         try:
             cursor = conn.cursor()
-            cursor.execute(query)
+            cursor.execute("""
+                SELECT
+                    incentive_id,
+                    title,
+                    description,
+                    ai_description,
+                    document_urls,
+                    date_publication,
+                    start_date,
+                    end_date,
+                    total_budget,
+                    source_link
+                FROM incentives
+            """)
+            columns = [column.name for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        except psycopg2.Error as e:
+            log.error(f"❌ Error loading incentives: {e}")
+            return False
+        finally:
+            cursor.close()
+            conn.close()
+
+    def get_incentive_embeddings(self):
+        """Get the id, title and embedding (float32 array) of every incentive that has an embedding"""
+        try:
+            with self.pooled_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT incentive_id, title, vector_send(embeddings)
+                    FROM incentives
+                    WHERE embeddings IS NOT NULL
+                    ORDER BY incentive_id
+                """)
+                results = cursor.fetchall()
+                cursor.close()
+            return [
+                {"incentive_id": row[0], "title": row[1], "embeddings": binary_vector(row[2])}
+                for row in results
+            ]
+        except psycopg2.Error as e:
+            log.error(f"❌ Error executing query: {e}")
+            return False
+
+    def get_company_embeddings(self, company_ids: list):
+        """Get the embeddings of several companies in one query, returns {company_id: float32 array}"""
+        if self.company_shards is not None:
+            return self.company_shards.embeddings(company_ids)
+        try:
+            with self.pooled_connection() as conn:
+                cursor = conn.cursor()
+                self.execute_prepared(cursor, "company_embeddings", COMPANY_EMBEDDINGS, [list(company_ids)])
+                results = cursor.fetchall()
+                cursor.close()
+            return {row[0]: binary_vector(row[1]) for row in results}
+        except psycopg2.Error as e:
+            log.error(f"❌ Error executing query: {e}")
+            return False
+
+    def iter_company_embeddings(self, block_size: int = 10000):
+        """
+        Stream the embeddings of every company in blocks of (company_ids, (block_size, dim) float32 matrix).
+        Uses a server-side cursor so only one block is in memory at a time.
+        Raises psycopg2.Error if the stream fails, a partial stream would look like fewer companies.
+        """
+        if self.company_shards is not None:
+            yield from self.company_shards.iter_embeddings(block_size)
+            return
+        conn = self.get_connection(database=self.database_name)
+        if not conn:
+            raise psycopg2.OperationalError(f"Could not connect to {self.database_name} to stream the company embeddings")
+
+        try:
+            cursor = conn.cursor(name="company_embeddings_stream")
+            cursor.itersize = block_size
+            cursor.execute("""
+                SELECT company_id, vector_send(embeddings)
+                FROM companies
+                WHERE embeddings IS NOT NULL
+            """)
+            while True:
+                rows = cursor.fetchmany(block_size)
+                if not rows:
+                    break
+                company_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+                yield company_ids, binary_vectors([row[1] for row in rows])
+        except psycopg2.Error as e:
+            log.error(f"❌ Error streaming company embeddings: {e}")
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+    def query_companies_by_ids(self, company_ids: list):
+        """Get the companies (without embeddings) with these ids, returns {company_id: company}"""
+        if self.company_shards is not None:
+            return self.company_shards.companies_by_ids(company_ids)
+        conn = self.get_connection(database=self.database_name)
+        if not conn:
+            return False
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT company_id, company_name, cae_primary_label, trade_description_native, website
+                FROM companies
+                WHERE company_id = ANY(%s)
+            """, (list(company_ids),))
+            return {
+                row[0]: {
+                    'company_id': row[0],
+                    'company_name': row[1],
+                    'cae_primary_label': row[2],
+                    'trade_description_native': row[3],
+                    'website': row[4]
+                }
+                for row in cursor.fetchall()
+            }
+        except psycopg2.Error as e:
+            log.error(f"❌ Error executing query: {e}")
+            return False
+        finally:
+            cursor.close()
+            conn.close()
+
+    def query_company_by_name(self, company_name: str):
+        """Find a company by its name, exact match first and then the most similar name (trigram)"""
+        if self.company_shards is not None:
+            return self.company_shards.company_by_name(company_name)
+        conn = self.get_connection(database=self.database_name)
+        if not conn:
+            return False
+
+        try:
+            cursor = conn.cursor()
+            columns = "company_id, company_name, cae_primary_label, trade_description_native, website"
+            cursor.execute(f"SELECT {columns} FROM companies WHERE company_name = %s LIMIT 1", (company_name,))
+            result = cursor.fetchone()
+            if not result:
+                cursor.execute(f"""
+                    SELECT {columns}
+                    FROM companies
+                    WHERE company_name %% %s
+                    ORDER BY similarity(company_name, %s) DESC
+                    LIMIT 1
+                """, (company_name, company_name))
+                result = cursor.fetchone()
+            if not result:
+                logs.event(log, logging.DEBUG, "not_found", f"❌ No company found with name {company_name}")
+                return None
+            return {
+                'company_id': result[0],
+                'company_name': result[1],
+                'cae_primary_label': result[2],
+                'trade_description_native': result[3],
+                'website': result[4]
+            }
+        except psycopg2.Error as e:
+            log.error(f"❌ Error executing query: {e}")
+            return False
+        finally:
+            cursor.close()
+            conn.close()
+
+    def general_query(self, query: str, params=None, stream: bool = False, itersize: int = ITERSIZE):
+        """
+        Execute a general query on the database.
+        stream=True returns a generator of rows read with a server-side cursor (see iter_query)
+        instead of the whole result in a list, for queries over big tables.
+        """
+        if stream:
+            return self.iter_query(query, params, itersize)
+        conn = self.get_connection(database=self.database_name)
+        if not conn:
+            return False
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
             results = cursor.fetchall()
-            print(f"✅ Query executed successfully!")
+            logs.event(log, logging.INFO, "query_executed", "✅ Query executed successfully!", query="general", rows=len(results))
             return results
         except psycopg2.Error as e:
-            print(f"❌ Error executing query: {e}")
+            log.error(f"❌ Error executing query: {e}")
             return False
         finally:
             cursor.close()
             conn.close()
 
+    def iter_query(self, query: str, params=None, itersize: int = ITERSIZE):
+        """
+        Generator of the rows of a query, read with a named (server-side) cursor:
+        only `itersize` rows are in memory at a time, whatever the size of the result.
+        The connection is closed when the generator is exhausted or closed.
+        Raises psycopg2.Error if the query fails, even after some rows (the caller must not take them for all of them).
+        """
+        conn = self.get_connection(database=self.database_name)
+        if not conn:
+            raise psycopg2.OperationalError(f"Could not connect to {self.database_name} to stream the query")
+
+        cursor = conn.cursor(name=f"stream_{id(conn)}")
+        cursor.itersize = itersize
+        try:
+            cursor.execute(query, params)
+            yield from cursor
+        except psycopg2.Error as e:
+            log.error(f"❌ Error streaming query: {e}")
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+    def table_columns(self, table_name: str, include_embeddings: bool = False) -> list:
+        """Columns of a table, without the embeddings (~6 KB per row) unless asked for"""
+        rows = self.general_query(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = %s ORDER BY ordinal_position",
+            (table_name,)
+        ) or []
+        return [row[0] for row in rows if include_embeddings or row[0] != "embeddings"]
+
+    def iter_table(self, table_name: str, columns: list = None, include_embeddings: bool = False,
+                   order_by: str = None, itersize: int = ITERSIZE):
+        """
+        Generator of every row of a table as a dict, with flat memory use (see iter_query).
+        columns: the columns to read, by default all of them except the embeddings
+        """
+        columns = columns or self.table_columns(table_name, include_embeddings)
+        query = sql.SQL("SELECT {} FROM {}").format(
+            sql.SQL(", ").join(map(sql.Identifier, columns)),
+            sql.Identifier(table_name)
+        )
+        if order_by:
+            query += sql.SQL(" ORDER BY {}").format(sql.Identifier(order_by))
+        for row in self.iter_query(query, itersize=itersize):
+            yield dict(zip(columns, row))
+
 
 TEST_COMPANIES_N = 1000
 DB_CONFIG = {
@@ -499,6 +1282,52 @@ def read_csv(file_path: str, test: bool = False) -> list:
         print(f"❌ Error reading CSV file: {e}")
         return []
 
+def create_company_name_indexes(cursor):
+    """
+    Indexes of query_company_by_name: a btree for the exact match, and a trigram GIN for the
+    company_name % %s fallback (without it every row of companies gets scored), if pg_trgm is installed
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS companies_company_name_idx ON companies (company_name)")
+    cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+    if cursor.fetchone():
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS companies_company_name_trgm_idx ON companies USING gin (company_name gin_trgm_ops)"
+        )
+
+
+def binary_vector(value) -> np.ndarray:
+    """
+    Parse the binary representation of a pgvector vector (SELECT vector_send(embeddings)):
+    int16 dim, int16 unused, then dim big-endian float4
+    """
+    if value is None:
+        return None
+    return np.frombuffer(value, dtype=">f4", offset=4).astype(np.float32)
+
+def binary_vectors(values: list) -> np.ndarray:
+    """Many vector_send() values at once into a (len(values), dim) float32 matrix"""
+    # the 4 bytes of the header take the place of one float, dropped with [:, 1:]
+    matrix = np.frombuffer(b"".join(values), dtype=">f4").reshape(len(values), -1)
+    return matrix[:, 1:].astype(np.float32)
+
+def incentive_document(incentive: dict, max_tokens: int = 8000) -> str:
+    """Text that is embedded for an incentive (title + description + ai_description)"""
+    parts = []
+    for key in ("title", "description", "ai_description"):
+        value = incentive.get(key)
+        if value is None or isinstance(value, float):
+            continue
+        if not isinstance(value, str):
+            value = json.dumps(value, ensure_ascii=False)
+        parts.append(value.strip().strip('"'))
+    doc = "\n".join(parts)
+    # text-embedding-3-small accepts at most 8191 tokens
+    encoding = tiktoken.encoding_for_model("text-embedding-3-small")
+    tokens = encoding.encode(doc)
+    if len(tokens) > max_tokens:
+        doc = encoding.decode(tokens[:max_tokens])
+    return doc
+
 def check_token_number_companies():
     companies = read_csv('csvs/companies.csv')
     encoding = tiktoken.encoding_for_model("text-embedding-3-small")
@@ -537,23 +1366,24 @@ def check_token_number_companies():
     for p in range(10, 100, 10):
         print(f"{p}th percentile: {tokens[int(len(tokens) * p / 100)]}")
 
+# Table schemas (also used by sharding.py and snapshot.py)
+TABLE_INCENTIVES_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS incentives (
+        incentive_id SERIAL PRIMARY KEY,
+        title TEXT NOT NULL,
+        description TEXT,
+        ai_description JSONB,
+        document_urls TEXT,
+        date_publication DATE,
+        start_date DATE,
+        end_date DATE,
+        total_budget NUMERIC(15,2),
+        source_link TEXT,
+        embeddings VECTOR(1536)
+    )
+    """
+
 def add_incentives_table(db_manager: PostgreSQLManager):
-    # Table schema
-    TABLE_INCENTIVES_SCHEMA = """
-        CREATE TABLE IF NOT EXISTS incentives (
-            incentive_id SERIAL PRIMARY KEY,
-            title TEXT NOT NULL,
-            description TEXT,
-            ai_description JSONB,
-            document_urls TEXT,
-            date_publication DATE,
-            start_date DATE,
-            end_date DATE,
-            total_budget NUMERIC(15,2),
-            source_link TEXT
-        )
-        """
-    
     if not db_manager.create_table(DATABASE_NAME, 'incentives', TABLE_INCENTIVES_SCHEMA):
         print("Failed to create table. Exiting.")
         sys.exit(1)
@@ -562,19 +1392,18 @@ def add_incentives_table(db_manager: PostgreSQLManager):
         print("Failed to insert sample data. Exiting.")
         sys.exit(1)
 
-def add_companies_table(db_manager: PostgreSQLManager):
-    # Table schema
-    TABLE_COMPANIES_SCHEMA = """
-        CREATE TABLE IF NOT EXISTS companies (
-            company_id SERIAL PRIMARY KEY,
-            company_name TEXT NOT NULL,
-            cae_primary_label TEXT,
-            trade_description_native TEXT,
-            website TEXT,
-            embeddings VECTOR(1536)
-        )
-        """
+TABLE_COMPANIES_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS companies (
+        company_id SERIAL PRIMARY KEY,
+        company_name TEXT NOT NULL,
+        cae_primary_label TEXT,
+        trade_description_native TEXT,
+        website TEXT,
+        embeddings VECTOR(1536)
+    )
+    """
 
+def add_companies_table(db_manager: PostgreSQLManager):
     if not db_manager.create_table(DATABASE_NAME, 'companies', TABLE_COMPANIES_SCHEMA):
         print("Failed to create table. Exiting.")
         sys.exit(1)
@@ -728,6 +1557,27 @@ def list_elements_in_table(db_name, table_name, connection_params, limit=5):
             cursor.close()
             conn.close()
 
+def export_table_csv(database: PostgreSQLManager, table_name: str, file_path: str, include_embeddings: bool = False):
+    """
+    Export a whole table to CSV, row by row with a server-side cursor (flat memory, even for companies).
+    Returns the number of rows, False on error (the partial file is deleted)
+    """
+    columns = database.table_columns(table_name, include_embeddings)
+    total = 0
+    try:
+        with open(file_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in tqdm(database.iter_table(table_name, columns), desc=f"Exporting {table_name}"):
+                writer.writerow([row[column] for column in columns])
+                total += 1
+    except psycopg2.Error as e:
+        print(f"❌ Export of '{table_name}' failed after {total} rows, {file_path} deleted: {e}")
+        os.remove(file_path)
+        return False
+    print(f"✅ Exported {total} rows of '{table_name}' to {file_path}")
+    return total
+
 def query_companies(database: PostgreSQLManager, user_query: str):
     results = database.query_companies_with_embedding("augusta_labs_db", user_query, top_k=5)
     if results:
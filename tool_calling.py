@@ -2,7 +2,14 @@ from api import API
 import json
 import re
 from sql import PostgreSQLManager
+from incentive_index import IncentiveIndex
 from copy import deepcopy
+from prefetch import Prefetcher
+import rendering
+import cancellation
+import logs
+import logging
+import time
 
 PROMPT_TO_COMPLETE = """\n
 [System: Continue your previous response]
@@ -19,8 +26,11 @@ Now complete your response. (Do not write every thing again, just complete the p
 
 database = PostgreSQLManager()
 model_helper = API()
+incentive_index = IncentiveIndex(database)  # loaded on first use
+prefetcher = Prefetcher(lambda function, parameter: run_function(function, parameter))
+log = logs.get_logger(__name__)
 
-def analyze_response(response: str, messages: list, api: API):
+def analyze_response(response: str, messages: list, api: API, session_id: str = None):
     function_call = check_function_call(response)
     
     # Yield the first part of the response
@@ -32,16 +42,18 @@ def analyze_response(response: str, messages: list, api: API):
     text_part = response[:response.rfind("```json")]
     # print(f"Yielding response part: {text_part[:50]}...")
     yield text_part
-    print(f"[DEBUG] Function call: {function_call}")
     # Execute function and yield the result
     function = function_call["function"]
     parameter = function_call["parameter"]
-    info = execute_function(function, parameter)
+    time_start = time.perf_counter()
+    info = execute_function(function, parameter, session_id)
+    logs.event(log, logging.INFO, "tool_call", f"Function call: {function}({parameter})", function=function,
+               parameter=parameter, ms=round((time.perf_counter() - time_start) * 1000, 2), result_chars=len(info))
     # Assuming last message is from user..
     messages[-1]["content"] += PROMPT_TO_COMPLETE.format(response=text_part, info=info)
-    remaining_of_response = api.converse(messages)
+    remaining_of_response = api.converse(messages, site="continuation")
 
-    for p in analyze_response(remaining_of_response, messages, api):
+    for p in analyze_response(remaining_of_response, messages, api, session_id):
         if p:
             yield p
 
@@ -58,7 +70,23 @@ def check_function_call(response: str) -> dict:
         return json_jsn
     return None
 
-def execute_function(function: str, parameter: str) -> str:
+def execute_function(function: str, parameter: str, session_id: str = None) -> str:
+    """
+    Run a tool call. With a session_id, uses what was prefetched for that session
+    and starts prefetching the likely next call (see prefetch.py)
+    """
+    try:
+        cancellation.check()
+    except cancellation.RequestCancelled:
+        cancellation.stats.add("tool_calls_skipped")
+        raise
+    info = prefetcher.get(session_id, function, parameter)
+    if info is None:
+        info = run_function(function, parameter)
+    prefetcher.schedule(session_id, function, parameter, info)
+    return info
+
+def run_function(function: str, parameter: str) -> str:
     if   function == "get_incentive_by_id":
         return get_incentive_by_id(parameter)
     elif function == "get_incentive_by_title":
@@ -67,9 +95,15 @@ def execute_function(function: str, parameter: str) -> str:
         return get_company_by_title(parameter)
     elif function == "get_companies_by_incentive":
         return get_companies_by_incentive(parameter)
+    elif function == "get_incentives_by_company":
+        return get_incentives_by_company(parameter)
     else:
         return "Function not found"
 
+def incentive_cards() -> dict:
+    """Cards precomputed by the incentive catalog, None without it (rendered on the fly)"""
+    return database.incentive_catalog.cards() if database.incentive_catalog is not None else None
+
 def get_incentive_by_id(id: str) -> str:
     try:
         id = int(id)
@@ -77,65 +111,52 @@ def get_incentive_by_id(id: str) -> str:
             return "Invalid ID"
         result = database.query_incentives_by_id(id)
         if result:
-            return f"""
-                Incentive ID: {result['incentive_id']}
-                Title: {result['title']}
-                Description: {result['description']}
-                AI Description: {result['ai_description']}
-                Document URLs: {result['document_urls']}
-                Date Publication: {result['date_publication']}
-                Start Date: {result['start_date']}
-                End Date: {result['end_date']}
-                Total Budget: {result['total_budget']}
-                Source Link: {result['source_link']}
-            """
+            return rendering.render_incentive(result, incentive_cards())
         else:
             return "Incentive not found"
     except ValueError:
         return "Invalid ID"
     except Exception as e:
-        print(f"Error querying database: {e}")
+        log.error(f"Error querying database: {e}")
         return "Error querying database"
 
 def get_incentive_by_title(title: str) -> str:
     try:
-        result = database.query_incentives_by_name(title)
+        # Semantic + title similarity, finds incentives worded differently from the question (see incentive_index.py)
+        result = incentive_index.hybrid_search(title)
+        if result is False:
+            return "Error querying database"
         if result:
-            results_str = "Possible results:"
-            for r in result:
-                results_str += f"""\n
-                    Incentive ID: {r['incentive_id']}
-                    Title: {r['title']}
-                    Description: {r['description']}
-                    AI Description: {r['ai_description']}
-                """
-            return results_str
+            return rendering.render_incentives(result, incentive_cards())
         else:
             return "Incentive not found"
     except Exception as e:
-        print(f"Error querying database: {e}")
+        log.error(f"Error querying database: {e}")
         return "Error querying database"
 
-def get_company_by_title(title: str, top_k: int = 3) -> str:
+def get_company_by_title(title: str, top_k: int = 3, function: str = "get_company_by_title") -> str:
+    """function: the tool whose token budget applies (see rendering.BUDGETS)"""
     try:
         result = database.query_companies_with_embedding(title, top_k=top_k)
         if result:
-            results_str = "Possible results:"
-            for r in result:
-                results_str += f"""\n
-                    Company Name: {r['company_name']}
-                    CAE Primary Label: {r['cae_primary_label']}
-                    Trade Description Native: {r['trade_description_native']}
-                    Website: {r['website']}
-                """
-            return results_str
+            return rendering.render_companies(result, function)
         else:
             return "Company not found"
     except Exception as e:
-        print(f"Error querying database: {e}")
+        log.error(f"Error querying database: {e}")
         return "Error querying database"
 
 def get_companies_by_incentive(incentive_id: str, on_string: bool = True) -> str:
+    query = create_incentive_query(incentive_id)
+    # print(f"[DEBUG] Query: {query}")
+    if on_string:
+        companies = get_company_by_title(query, 5, function="get_companies_by_incentive")
+    else:
+        companies = database.query_companies_with_embedding(query, 5)
+    return companies
+
+def create_incentive_query(incentive_id: str) -> str:
+    """Uses the LLM to turn the incentive into a small query to search for companies"""
     incentive_info = get_incentive_by_id(incentive_id)
     prompt = f"""
     You have this incentive information: \n{incentive_info}\n
@@ -151,13 +172,27 @@ def get_companies_by_incentive(incentive_id: str, on_string: bool = True) -> str
     Now generate your query (in portuguese).
     Your response may only be the generated query, nothing else. NO bold, and NO prefix like "Query: ..."
     """
-    query = model_helper.call(prompt, system="You are a helpful assistant to create a query for a database.")
-    # print(f"[DEBUG] Query: {query}")
-    if on_string:
-        companies = get_company_by_title(query, 5)
-    else:
-        companies = database.query_companies_with_embedding(query, 5)
-    return companies
+    return model_helper.call(prompt, system="You are a helpful assistant to create a query for a database.", site="query_rewrite")
+
+def get_incentives_by_company(company_name: str, top_k: int = 5) -> str:
+    try:
+        company = database.query_company_by_name(company_name)
+        if not company:
+            return "Company not found"
+        result = incentive_index.rank_for_company(company['company_id'], top_k=max(1, int(top_k)))
+        if result is False:
+            return "Error querying database"
+        if result:
+            return rendering.fit(
+                [rendering.incentive_line(r) for r in result],
+                rendering.BUDGETS["get_incentives_by_company"],
+                header=f"Company: {company['company_name']}\nPossible incentives:"
+            )
+        else:
+            return "Incentive not found"
+    except Exception as e:
+        log.error(f"Error querying database: {e}")
+        return "Error querying database"
 
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+"""
+Client CPU and bytes on the wire of the vector queries, before and after the numpy adapters / prepared statements.
+
+    legacy:   embedding as a Python list (sent as ARRAY[...] and cast to vector by the server),
+              query parsed and planned every time, embeddings read back as text and parsed with json
+    numpy:    embedding as a float32 array (sent as a '[...]'::vector literal), prepared statement,
+              embeddings read back in binary (vector_send) into float32 arrays
+
+Bytes received are the size of the result values in the text protocol (bytea travels hex encoded).
+
+Usage: python vector_transfer_bench.py --queries 200
+"""
+import argparse
+import json
+import time
+from statistics import median
+
+from sql import PostgreSQLManager, SEARCH_COMPANIES, COMPANY_EMBEDDINGS, binary_vector
+
+
+def measure(function, queries: list) -> dict:
+    """function(query) -> (bytes sent, bytes received), returns the medians per query"""
+    cpu, wall, sent, received = [], [], [], []
+    for query in queries:
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        query_sent, query_received = function(query)
+        cpu.append(time.process_time() - cpu_start)
+        wall.append(time.perf_counter() - wall_start)
+        sent.append(query_sent)
+        received.append(query_received)
+    return {
+        "client_cpu_us": round(median(cpu) * 1e6),
+        "latency_us": round(median(wall) * 1e6),
+        "bytes_sent": round(median(sent)),
+        "bytes_received": round(median(received)),
+    }
+
+
+def main(queries: int, top_k: int, batch: int):
+    database = PostgreSQLManager()
+    with database.pooled_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT company_id FROM companies WHERE embeddings IS NOT NULL ORDER BY random() LIMIT %s", (queries,))
+        ids = [row[0] for row in cursor.fetchall()]
+        vectors = database.get_company_embeddings(ids)
+        query_vectors = [vectors[company_id] for company_id in ids]
+        # What the OpenAI response gives us: a list of floats with ~10 significant digits
+        query_lists = {id(vector): [float("%.10g" % x) for x in vector.tolist()] for vector in query_vectors}
+        id_batches = [ids[i:i + batch] for i in range(0, len(ids), batch)] * 5
+
+        def search_legacy(vector):
+            cursor.execute(SEARCH_COMPANIES.replace("$1", "%s::vector").replace("$2", "%s"), (query_lists[id(vector)], top_k))
+            rows = cursor.fetchall()
+            return len(cursor.query), sum(len(str(value)) for row in rows for value in row)
+
+        def search_numpy(vector):
+            database.execute_prepared(cursor, "search_companies", SEARCH_COMPANIES, [vector, top_k])
+            rows = cursor.fetchall()
+            return len(cursor.query), sum(len(str(value)) for row in rows for value in row)
+
+        def embeddings_legacy(company_ids):
+            cursor.execute(
+                "SELECT company_id, embeddings::text FROM companies WHERE company_id = ANY(%s) AND embeddings IS NOT NULL",
+                (company_ids,)
+            )
+            rows = cursor.fetchall()
+            {row[0]: json.loads(row[1]) for row in rows}
+            return len(cursor.query), sum(len(row[1]) for row in rows)
+
+        def embeddings_numpy(company_ids):
+            database.execute_prepared(cursor, "company_embeddings", COMPANY_EMBEDDINGS, [company_ids])
+            rows = cursor.fetchall()
+            {row[0]: binary_vector(row[1]) for row in rows}
+            return len(cursor.query), sum(2 * len(row[1]) for row in rows)
+
+        # Warm up the caches (and prepare the statements) before measuring
+        for function, argument in ((search_legacy, query_vectors[0]), (search_numpy, query_vectors[0]),
+                                   (embeddings_legacy, id_batches[0]), (embeddings_numpy, id_batches[0])):
+            function(argument)
+
+        print(f"Vector search ({len(query_vectors)} queries, top {top_k}):")
+        print(f"  legacy: {measure(search_legacy, query_vectors)}")
+        print(f"  numpy:  {measure(search_numpy, query_vectors)}")
+        print(f"Fetch embeddings ({len(id_batches)} batches of {batch} companies):")
+        print(f"  legacy: {measure(embeddings_legacy, id_batches)}")
+        print(f"  numpy:  {measure(embeddings_numpy, id_batches)}")
+        cursor.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the vector transfer between the app and Postgres")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--batch", type=int, default=50, help="companies per embedding fetch")
+    args = parser.parse_args()
+    main(args.queries, args.top_k, args.batch)
@@ -0,0 +1,277 @@
+"""
+Warmup of a freshly started API worker, before it says it's ready (/health).
+
+A new worker is slow on its first requests: the companies table, its embeddings (TOAST) and the vector index
+are cold in shared_buffers, the pool has no connection open, the result cache and the embeddings of the
+incentive searches are empty, and the first embedding request pays for the TLS handshake. The lifespan of
+api_server.py runs Warmup.run() in the background, every step is timed and a failed step doesn't stop the others:
+    connections     open and configure WARMUP_CONNECTIONS pooled connections (prepared hot statements)
+    prewarm         pg_prewarm of WARMUP_TABLES with their TOAST and indexes (see PostgreSQLManager.prewarm_tables)
+    incentives      load the incentive index (the catalog is already loaded by the lifespan)
+    queries         run the WARMUP_QUERIES searches asked the most in the last WARMUP_RECENT_DAYS days,
+                    fills the result cache and the query embeddings, and opens the connection to the embeddings API
+/health answers 503 {"status": "warming"} until it's done (or WARMUP_TIMEOUT seconds passed), then 200.
+
+The searches are counted by QueryRecorder (database.query_recorder): a Counter in memory, added every
+RECORD_FLUSH_SECONDS to the frequent_queries table (one row per kind, query, top_k and day), shared by every
+worker, so a new worker primes what the others were asked.
+
+    WARMUP=0                disables it (ready right away)
+    WARMUP_QUERIES=200
+    WARMUP_RECENT_DAYS=7
+    WARMUP_CONNECTIONS=10   (at most DB_POOL_SIZE)
+    WARMUP_TABLES=companies,incentives
+    WARMUP_CONCURRENCY=8
+    WARMUP_TIMEOUT=120
+    RECORD_QUERIES=1        (0: this worker doesn't count its searches, it still primes what the others counted)
+    RECORD_FLUSH_SECONDS=60
+"""
+import atexit
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from result_cache import normalize
+from sql import POOL_SIZE
+import logs
+
+ENABLED = os.getenv("WARMUP", "1") == "1"
+QUERIES = int(os.getenv("WARMUP_QUERIES", 200))
+RECENT_DAYS = int(os.getenv("WARMUP_RECENT_DAYS", 7))
+CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", POOL_SIZE))
+TABLES = [table.strip() for table in os.getenv("WARMUP_TABLES", "companies,incentives").split(",") if table.strip()]
+CONCURRENCY = int(os.getenv("WARMUP_CONCURRENCY", 8))
+TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", 120))
+
+RECORD = os.getenv("RECORD_QUERIES", "1") == "1"
+FLUSH_SECONDS = float(os.getenv("RECORD_FLUSH_SECONDS", 60))
+# Distinct queries kept in memory between two flushes, the new ones over this are not counted
+MAX_PENDING = 10_000
+# Longer texts are not counted (pasted documents are not going to be asked again)
+MAX_QUERY_LENGTH = 500
+
+# False while the warmup runs its own searches, so they don't count as asked
+recording = contextvars.ContextVar("record_queries", default=True)
+
+log = logs.get_logger(__name__)
+
+
+class QueryRecorder:
+    """Counts the searches (kind, normalized query, top_k), flushed to the frequent_queries table"""
+
+    def __init__(self, database, flush_seconds: float = FLUSH_SECONDS):
+        self.database = database
+        self.flush_seconds = flush_seconds
+        self.lock = threading.Lock()
+        self.pending = Counter()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.counters = {"recorded": 0, "not_counted": 0, "flushes": 0, "flush_errors": 0}
+
+    def create(self) -> bool:
+        conn = self.database.get_connection(database=self.database.database_name)
+        if not conn:
+            return False
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS frequent_queries (
+                    kind TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    top_k INTEGER NOT NULL,
+                    day DATE NOT NULL DEFAULT current_date,
+                    count BIGINT NOT NULL,
+                    PRIMARY KEY (kind, query, top_k, day)
+                )
+            """)
+            conn.commit()
+            return True
+        except psycopg2.Error as e:
+            log.error(f"❌ Error creating the frequent queries table: {e}")
+            conn.rollback()
+            return False
+        finally:
+            cursor.close()
+            conn.close()
+
+    def start(self) -> bool:
+        if not self.create():
+            return False
+        self.thread = threading.Thread(target=self.run, name="query-recorder", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+        return True
+
+    def stop(self):
+        if self.thread is not None and not self.stop_event.is_set():
+            self.stop_event.set()
+            self.thread.join(timeout=5)
+
+    def run(self):
+        while not self.stop_event.wait(self.flush_seconds):
+            self.flush()
+        self.flush()
+
+    def record(self, kind: str, query: str, top_k: int):
+        if not recording.get() or not query or len(query) > MAX_QUERY_LENGTH:
+            return
+        key = (kind, normalize(query), int(top_k))
+        with self.lock:
+            if key not in self.pending and len(self.pending) >= MAX_PENDING:
+                self.counters["not_counted"] += 1
+                return
+            self.pending[key] += 1
+            self.counters["recorded"] += 1
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, Counter()
+        if not pending:
+            return
+        try:
+            with self.database.pooled_connection() as conn:
+                cursor = conn.cursor()
+                # One statement for all of them, sorted so two workers flushing at the same time lock the rows in the same order
+                execute_values(
+                    cursor,
+                    """
+                    INSERT INTO frequent_queries (kind, query, top_k, count) VALUES %s
+                    ON CONFLICT (kind, query, top_k, day) DO UPDATE SET count = frequent_queries.count + EXCLUDED.count
+                    """,
+                    [(*key, count) for key, count in sorted(pending.items())]
+                )
+                cursor.execute("DELETE FROM frequent_queries WHERE day < current_date - %s", (RECENT_DAYS,))
+                cursor.close()
+            self.counters["flushes"] += 1
+        except psycopg2.Error as e:
+            # Lost, they are only counts
+            self.counters["flush_errors"] += 1
+            log.warning(f"⚠️ Error writing the frequent queries: {e}")
+
+    def top(self, limit: int = QUERIES, days: int = RECENT_DAYS) -> list:
+        """(kind, query, top_k) asked the most in the last days, most asked first"""
+        try:
+            with self.database.pooled_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """
+                    SELECT kind, query, top_k FROM frequent_queries
+                    WHERE day >= current_date - %s
+                    GROUP BY kind, query, top_k
+                    ORDER BY sum(count) DESC, kind, query, top_k
+                    LIMIT %s
+                    """,
+                    (days, limit)
+                )
+                rows = cursor.fetchall()
+                cursor.close()
+            return rows
+        except psycopg2.Error as e:
+            log.warning(f"⚠️ Error reading the frequent queries: {e}")
+            return []
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {**self.counters, "pending": len(self.pending)}
+
+
+@contextmanager
+def not_recorded():
+    token = recording.set(False)
+    try:
+        yield
+    finally:
+        recording.reset(token)
+
+
+class Warmup:
+    def __init__(self, database, incentive_index, enabled: bool = ENABLED):
+        self.database = database
+        self.incentive_index = incentive_index
+        self.enabled = enabled
+        self.status = "warming" if enabled else "disabled"
+        self.steps = {}     # name -> {"ms": ..., "ok": ..., details}
+        self.time_start = None
+        self.ms = None
+
+    @property
+    def ready(self) -> bool:
+        return self.status != "warming"
+
+    def step(self, name: str, function, *args):
+        """Run one step, timed, an error only fails this step"""
+        time_start = time.perf_counter()
+        try:
+            details = function(*args) or {}
+            ok = True
+        except Exception as e:
+            log.error(f"❌ Warmup step '{name}' failed: {e}")
+            details, ok = {"error": str(e)}, False
+        self.steps[name] = {"ok": ok, "ms": round((time.perf_counter() - time_start) * 1000, 1), **details}
+        logs.event(log, logging.INFO, "warmup_step", f"🔥 Warmup step '{name}' done", step=name, **self.steps[name])
+
+    def connections(self) -> dict:
+        return {"opened": self.database.warm_connections(CONNECTIONS)}
+
+    def prewarm(self) -> dict:
+        blocks = self.database.prewarm_tables(TABLES)
+        if self.database.company_shards is not None:
+            for i, shard in enumerate(self.database.company_shards.shards):
+                blocks.update({f"shard{i}.{relation}": count for relation, count in shard.prewarm_tables(["companies"]).items()})
+        return {"blocks": blocks}
+
+    def incentives(self) -> dict:
+        return {"loaded": self.incentive_index.load()}
+
+    def search(self, kind: str, query: str, top_k: int):
+        with not_recorded():
+            if kind == "companies":
+                return self.database.query_companies_with_embedding(query, top_k)
+            return self.incentive_index.hybrid_search(query, top_k)
+
+    def queries(self, deadline: float) -> dict:
+        # Also with RECORD_QUERIES=0, the other workers may be recording
+        recorder = self.database.query_recorder or QueryRecorder(self.database)
+        queries = recorder.top(QUERIES, RECENT_DAYS)
+        if not queries:
+            # Nothing recorded yet, one embedding request at least opens the connection to the API
+            self.incentive_index.query_vector("warmup")
+            return {"primed": 0}
+        executor = ThreadPoolExecutor(max_workers=CONCURRENCY, thread_name_prefix="warmup")
+        futures = [executor.submit(self.search, *query) for query in queries]
+        done, not_done = wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+        # The ones not started yet are dropped, the running ones finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+        errors = sum(1 for future in done if future.exception() is not None or future.result() is False)
+        return {"primed": len(done) - errors, "errors": errors, "skipped": len(not_done)}
+
+    def run(self):
+        """All the steps, in order (the lifespan runs it in the executor)"""
+        if not self.enabled:
+            return
+        self.time_start = time.perf_counter()
+        deadline = time.monotonic() + TIMEOUT
+        self.step("connections", self.connections)
+        self.step("prewarm", self.prewarm)
+        self.step("incentives", self.incentives)
+        self.step("queries", self.queries, deadline)
+        self.finish()
+
+    def finish(self, status: str = "ready"):
+        """Ready from now on (status "timed_out" if the lifespan stopped waiting for it)"""
+        if self.ready:
+            return
+        self.ms = round((time.perf_counter() - self.time_start) * 1000, 1) if self.time_start else None
+        self.status = status
+        logs.event(log, logging.INFO, "warmup_done", f"🔥 Warmup {status} in {self.ms} ms", status=status, ms=self.ms)
+
+    def stats(self) -> dict:
+        return {"status": self.status, "ms": self.ms, "steps": self.steps}